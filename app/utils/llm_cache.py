@@ -0,0 +1,147 @@
+"""Persistent cache of LLM (Ollama generate) responses.
+
+Provides:
+- CACHE_MODES: per-request policies ("auto", "use", "refresh", "bypass")
+- cache_key(request, digest): sha256 of a generate request (model, prompt,
+  system, format, options, ...) and the model's digest
+- is_deterministic(options, max_temperature): whether "auto" caches a request
+- LlmCache(path, max_bytes, ttl): SQLite store of responses with TTL expiry
+  and least-recently-used eviction by total size
+
+Policies: "auto" reads and writes only requests sampled at temperature <=
+max_temperature (an answer at 0.8 is not the answer to replay); "use" does so
+for any request; "refresh" skips the lookup but stores the new answer;
+"bypass" does neither. The model digest is part of the key, so pulling a new
+build of a model under the same name never serves answers of the old one.
+
+The database is in WAL mode: uvicorn workers share one file, readers do not
+block the writer, and a commit costs no fsync. Calls block (up to the busy
+timeout while another worker writes): async callers run them in a thread.
+A put only adds to a running byte total; expired entries are dropped and the
+total is recounted (other workers write too) every EVICT_EVERY puts, or as
+soon as the total is over max_bytes. Keep-alive settings and the stream flag
+are not part of the key.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional
+
+try:
+    from prometheus_client import Counter
+except Exception:
+    Counter = None
+
+if Counter is not None:
+    _HITS = Counter("llm_response_cache_hits_total", "LLM response cache hits")
+    _MISSES = Counter("llm_response_cache_misses_total", "LLM response cache misses")
+else:
+    _HITS = _MISSES = None
+
+CACHE_MODES = ("auto", "use", "refresh", "bypass")
+EVICT_EVERY = 64
+# generate() arguments that do not change the answer
+_UNKEYED = ("stream", "keep_alive")
+
+
+def cache_key(request: Mapping[str, Any], digest: str) -> str:
+    body = {k: v for k, v in request.items() if k not in _UNKEYED and v not in (None, "", [], {})}
+    body["digest"] = digest
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def is_deterministic(options: Optional[Mapping[str, Any]], max_temperature: float = 0.1) -> bool:
+    temperature = (options or {}).get("temperature")
+    return temperature is not None and float(temperature) <= max_temperature
+
+
+class LlmCache:
+    def __init__(self, path: Path, max_bytes: int = 256 * 1024 * 1024, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, created REAL, used REAL, size INTEGER, response TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        self._bytes = self._total()
+
+    def _total(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ? AND created >= ?", (key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                if _MISSES is not None:
+                    _MISSES.inc()
+                return None
+            self._db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            if _HITS is not None:
+                _HITS.inc()
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, response: Mapping[str, Any]) -> None:
+        data = json.dumps(dict(response), default=str)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, now, now, len(data), data),
+            )
+            self._bytes += len(data) - (old[0] if old else 0)
+            self._puts += 1
+            if self._bytes > self.max_bytes or self._puts % EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        dropped = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,)).rowcount
+        total = self._total()
+        if total > self.max_bytes:
+            stale = []
+            # walks the ``used`` index only as far as needed
+            rows = self._db.execute("SELECT key, size FROM responses ORDER BY used")
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            rows.close()
+            self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
+            dropped += len(stale)
+        self._bytes = total
+        self.evictions += max(dropped, 0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {
+                "entries": entries,
+                "bytes": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,342 @@
+"""Application-scoped access to the Ollama server.
+
+Provides:
+- LlmGateway: one pooled sync ollama.Client and one ollama.AsyncClient with
+  shared connection limits, timeouts and a default model ``keep_alive``
+  - generate(...) / agenerate(...): ollama generate through the pooled clients
+  - astream(...): async iterator of a streamed generation's parts; closing it
+    early closes the upstream request, and Ollama stops generating
+  - list() / alist(): installed models
+  - digest(model) / adigest(model): the installed build of a model
+  - admit(model, priority): refuse now (QueueFull) what the scheduler would
+  - stats(): coalesced requests and generations in flight
+  - close() / aclose(): release the connection pools
+
+A fresh ollama.Client per request builds a new httpx connection pool, so every
+call paid a TCP (and, behind a proxy, TLS) handshake. The gateway is created
+once per process (in the app lifespan) and its connections stay open between
+calls. Async endpoints use agenerate and hold no threadpool worker while a
+generation runs; sync callers (background threads, jobs) use generate.
+
+With an LlmCache attached, generate/agenerate/astream take a ``cache`` policy
+(app.utils.llm_cache.CACHE_MODES) and answer repeated requests from it; a
+streamed hit is replayed as one part plus the final stats. Model digests are
+looked up with /api/tags and remembered for DIGEST_TTL seconds. The async
+paths read and write the (SQLite) cache from a worker thread, so a write held
+up by another process never stalls the event loop.
+
+Concurrent identical async requests (same model, prompt, options, ...) are
+coalesced: the first starts the upstream generation as a task of its own and
+the others attach to it, so N browser tabs asking the same question cost one
+generation. A streamed generation is fanned out to every subscriber, late
+joiners first get the parts already produced; it is cancelled (and Ollama
+stops) once its last subscriber has gone. Sync callers are not coalesced.
+
+With an LlmScheduler attached, every upstream generation holds one of the
+model's slots while it runs; generate/agenerate/astream take a ``priority``
+(app.utils.llm_scheduler.PRIORITIES, default "batch") and raise QueueFull when
+the model's queue is full. Cache hits and coalesced requests take no slot.
+
+Time to the first streamed part (model load + prompt evaluation, i.e. the
+wait a streaming user sees) is recorded in a prometheus_client histogram,
+and coalesced requests are counted (when prometheus_client is installed),
+both exposed on the app's /metrics endpoint.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, AsyncContextManager, AsyncIterator, ContextManager, Dict, List, Mapping, Optional, Tuple, Union
+
+from app.utils.llm_cache import CACHE_MODES, LlmCache, cache_key, is_deterministic
+from app.utils.llm_scheduler import LlmScheduler
+
+import anyio
+
+try:
+    import httpx
+    from ollama import AsyncClient, Client
+except Exception:  # pragma: no cover - ollama is optional until an LLM endpoint is used
+    httpx = AsyncClient = Client = None
+
+try:
+    from prometheus_client import Counter, Histogram
+except Exception:
+    Counter = Histogram = None
+
+_FIRST_TOKEN = (
+    Histogram(
+        "llm_time_to_first_token_seconds",
+        "Seconds from a streamed generate request to its first part",
+        ["model"],
+        buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+    )
+    if Histogram is not None
+    else None
+)
+_COALESCED = (
+    Counter("llm_coalesced_requests_total", "LLM requests served by an identical in-flight generation", ["kind"])
+    if Counter is not None
+    else None
+)
+_UPSTREAM = (
+    Counter("llm_upstream_generations_total", "Generations sent to Ollama by async callers", ["kind"])
+    if Counter is not None
+    else None
+)
+
+DIGEST_TTL = 60.0
+
+
+class _Flight:
+    """Parts of one streamed upstream generation, replayed to each subscriber."""
+
+    def __init__(self) -> None:
+        self.parts: List[Mapping[str, Any]] = []
+        self.error: Optional[BaseException] = None
+        self.finished = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, part: Optional[Mapping[str, Any]] = None, error: Optional[BaseException] = None) -> None:
+        if part is not None:
+            self.parts.append(part)
+        else:
+            self.error, self.finished = error, True
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[Mapping[str, Any]]:
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class LlmGateway:
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        max_connections: int = 16,
+        max_keepalive: int = 8,
+        timeout: Optional[float] = 600.0,
+        connect_timeout: float = 10.0,
+        keep_alive: Optional[Union[float, str]] = None,
+        cache: Optional[LlmCache] = None,
+        cache_max_temperature: float = 0.1,
+        coalesce: bool = True,
+        scheduler: Optional[LlmScheduler] = None,
+    ):
+        if Client is None:
+            raise RuntimeError("ollama is not installed")
+        self.host = host
+        self.keep_alive = keep_alive
+        self.cache = cache
+        self.cache_max_temperature = cache_max_temperature
+        self.coalesce = coalesce
+        self.scheduler = scheduler
+        self.coalesced = 0
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, _Flight] = {}
+        self._digests: Dict[str, Tuple[str, float]] = {}
+        self._digest_lock = threading.Lock()
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        timeouts = httpx.Timeout(timeout, connect=connect_timeout)
+        self.client = Client(host=host, limits=limits, timeout=timeouts)
+        self.aclient = AsyncClient(host=host, limits=limits, timeout=timeouts)
+
+    def _defaults(self, kwargs: dict) -> dict:
+        if self.keep_alive is not None:
+            kwargs.setdefault("keep_alive", self.keep_alive)
+        return kwargs
+
+    # ------------------------------------------------------------------
+    def _cached(self, mode: str, kwargs: dict) -> bool:
+        if mode not in CACHE_MODES:
+            raise ValueError(f"unknown cache mode {mode!r}; expected one of {', '.join(CACHE_MODES)}")
+        if self.cache is None or mode == "bypass":
+            return False
+        return mode != "auto" or is_deterministic(kwargs.get("options"), self.cache_max_temperature)
+
+    def _slot(self, kwargs: dict, priority: str) -> ContextManager[None]:
+        return self.scheduler.slot(kwargs.get("model", ""), priority) if self.scheduler is not None else nullcontext()
+
+    def _aslot(self, kwargs: dict, priority: str) -> AsyncContextManager[None]:
+        return self.scheduler.aslot(kwargs.get("model", ""), priority) if self.scheduler is not None else nullcontext()
+
+    def admit(self, model: str, priority: str = "batch") -> None:
+        if self.scheduler is not None:
+            self.scheduler.check(model, priority)
+
+    def _lookup(self, mode: str, key: str) -> Optional[Dict[str, Any]]:
+        return self.cache.get(key) if mode != "refresh" else None
+
+    async def _alookup(self, mode: str, key: str) -> Optional[Dict[str, Any]]:
+        return await anyio.to_thread.run_sync(self._lookup, mode, key)
+
+    async def _astore(self, key: str, model: str, resp: Mapping[str, Any]) -> None:
+        await anyio.to_thread.run_sync(self.cache.put, key, model, resp)
+
+    def _known_digest(self, model: str) -> Optional[str]:
+        with self._digest_lock:
+            item = self._digests.get(model)
+        return item[0] if item is not None and time.time() - item[1] < DIGEST_TTL else None
+
+    def _remember_digests(self, listing: Mapping[str, Any], model: str) -> str:
+        now = time.time()
+        found = {}
+        for m in listing.get("models", []):
+            name = m.get("name") or m.get("model") or ""
+            found[name] = found[name.removesuffix(":latest")] = m.get("digest", "")
+        with self._digest_lock:
+            for name, digest in found.items():
+                self._digests[name] = (digest, now)
+        return found.get(model, "")
+
+    def digest(self, model: str) -> str:
+        digest = self._known_digest(model)
+        if digest is None:
+            digest = self._remember_digests(self.client.list(), model)
+        return digest
+
+    async def adigest(self, model: str) -> str:
+        digest = self._known_digest(model)
+        if digest is None:
+            digest = self._remember_digests(await self.aclient.list(), model)
+        return digest
+
+    # ------------------------------------------------------------------
+    def generate(self, cache: str = "auto", priority: str = "batch", **kwargs: Any) -> Mapping[str, Any]:
+        if not self._cached(cache, kwargs):
+            with self._slot(kwargs, priority):
+                return self.client.generate(**self._defaults(kwargs))
+        key = cache_key(kwargs, self.digest(kwargs.get("model", "")))
+        resp = self._lookup(cache, key)
+        if resp is None:
+            with self._slot(kwargs, priority):
+                resp = self.client.generate(**self._defaults(kwargs))
+            self.cache.put(key, kwargs.get("model", ""), resp)
+        return resp
+
+    def _joined(self, kind: str) -> None:
+        self.coalesced += 1
+        if _COALESCED is not None:
+            _COALESCED.labels(kind).inc()
+
+    def _started(self, kind: str) -> None:
+        if _UPSTREAM is not None:
+            _UPSTREAM.labels(kind).inc()
+
+    async def agenerate(self, cache: str = "auto", priority: str = "batch", **kwargs: Any) -> Any:
+        key = None
+        if self._cached(cache, kwargs):
+            key = cache_key(kwargs, await self.adigest(kwargs.get("model", "")))
+            resp = await self._alookup(cache, key)
+            if resp is not None:
+                return resp
+
+        async def call() -> Any:
+            async with self._aslot(kwargs, priority):
+                self._started("generate")
+                resp = await self.aclient.generate(**self._defaults(dict(kwargs)))
+            if key is not None:
+                await self._astore(key, kwargs.get("model", ""), resp)
+            return resp
+
+        if not self.coalesce:
+            return await call()
+        flight = cache_key(kwargs, "")
+        call_task = self._calls.get(flight)
+        if call_task is None:
+            # a task of its own: a waiter that is cancelled does not cancel it for the others
+            call_task = self._calls[flight] = asyncio.ensure_future(call())
+            call_task.add_done_callback(lambda t: (self._calls.pop(flight, None), t.cancelled() or t.exception()))
+        else:
+            self._joined("generate")
+        return await asyncio.shield(call_task)
+
+    async def astream(self, cache: str = "auto", priority: str = "batch", **kwargs: Any) -> AsyncIterator[Mapping[str, Any]]:
+        key = None
+        if self._cached(cache, kwargs):
+            key = cache_key(kwargs, await self.adigest(kwargs.get("model", "")))
+            hit = await self._alookup(cache, key)
+            if hit is not None:
+                yield {"model": hit.get("model"), "response": hit.get("response", ""), "done": False}
+                yield dict(hit, response="")
+                return
+        name = cache_key(kwargs, "")
+        flight = self._streams.get(name) if self.coalesce else None
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(self._pump(flight, key, priority, kwargs))
+            if self.coalesce:
+                self._streams[name] = flight
+                flight.task.add_done_callback(lambda _: self._streams.get(name) is flight and self._streams.pop(name))
+        else:
+            self._joined("stream")
+        flight.subscribers += 1
+        try:
+            async for part in flight.follow():
+                yield part
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.finished:
+                # nobody listens any more: stop the generation, later requests start afresh
+                if self._streams.get(name) is flight:
+                    del self._streams[name]
+                flight.task.cancel()
+
+    async def _pump(self, flight: _Flight, key: Optional[str], priority: str, kwargs: dict) -> None:
+        started = time.perf_counter()
+        pieces: List[str] = []
+        error: Optional[BaseException] = None
+        try:
+            async with self._aslot(kwargs, priority):
+                self._started("stream")
+                parts = await self.aclient.generate(stream=True, **self._defaults(dict(kwargs)))
+                try:
+                    async for part in parts:
+                        if not pieces and _FIRST_TOKEN is not None:
+                            _FIRST_TOKEN.labels(kwargs.get("model", "")).observe(time.perf_counter() - started)
+                        pieces.append(part.get("response", ""))
+                        if key is not None and part.get("done"):
+                            await self._astore(key, kwargs.get("model", ""), dict(part, response="".join(pieces)))
+                        flight.publish(part)
+                finally:
+                    # leaves the httpx stream: the connection is dropped if the body was not fully read
+                    await parts.aclose()
+        except Exception as exc:
+            error = exc
+        finally:
+            flight.publish(error=error)
+
+    def stats(self) -> Dict[str, int]:
+        return {"coalesced": self.coalesced, "in_flight": len(self._calls) + len(self._streams)}
+
+    def list(self) -> List[str]:
+        return _model_names(self.client.list())
+
+    async def alist(self) -> List[str]:
+        return _model_names(await self.aclient.list())
+
+    # ollama's clients do not expose close(); their httpx client is ``_client``
+    def close(self) -> None:
+        self.client._client.close()
+
+    async def aclose(self) -> None:
+        self.close()
+        await self.aclient._client.aclose()
+
+
+def _model_names(listing: Mapping[str, Any]) -> List[str]:
+    return [m.get("name") or m.get("model") for m in listing.get("models", [])]
@@ -0,0 +1,223 @@
+"""Admission control for LLM generations.
+
+Provides:
+- PRIORITIES: request classes, most urgent first ("interactive", "batch")
+- QueueFull: raised when a model's wait queue is full; carries retry_after
+- LlmScheduler(concurrency, max_queue, limits): per-model generation slots
+  - slot(model, priority) / aslot(model, priority): hold a slot (sync / async)
+  - check(model, priority): raise QueueFull now if a request would be refused
+  - stats(): active and queued generations per model, rejections
+
+Ollama runs a handful of generations per model at once and queues the rest
+internally, where nothing bounds the wait nor tells a chat question from a
+batch job. The scheduler keeps at most ``limits.get(model, concurrency)``
+generations per model in flight; further requests wait in a priority queue
+(interactive first, FIFO within a class). When ``max_queue`` requests are
+already waiting for the model, a request is refused at once with QueueFull,
+and retry_after estimates when a slot frees up from the recent generation
+time. A waiter that is cancelled (client gone) leaves the queue.
+
+Queue depth, active generations, wait time and rejections are exported as
+prometheus_client metrics (when installed) on the app's /metrics endpoint.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+except Exception:
+    Counter = Gauge = Histogram = None
+
+if Gauge is not None:
+    _DEPTH = Gauge("llm_queue_depth", "LLM requests waiting for a generation slot", ["model"])
+    _ACTIVE = Gauge("llm_active_generations", "LLM generations holding a slot", ["model"])
+    _WAIT = Histogram(
+        "llm_queue_wait_seconds",
+        "Seconds an LLM request waited for a generation slot",
+        ["model", "priority"],
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+    )
+    _REJECTED = Counter("llm_rejected_requests_total", "LLM requests refused because the queue was full", ["model", "priority"])
+else:
+    _DEPTH = _ACTIVE = _WAIT = _REJECTED = None
+
+PRIORITIES = ("interactive", "batch")
+# assumed generation time until one has been measured
+_DEFAULT_SERVICE = 5.0
+
+
+class QueueFull(RuntimeError):
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"LLM queue for {model!r} is full; retry in {retry_after}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.granted = False
+
+
+class _ModelQueue:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiting: List[Tuple[int, int, _Waiter]] = []
+        self.service = _DEFAULT_SERVICE
+        self.measured = False
+        self.admitted = 0
+        self.rejected = 0
+
+
+class LlmScheduler:
+    def __init__(self, concurrency: int = 2, max_queue: int = 32, limits: Optional[Dict[str, int]] = None):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.limits = dict(limits or {})
+        self._models: Dict[str, _ModelQueue] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _queue(self, model: str) -> _ModelQueue:
+        q = self._models.get(model)
+        if q is None:
+            q = self._models[model] = _ModelQueue(max(1, self.limits.get(model, self.concurrency)))
+        return q
+
+    def _retry_after(self, q: _ModelQueue) -> int:
+        # the queue ahead drains ``limit`` generations at a time
+        return max(1, math.ceil(q.service * (len(q.waiting) // q.limit + 1)))
+
+    def _refuse(self, model: str, q: _ModelQueue, priority: str) -> QueueFull:
+        q.rejected += 1
+        if _REJECTED is not None:
+            _REJECTED.labels(model, priority).inc()
+        return QueueFull(model, self._retry_after(q))
+
+    def _publish(self, model: str, q: _ModelQueue) -> None:
+        if _DEPTH is not None:
+            _DEPTH.labels(model).set(len(q.waiting))
+            _ACTIVE.labels(model).set(q.active)
+
+    def check(self, model: str, priority: str = "batch") -> None:
+        """Raise QueueFull if a request for ``model`` would be refused right now."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown priority {priority!r}; expected one of {', '.join(PRIORITIES)}")
+        with self._lock:
+            q = self._queue(model)
+            if q.active >= q.limit and len(q.waiting) >= self.max_queue:
+                raise self._refuse(model, q, priority)
+
+    def _enter(self, model: str, priority: str, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """Take a free slot (None) or queue a waiter that ``wake`` notifies once it holds one."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown priority {priority!r}; expected one of {', '.join(PRIORITIES)}")
+        with self._lock:
+            q = self._queue(model)
+            if q.active < q.limit and not q.waiting:
+                q.active += 1
+                q.admitted += 1
+                self._publish(model, q)
+                return None
+            if len(q.waiting) >= self.max_queue:
+                raise self._refuse(model, q, priority)
+            waiter = _Waiter(wake)
+            heapq.heappush(q.waiting, (PRIORITIES.index(priority), next(self._seq), waiter))
+            self._publish(model, q)
+            return waiter
+
+    def _leave(self, model: str, waiter: _Waiter) -> bool:
+        """Drop a waiter that gave up; False if it was granted a slot meanwhile (release it)."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            q = self._models[model]
+            q.waiting = [item for item in q.waiting if item[2] is not waiter]
+            heapq.heapify(q.waiting)
+            self._publish(model, q)
+            return True
+
+    def _release(self, model: str, held: Optional[float]) -> None:
+        with self._lock:
+            q = self._models[model]
+            if held is not None:
+                q.service = 0.8 * q.service + 0.2 * held if q.measured else held
+                q.measured = True
+            if q.waiting:
+                # hand the slot over: ``active`` stays as it is
+                _, _, waiter = heapq.heappop(q.waiting)
+                waiter.granted = True
+                q.admitted += 1
+                waiter.wake()
+            else:
+                q.active -= 1
+            self._publish(model, q)
+
+    def _waited(self, model: str, priority: str, since: float) -> None:
+        if _WAIT is not None:
+            _WAIT.labels(model, priority).observe(time.perf_counter() - since)
+
+    @contextmanager
+    def slot(self, model: str, priority: str = "batch") -> Iterator[None]:
+        queued = time.perf_counter()
+        granted = threading.Event()
+        waiter = self._enter(model, priority, granted.set)
+        if waiter is not None:
+            granted.wait()
+        self._waited(model, priority, queued)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(model, time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def aslot(self, model: str, priority: str = "batch") -> AsyncIterator[None]:
+        queued = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enter(model, priority, wake)
+        if waiter is not None:
+            try:
+                await granted
+            except BaseException:
+                if not self._leave(model, waiter):
+                    self._release(model, None)
+                raise
+        self._waited(model, priority, queued)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(model, time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "max_queue": self.max_queue,
+                "models": {
+                    model: {
+                        "limit": q.limit,
+                        "active": q.active,
+                        "queued": len(q.waiting),
+                        "admitted": q.admitted,
+                        "rejected": q.rejected,
+                        "avg_generation_s": round(q.service, 3),
+                    }
+                    for model, q in self._models.items()
+                },
+            }
@@ -0,0 +1,313 @@
+"""Streaming, bounded-memory full build of the RAG index store.
+
+Provides:
+- stream_build(sources, chunker, tokenizer, store_dir, ...): walk -> chunk ->
+  tokenize -> postings segments on disk -> merge into a new store generation
+- peak_rss_bytes / reset_peak_rss: per-build peak memory reporting
+
+Unlike RagIndex + write_store, nothing proportional to the corpus text is kept
+in memory: each chunk's JSON is appended to the raw doc stream as soon as it is
+produced (and compressed into blocks at the end), and postings are buffered
+only up to ``memory_limit_mb`` before being flushed to a sorted segment.
+Segments are k-way merged term by term into the store layout (see
+app.utils.rag_store); the result scores exactly like write_store's output for
+the same sources. Repeated chunk texts are indexed once (RagIndex dedup
+rules); only their digests and extra occurrences are kept in memory.
+"""
+from __future__ import annotations
+
+import heapq
+import json
+import math
+import os
+import shutil
+import struct
+import sys
+import time
+from array import array
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.rag_filters import write_attributes
+from app.utils.rag_index import Chunker, SourceFile, Tokenizer, chunk_digest, load_sources, occurrence
+from app.utils.rag_store import _map_array, compress_docs, discard_generation, new_generation_dir, publish_generation, store_meta
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# rough per-term cost of a buffered postings list (dict slot, str, two arrays)
+_TERM_OVERHEAD = 240
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process (since the last reset_peak_rss)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the kernel's peak-RSS mark (Linux) so the next reading covers one build."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class _PostingsBuffer:
+    """term -> (doc ids, tfs) for a run of consecutive docs, flushed as a segment."""
+
+    def __init__(self):
+        self.terms: Dict[str, Tuple[array, array]] = {}
+        self.entries = 0
+
+    def add(self, slot: int, freqs: Dict[str, int]) -> None:
+        for term, tf in freqs.items():
+            lists = self.terms.get(term)
+            if lists is None:
+                lists = self.terms[term] = (array("i"), array("f"))
+            lists[0].append(slot)
+            lists[1].append(tf)
+        self.entries += len(freqs)
+
+    def nbytes(self) -> int:
+        return 8 * self.entries + _TERM_OVERHEAD * len(self.terms)
+
+    def flush(self, path: Path) -> None:
+        """Write a segment: terms sorted by utf-8 bytes, then their postings."""
+        path.mkdir(parents=True)
+        encoded = sorted((t.encode("utf-8"), t) for t in self.terms)
+        with open(path / "terms.bin", "wb") as f:
+            f.write(b"".join(e for e, _ in encoded))
+        np.cumsum([0] + [len(e) for e, _ in encoded], dtype="<u8").tofile(path / "terms.u64")
+        counts = [len(self.terms[t][0]) for _, t in encoded]
+        np.cumsum([0] + counts, dtype="<u8").tofile(path / "post.u64")
+        with open(path / "ids.i32", "wb") as f:
+            for _, t in encoded:
+                self.terms[t][0].tofile(f)
+        with open(path / "tfs.f32", "wb") as f:
+            for _, t in encoded:
+                self.terms[t][1].tofile(f)
+        self.terms = {}
+        self.entries = 0
+
+
+class _Segment:
+    def __init__(self, path: Path):
+        self.terms = (path / "terms.bin").read_bytes() if (path / "terms.bin").stat().st_size else b""
+        n_terms = (path / "terms.u64").stat().st_size // 8 - 1
+        self.term_off = _map_array(path / "terms.u64", "<u8", n_terms + 1)
+        self.post_off = _map_array(path / "post.u64", "<u8", n_terms + 1)
+        n_post = int(self.post_off[-1])
+        self.ids = _map_array(path / "ids.i32", "<i4", n_post)
+        self.tfs = _map_array(path / "tfs.f32", "<f4", n_post)
+        self.n_terms = n_terms
+
+    def __iter__(self) -> Iterator[Tuple[bytes, int, "_Segment"]]:
+        for i in range(self.n_terms):
+            yield self.terms[int(self.term_off[i]) : int(self.term_off[i + 1])], i, self
+
+    def postings(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = int(self.post_off[i]), int(self.post_off[i + 1])
+        return self.ids[start:end], self.tfs[start:end]
+
+
+def _attach_duplicates(out: Path, duplicates: Dict[int, List[Dict[str, Any]]]) -> None:
+    """Rewrite docs.raw/docs.u64 adding ``duplicates`` to the docs that have them."""
+    offsets = np.fromfile(out / "docs.u64", dtype="<u8")
+    with open(out / "docs.raw", "rb") as src, open(out / "docs.raw.tmp", "wb") as dst, \
+            open(out / "docs.u64.tmp", "wb") as off_f:
+        end = 0
+        off_f.write(struct.pack("<Q", 0))
+        for slot in range(len(offsets) - 1):
+            blob = src.read(int(offsets[slot + 1] - offsets[slot]))
+            if slot in duplicates:
+                doc = json.loads(blob)
+                doc["duplicates"] = duplicates[slot]
+                blob = json.dumps(doc, ensure_ascii=False).encode("utf-8")
+            end += dst.write(blob)
+            off_f.write(struct.pack("<Q", end))
+    os.replace(out / "docs.raw.tmp", out / "docs.raw")
+    os.replace(out / "docs.u64.tmp", out / "docs.u64")
+
+
+def _merge_segments(seg_dirs: List[Path], out: Path, n_live: int, epsilon: float) -> Tuple[int, int]:
+    """K-way merge of sorted segments into vocab/postings/idf files. Returns (terms, postings)."""
+    segments = [_Segment(p) for p in seg_dirs]
+    vocab_off = array("Q", [0])
+    post_off = array("Q", [0])
+    raw_idf = array("d")
+    idf_sum = 0.0
+    tfs_tmp = out / "postings.tfs.tmp"
+    with open(out / "vocab.bin", "wb") as vocab, open(out / "postings.bin", "wb") as ids_f, open(tfs_tmp, "wb") as tfs_f:
+        # segments hold consecutive doc-id ranges in order, so concatenating a
+        # term's lists in segment order keeps its doc ids sorted
+        merged = heapq.merge(*segments, key=lambda item: item[0])
+        for term, group in groupby(merged, key=lambda item: item[0]):
+            df = 0
+            for _, i, seg in group:
+                ids, tfs = seg.postings(i)
+                np.ascontiguousarray(ids, dtype="<i4").tofile(ids_f)
+                np.ascontiguousarray(tfs, dtype="<f4").tofile(tfs_f)
+                df += len(ids)
+            vocab.write(term)
+            vocab_off.append(vocab_off[-1] + len(term))
+            post_off.append(post_off[-1] + df)
+            idf = math.log(n_live - df + 0.5) - math.log(df + 0.5)
+            raw_idf.append(idf)
+            idf_sum += idf
+    with open(out / "postings.bin", "ab") as ids_f, open(tfs_tmp, "rb") as tfs_f:
+        shutil.copyfileobj(tfs_f, ids_f, 1024 * 1024)
+    tfs_tmp.unlink()
+
+    idf = np.frombuffer(raw_idf, dtype=np.float64).copy()
+    if len(idf):
+        # same floor as RagIndex._refresh_idf / BM25Okapi
+        idf[idf < 0] = epsilon * (idf_sum / len(idf))
+    idf.astype("<f8").tofile(out / "idf.f64")
+    np.frombuffer(vocab_off, dtype=np.uint64).astype("<u8").tofile(out / "vocab.u64")
+    np.frombuffer(post_off, dtype=np.uint64).astype("<u8").tofile(out / "postings.u64")
+    return len(idf), int(post_off[-1])
+
+
+def stream_build(
+    sources: Iterable[SourceFile],
+    chunker: Chunker,
+    tokenizer: Tokenizer,
+    store_dir: Path,
+    memory_limit_mb: float = 256,
+    processes: int = 0,
+    k1: float = 1.5,
+    b: float = 0.75,
+    epsilon: float = 0.25,
+    before_publish: Optional[Callable[[Path], None]] = None,
+) -> Dict[str, Any]:
+    """Full build of ``sources`` into a new generation of ``store_dir``.
+
+    ``memory_limit_mb`` bounds the in-memory postings buffer; when it fills a
+    segment is flushed to disk. The generation is published only if at least
+    one chunk was indexed (``generation`` is None otherwise), after
+    ``before_publish(generation_dir)`` (see write_store). Returns build
+    statistics including the peak RSS observed during the build.
+    """
+    started = time.time()
+    reset_peak_rss()
+    budget = int(memory_limit_mb * 1024 * 1024)
+    out = new_generation_dir(store_dir)
+    seg_root = out / "segments"
+    seg_dirs: List[Path] = []
+    buffer = _PostingsBuffer()
+    files = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    n_docs = total_len = n_chunks = 0
+    doc_end = 0
+    by_digest: Dict[str, int] = {}
+    duplicates: Dict[int, List[Dict[str, Any]]] = {}
+
+    items = []
+    for src in sources:
+        try:
+            st = src.path.stat()
+        except OSError:
+            continue
+        items.append((src, {"rel": src.rel, "kind": src.kind, "size": st.st_size, "mtime": st.st_mtime_ns}, None))
+
+    try:
+        with open(out / "docs.raw", "wb") as docs_f, open(out / "docs.u64", "wb") as off_f, \
+                open(out / "doclen.f32", "wb") as len_f, open(out / "manifest.json", "w", encoding="utf-8") as man_f:
+            off_f.write(struct.pack("<Q", 0))
+            man_f.write('{"files": {')
+            for res in load_sources(items, chunker, tokenizer, processes=processes):
+                if res is None:
+                    continue
+                src, meta, chunks = res
+                slots = []
+                for doc, freqs in chunks:
+                    digest = chunk_digest(doc["text"])
+                    slot = by_digest.get(digest)
+                    if slot is not None:
+                        duplicates.setdefault(slot, []).append(occurrence(doc))
+                        slots.append(slot)
+                        continue
+                    slot = by_digest[digest] = n_docs
+                    doc_end += docs_f.write(json.dumps(doc, ensure_ascii=False).encode("utf-8"))
+                    off_f.write(struct.pack("<Q", doc_end))
+                    length = sum(freqs.values())
+                    len_f.write(struct.pack("<f", length))
+                    buffer.add(slot, freqs)
+                    slots.append(slot)
+                    n_docs += 1
+                    total_len += length
+                n_chunks += len(slots)
+                if files["added"]:
+                    man_f.write(", ")
+                man_f.write(f"{json.dumps(str(src.path))}: {json.dumps(dict(meta, chunks=slots))}")
+                files["added"] += 1
+                if buffer.nbytes() >= budget:
+                    seg_dirs.append(seg_root / f"{len(seg_dirs):05d}")
+                    buffer.flush(seg_dirs[-1])
+            man_f.write("}}")
+        if duplicates:
+            _attach_duplicates(out, duplicates)
+        compress_docs(out)
+        if buffer.entries or not seg_dirs:
+            seg_dirs.append(seg_root / f"{len(seg_dirs):05d}")
+            buffer.flush(seg_dirs[-1])
+
+        n_terms, n_postings = _merge_segments(seg_dirs, out, n_docs, epsilon)
+        manifest = json.loads((out / "manifest.json").read_text(encoding="utf-8"))["files"]
+        write_attributes(out, manifest, n_docs)
+        shutil.rmtree(seg_root, ignore_errors=True)
+        meta = store_meta(
+            n_terms=n_terms,
+            n_postings=n_postings,
+            n_slots=n_docs,
+            n_live=n_docs,
+            n_chunks=n_chunks,
+            total_len=total_len,
+            k1=k1,
+            b=b,
+            epsilon=epsilon,
+        )
+        (out / "meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+    except BaseException:
+        discard_generation(out)
+        raise
+
+    generation = None
+    if n_docs:
+        if before_publish is not None:
+            try:
+                before_publish(out)
+            except BaseException:
+                discard_generation(out)
+                raise
+        publish_generation(store_dir, out.name)
+        generation = out.name
+    else:
+        discard_generation(out)
+    peak = peak_rss_bytes()
+    return {
+        "generation": generation,
+        "indexed_chunks": n_docs,
+        "chunk_occurrences": n_chunks,
+        "files": files,
+        "segments": len(seg_dirs),
+        "memory_limit_mb": memory_limit_mb,
+        "peak_rss_mb": round(peak / 2**20, 1) if peak else None,
+        "seconds": round(time.time() - started, 3),
+    }
@@ -0,0 +1,119 @@
+"""In-process LRU cache for RAG retrieval results.
+
+Provides:
+- RetrievalCache: LRU of _retrieve() results bounded by entry count and bytes,
+  invalidated wholesale by bumping an index generation counter
+
+Keys are (normalized query tokens, k, min_score) plus the generation current at
+insert time, so entries from an older index can never be served; they simply
+age out. Hit/miss/eviction counters are registered with prometheus_client (when
+installed) and show up on the app's existing /metrics endpoint.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+try:
+    from prometheus_client import Counter, Gauge
+except Exception:
+    Counter = Gauge = None
+
+if Counter is not None:
+    _HITS = Counter("rag_retrieval_cache_hits_total", "Retrieval cache hits")
+    _MISSES = Counter("rag_retrieval_cache_misses_total", "Retrieval cache misses")
+    _EVICTIONS = Counter("rag_retrieval_cache_evictions_total", "Retrieval cache evictions (LRU or size bound)")
+    _ENTRIES = Gauge("rag_retrieval_cache_entries", "Entries held in the retrieval cache")
+    _BYTES = Gauge("rag_retrieval_cache_bytes", "Approximate bytes held in the retrieval cache")
+    _GENERATION = Gauge("rag_index_generation", "In-process index generation counter")
+else:
+    _HITS = _MISSES = _EVICTIONS = _ENTRIES = _BYTES = _GENERATION = None
+
+Hits = List[Dict[str, Any]]
+
+
+def _hits_size(hits: Hits) -> int:
+    # chunk text dominates; count str payloads plus a flat per-hit overhead
+    return sum(200 + sum(len(v) for v in h.values() if isinstance(v, str)) for h in hits)
+
+
+def query_key(tokens: Sequence[str], k: int, min_score: Optional[float] = None) -> Tuple[Hashable, ...]:
+    """BM25 ignores token order, so sorted tokens (with repeats) identify a query."""
+    return (tuple(sorted(tokens)), k, min_score)
+
+
+class RetrievalCache:
+    def __init__(self, max_entries: int = 512, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries: "OrderedDict[Tuple[Hashable, ...], Tuple[Hits, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump(self) -> int:
+        """Invalidate every cached result (index rebuilt, reloaded or root changed)."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._publish()
+            return self.generation
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[Hits]:
+        with self._lock:
+            item = self._entries.get((self.generation, key))
+            if item is None:
+                self.misses += 1
+                if _MISSES is not None:
+                    _MISSES.inc()
+                return None
+            self._entries.move_to_end((self.generation, key))
+            self.hits += 1
+            if _HITS is not None:
+                _HITS.inc()
+        # callers merge/annotate hits; hand out copies so the cached ones stay intact
+        return [dict(h) for h in item[0]]
+
+    def put(self, key: Tuple[Hashable, ...], hits: Hits, generation: Optional[int] = None) -> None:
+        """Store ``hits``; ignored if the index changed since ``generation`` was read."""
+        size = _hits_size(hits)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            full_key = (self.generation, key)
+            old = self._entries.pop(full_key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[full_key] = ([dict(h) for h in hits], size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+                if _EVICTIONS is not None:
+                    _EVICTIONS.inc()
+            self._publish()
+
+    def _publish(self) -> None:
+        if _ENTRIES is not None:
+            _ENTRIES.set(len(self._entries))
+            _BYTES.set(self._bytes)
+            _GENERATION.set(self.generation)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "generation": self.generation,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
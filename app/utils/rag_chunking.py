@@ -0,0 +1,138 @@
+"""Chunking used to build the RAG index (tokenization: app.utils.rag_tokenizer).
+
+Provides:
+- chunk_text(text, size, overlap): fixed-size overlapping windows
+- solidity_spans(text): (start, end) chunk offsets from a single-pass,
+  brace-aware scan that cuts at contract/function/modifier/event/... declarations
+- split_solidity(text): the chunk strings for solidity_spans
+- chunk_source(src, text): chunk dicts for one SourceFile
+
+Everything here is a plain module-level function so it can be pickled and run
+in the build process pool (see RagIndex.sync).
+"""
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, List, Tuple
+
+from app.utils.rag_index import SourceFile
+
+
+# declaration keywords followed by a name ("function(uint) external" is a type,
+# "string memory error" a parameter) / by a parameter list
+_NAMED_DECLARATIONS = ("abstract", "contract", "library", "interface", "function", "modifier", "event", "error", "struct", "enum")
+_ANONYMOUS_DECLARATIONS = ("constructor", "fallback", "receive")
+# One alternation, scanned once left to right: comments (a run of // lines is
+# one token) and string literals are consumed whole, so keywords and braces
+# inside them are ignored; declaration keywords must start a line. Every branch
+# starts with / " ' or a newline, so the regex engine skips everything else
+# without trying the branches. Braces are counted in the gaps between tokens.
+_SOL_TOKEN = re.compile(
+    r"//[^\n]*(?:\n[ \t]*//[^\n]*)*|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|/\*.*"
+    r"|\"(?:\\.|[^\"\\\n])*\"?|'(?:\\.|[^'\\\n])*'?"
+    r"|\n[ \t]*(?:" + "|".join(_NAMED_DECLARATIONS) + r")(?=\s+[A-Za-z_$])"
+    r"|\n[ \t]*(?:" + "|".join(_ANONYMOUS_DECLARATIONS) + r")(?=\s*\()",
+    re.S,
+)
+_BLANK = re.compile(r"\s*")
+_SPACE = re.compile(r"\s+")
+# declarations shorter than this (events, errors, one-line setters) are merged
+# into the following chunk instead of becoming chunks of their own
+MIN_CHUNK_CHARS = 200
+
+
+def chunk_text(text: str, size: int = 1500, overlap: int = 150) -> List[str]:
+    out: List[str] = []
+    step = max(1, size - overlap)
+    text_len = len(text)
+    for i in range(0, text_len, step):
+        out.append(text[i : i + size])
+        if i + size >= text_len:
+            break
+    return out
+
+
+def _trim(text: str, start: int, end: int) -> Tuple[int, int]:
+    m = _SPACE.match(text, start, end)
+    if m:
+        start = m.end()
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def solidity_spans(text: str, size: int = 1500, overlap: int = 150) -> List[Tuple[int, int]]:
+    """Chunk boundaries for a Solidity source as (start, end) character offsets.
+
+    A new chunk starts at each top-level or contract-member declaration (brace
+    depth <= 1, first on its line), including the doc comment right above it;
+    keywords inside function bodies, comments and strings are ignored.
+    Runs shorter than MIN_CHUNK_CHARS are merged forward, and chunks longer
+    than ``size`` are cut into overlapping windows like chunk_text.
+    """
+    cuts = [0]
+    depth = 0
+    gap = 0
+    doc_start = doc_end = -1
+    for m in _SOL_TOKEN.finditer(text):
+        start = m.start()
+        depth += text.count("{", gap, start) - text.count("}", gap, start)
+        if depth < 0:
+            depth = 0
+        gap = m.end()
+        tok = m.group()
+        c = tok[0]
+        if c == "/":
+            line_start = text.rfind("\n", 0, start) + 1
+            if not _BLANK.fullmatch(text, line_start, start):
+                # trailing comment on a code line belongs to that line, and
+                # ends any doc block above it
+                doc_start = doc_end = -1
+                continue
+            # consecutive comments separated only by whitespace form one block
+            if doc_end < 0 or not _BLANK.fullmatch(text, doc_end, start):
+                doc_start = start
+            doc_end = gap
+            continue
+        if c == '"' or c == "'" or depth > 1:
+            # string literal, or a keyword inside a function body
+            continue
+
+        start = gap - len(tok.lstrip())
+        if doc_end >= 0 and _BLANK.fullmatch(text, doc_end, start):
+            start = doc_start
+        if start > cuts[-1]:
+            cuts.append(start)
+    cuts.append(len(text))
+
+    spans: List[Tuple[int, int]] = []
+    pending = -1
+    for a, b in zip(cuts, cuts[1:]):
+        start = a if pending < 0 else pending
+        s, e = _trim(text, start, b)
+        if e <= s:
+            continue
+        if e - s < MIN_CHUNK_CHARS and b < len(text):
+            pending = start
+            continue
+        pending = -1
+        step = max(1, size - overlap)
+        while True:
+            spans.append((s, min(e, s + size)))
+            if s + size >= e:
+                break
+            s += step
+    return spans
+
+
+def split_solidity(text: str) -> List[str]:
+    return [text[s:e] for s, e in solidity_spans(text)]
+
+
+def chunk_source(src: SourceFile, text: str) -> List[Dict[str, Any]]:
+    if src.kind == 'script':
+        return [{'id': src.rel, 'text': text[:8000], 'source': src.rel}]
+    return [
+        {'id': f'{src.rel}#{i}', 'text': text[s:e], 'source': src.rel, 'start': s, 'end': e}
+        for i, (s, e) in enumerate(solidity_spans(text))
+    ]
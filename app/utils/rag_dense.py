@@ -0,0 +1,345 @@
+"""Optional dense (embedding) retrieval fused with BM25.
+
+Provides:
+- OllamaEmbedder: chunk/query embeddings from an Ollama client (the app's
+  pooled gateway client, or one of its own)
+- HashEmbedder: deterministic feature-hashing stand-in (tests, offline use)
+- make_embedder(kind, model, host, client): embedder for PRX_RAG_DENSE, or None
+- EmbeddingCache: persistent sha256(chunk text) -> vector map per model, so a
+  rebuild only embeds chunks it has not seen before
+- DenseIndex / build_dense(index, embedder, cache): L2-normalized float32 matrix
+  aligned with the index's doc slots, searched by brute-force dot product
+- write_dense(gen_dir, dense) / load_dense(gen_dir, model): the matrix stored
+  with an index generation, memory-mapped back by readers
+- hybrid_top_k(...): BM25 and cosine scores fused per candidate
+
+At the corpus sizes served here (thousands of chunks) a brute-force matrix
+product takes well under a millisecond, so no ANN structure is used.
+
+Cache layout under ``<dir>/<model slug>/``: meta.json (model, dim),
+digests.bin (32-byte raw sha256 per row) and vectors.f32 (dim float32 per
+row). Both data files are append-only; a reader truncates to the rows present
+in both, so a crashed append loses only its own rows.
+
+The matrix of a generation is built once, by whoever writes the generation,
+and stored in it as ``dense-<model slug>.f32`` (rows x dim float32) plus
+``dense-<model slug>.json`` (model, rows, dim). Workers that pick up the
+generation map that file instead of decoding and hashing every chunk again.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.rag_index import Bm25Scorer, chunk_digest, select_top_k
+from app.utils.rag_tokenizer import tokenize
+
+try:
+    from ollama import Client
+except Exception:  # pragma: no cover - ollama is optional for the local stand-in
+    Client = None
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return vecs / np.where(norms > 0, norms, 1)
+
+
+def _slug(model: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model)
+
+
+class OllamaEmbedder:
+    """``client`` returns the ollama.Client to use (e.g. the app gateway's pooled
+    one, looked up per call so a restarted gateway is followed); without it the
+    embedder opens its own client on ``host``."""
+
+    def __init__(
+        self,
+        model: str,
+        host: Optional[str] = None,
+        batch_size: int = 32,
+        client: Optional[Callable[[], Any]] = None,
+    ):
+        if Client is None and client is None:
+            raise RuntimeError("ollama is not installed")
+        self.name = f"ollama:{model}"
+        self.model = model
+        self.batch_size = batch_size
+        if client is None:
+            own = Client(host=host) if host else Client()
+            client = lambda: own  # noqa: E731
+        self._client = client
+
+    @property
+    def client(self) -> Any:
+        return self._client()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        client = self.client
+        out: List[List[float]] = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i : i + self.batch_size]
+            if hasattr(client, "embed"):
+                out.extend(client.embed(model=self.model, input=batch)["embeddings"])
+            else:
+                # older clients: one prompt per request
+                out.extend(client.embeddings(model=self.model, prompt=t)["embedding"] for t in batch)
+        return _normalize(np.array(out, dtype=np.float32).reshape(len(texts), -1))
+
+
+@lru_cache(maxsize=1 << 16)
+def _feature(token: str, dim: int) -> Tuple[int, float]:
+    h = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+    return h % dim, (1.0 if (h >> 63) else -1.0)
+
+
+class HashEmbedder:
+    """Signed feature hashing of rag_tokenizer tokens (sublinear tf), L2-normalized.
+
+    Purely lexical, so it does not understand paraphrases; it exists so the
+    dense path can be exercised without an embedding model.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.name = f"hash:{dim}"
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: Dict[str, int] = {}
+            for tok in tokenize(text):
+                counts[tok] = counts.get(tok, 0) + 1
+            for tok, tf in counts.items():
+                col, sign = _feature(tok, self.dim)
+                out[row, col] += sign * (1.0 + np.log(tf))
+        return _normalize(out)
+
+
+def make_embedder(kind: str, model: str, host: Optional[str] = None, client: Optional[Callable[[], Any]] = None) -> Optional[Any]:
+    kind = (kind or "").lower()
+    if kind in ("", "0", "off", "false", "no"):
+        return None
+    if kind == "hash":
+        return HashEmbedder()
+    if kind in ("1", "ollama", "true", "yes"):
+        return OllamaEmbedder(model, host, client=client)
+    raise ValueError(f"unknown PRX_RAG_DENSE backend: {kind}")
+
+
+class EmbeddingCache:
+    def __init__(self, root: Path, model: str):
+        self.dir = Path(root) / _slug(model)
+        self.model = model
+        self.dim: Optional[int] = None
+        self._rows: Dict[str, np.ndarray] = {}
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _reload(self) -> None:
+        """Pick up rows appended since the last read (possibly by another process)."""
+        meta_path = self.dir / "meta.json"
+        if not meta_path.exists():
+            return
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        if meta.get("model") != self.model:
+            return
+        self.dim = int(meta["dim"])
+        try:
+            n = min((self.dir / "digests.bin").stat().st_size // 32, (self.dir / "vectors.f32").stat().st_size // (4 * self.dim))
+        except OSError:
+            return
+        if n <= self._loaded:
+            return
+        with open(self.dir / "digests.bin", "rb") as f:
+            f.seek(32 * self._loaded)
+            raw = f.read(32 * (n - self._loaded))
+        vecs = np.fromfile(self.dir / "vectors.f32", dtype="<f4", count=(n - self._loaded) * self.dim, offset=4 * self.dim * self._loaded)
+        vecs = vecs.reshape(-1, self.dim)
+        for i in range(n - self._loaded):
+            self._rows[raw[32 * i : 32 * (i + 1)].hex()] = vecs[i]
+        self._loaded = n
+
+    def get_many(self, digests: Iterable[str]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            self._reload()
+            return {d: self._rows[d] for d in digests if d in self._rows}
+
+    def put_many(self, digests: List[str], vecs: np.ndarray) -> None:
+        if not digests:
+            return
+        vecs = np.ascontiguousarray(vecs, dtype="<f4")
+        with self._lock:
+            self._reload()
+            if self.dim is None:
+                self.dim = int(vecs.shape[1])
+                self.dir.mkdir(parents=True, exist_ok=True)
+                (self.dir / "meta.json").write_text(json.dumps({"model": self.model, "dim": self.dim}), encoding="utf-8")
+            elif vecs.shape[1] != self.dim:
+                raise ValueError(f"embedding dim changed from {self.dim} to {vecs.shape[1]} for {self.model}")
+            # drop the tail of an append that crashed halfway, then write
+            # vectors first: a row only counts once its digest is written too
+            for name, row_size in (("vectors.f32", 4 * self.dim), ("digests.bin", 32)):
+                path = self.dir / name
+                if path.exists() and path.stat().st_size > self._loaded * row_size:
+                    with open(path, "r+b") as f:
+                        f.truncate(self._loaded * row_size)
+            with open(self.dir / "vectors.f32", "ab") as f:
+                f.write(vecs.tobytes())
+            with open(self.dir / "digests.bin", "ab") as f:
+                f.write(b"".join(bytes.fromhex(d) for d in digests))
+            for d, v in zip(digests, vecs):
+                self._rows[d] = v
+            self._loaded += len(digests)
+
+
+class DenseIndex:
+    """Row i is the normalized embedding of doc slot i (zeros for free slots)."""
+
+    def __init__(self, matrix: np.ndarray, model: str):
+        self.matrix = matrix
+        self.model = model
+
+    @property
+    def dim(self) -> int:
+        return int(self.matrix.shape[1])
+
+    def similarity(self, qvec: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        return self.matrix[ids] @ qvec
+
+    def search(self, qvec: np.ndarray, n: int, within: Optional[np.ndarray] = None) -> Tuple[List[int], List[float]]:
+        """Best ``n`` slots by cosine similarity (positive similarities only), optionally only ``within``."""
+        sims = self.matrix @ qvec
+        ids = np.flatnonzero((sims > 0) & within if within is not None else sims > 0)
+        return select_top_k(ids, sims[ids], n)
+
+
+def build_dense(index: Bm25Scorer, embedder: Any, cache: EmbeddingCache, batch_size: int = 64) -> Tuple[DenseIndex, Dict[str, Any]]:
+    """Embedding matrix for every live doc of ``index``; only uncached texts are embedded."""
+    started = time.time()
+    docs = index.docs
+    slots: List[int] = []
+    digests: List[str] = []
+    texts: Dict[str, str] = {}
+    for slot in range(len(docs)):
+        doc = docs[slot]
+        if doc is None:
+            continue
+        d = chunk_digest(doc["text"])
+        slots.append(slot)
+        digests.append(d)
+        texts.setdefault(d, doc["text"])
+    have = cache.get_many(texts)
+    missing = [d for d in texts if d not in have]
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i : i + batch_size]
+        vecs = embedder.embed([texts[d] for d in batch])
+        cache.put_many(batch, vecs)
+        have.update(zip(batch, vecs))
+    dim = cache.dim or (len(next(iter(have.values()))) if have else 0)
+    matrix = np.zeros((len(docs), dim), dtype=np.float32)
+    for slot, d in zip(slots, digests):
+        matrix[slot] = have[d]
+    stats = {
+        "model": embedder.name,
+        "dim": dim,
+        "embedded": len(missing),
+        "cached": len(texts) - len(missing),
+        "seconds": round(time.time() - started, 3),
+    }
+    return DenseIndex(matrix, embedder.name), stats
+
+
+def _dense_files(gen_dir: Path, model: str) -> Tuple[Path, Path]:
+    """(matrix, meta) paths of ``model`` in ``gen_dir``."""
+    # appended, not with_suffix(): slugs keep dots ("...:v1.5")
+    name = f"dense-{_slug(model)}"
+    return gen_dir / f"{name}.f32", gen_dir / f"{name}.json"
+
+
+def write_dense(gen_dir: Path, dense: DenseIndex) -> None:
+    """Store ``dense`` with the generation in ``gen_dir`` (replacing an older matrix of the model)."""
+    matrix_path, meta_path = _dense_files(gen_dir, dense.model)
+    matrix = np.ascontiguousarray(dense.matrix, dtype="<f4")
+    tmp = gen_dir / f"{matrix_path.stem}.{os.getpid()}.tmp"
+    matrix.tofile(tmp)
+    os.replace(tmp, matrix_path)
+    # the meta file last: a matrix counts once its meta is there
+    tmp.write_text(json.dumps({"model": dense.model, "rows": matrix.shape[0], "dim": matrix.shape[1]}), encoding="utf-8")
+    os.replace(tmp, meta_path)
+
+
+def load_dense(gen_dir: Path, model: str) -> Optional[DenseIndex]:
+    """The stored matrix of ``model`` for the generation in ``gen_dir`` (memory-mapped), or None."""
+    matrix_path, meta_path = _dense_files(gen_dir, model)
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        if meta.get("model") != model:
+            return None
+        rows, dim = int(meta["rows"]), int(meta["dim"])
+        if not rows or not dim:
+            return DenseIndex(np.zeros((rows, dim), dtype=np.float32), model)
+        matrix = np.memmap(matrix_path, dtype="<f4", mode="r", shape=(rows, dim))
+    except (OSError, ValueError, KeyError):
+        return None
+    return DenseIndex(matrix, model)
+
+
+def hybrid_top_k(
+    index: Bm25Scorer,
+    dense: DenseIndex,
+    query: List[str],
+    qvec: np.ndarray,
+    k: int,
+    weight: float = 0.5,
+    min_score: Optional[float] = None,
+    pool: int = 50,
+    lexical: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    within: Optional[np.ndarray] = None,
+) -> Tuple[List[int], List[float], List[float], List[float]]:
+    """Top ``k`` slots by ``weight * bm25 / max_bm25 + (1 - weight) * max(cosine, 0)``.
+
+    Candidates are the best ``max(pool, 4k)`` slots of each retriever; both
+    scores are then computed exactly for every candidate. ``min_score`` keeps
+    its BM25 meaning: slots below it are not eligible, even if found densely.
+    ``lexical`` is ``index.score(query, within)`` when the caller already has it
+    (batches); ``within`` limits both retrievers to those slots.
+    Returns (ids, fused scores, bm25 scores, cosine similarities).
+    """
+    ids, scores = lexical if lexical is not None else index.score(query, within)
+    n = max(pool, 4 * k)
+    bm25 = dict(zip(ids.tolist(), scores.tolist()))
+    lex_ids, _ = select_top_k(ids, scores, n)
+    dense_ids, _ = dense.search(qvec, n, within)
+    cands = list(dict.fromkeys(lex_ids + dense_ids))
+    if min_score is not None:
+        cands = [c for c in cands if bm25.get(c, 0.0) >= min_score]
+    if not cands:
+        return [], [], [], []
+    cand = np.array(cands, dtype=np.int64)
+    lex = np.array([bm25.get(c, 0.0) for c in cands])
+    sims = dense.similarity(qvec, cand).astype(np.float64)
+    top = lex.max()
+    fused = weight * (lex / top if top > 0 else lex) + (1 - weight) * np.maximum(sims, 0)
+    top_ids, top_scores = select_top_k(cand, fused, k)
+    pos = {c: i for i, c in enumerate(cands)}
+    return (
+        top_ids,
+        top_scores,
+        [float(lex[pos[i]]) for i in top_ids],
+        [float(sims[pos[i]]) for i in top_ids],
+    )
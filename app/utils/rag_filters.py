@@ -0,0 +1,221 @@
+"""Per-document attributes for filtered RAG retrieval.
+
+Provides:
+- payrox_bucket(path): coarse PayRox bucket of a source path
+- DocFilter: a query's bucket / path prefix / file extension restriction
+- DocAttributes: per-slot bitsets (one per bucket and per extension) plus the
+  sorted file list with each file's slots; mask(filter) is the bool array of
+  slots a filtered query may return
+- write_attributes(out, manifest, n_slots): persist them into a store generation
+
+Filters are applied while scoring (Bm25Scorer ``within``): postings of docs
+outside the mask are dropped before any BM25 arithmetic, so a filtered query
+does less work than an unfiltered one and never over-fetches. Scores of the
+docs that remain are unchanged (idf stays corpus-wide).
+
+A chunk shared by several files (see app.utils.rag_index dedup) matches when
+any of its files does; DocFilter.locate() then reports it at the first of
+those files, not at its first occurrence, so a hit never names a file outside
+the filter. Paths are the ``rel`` of the manifest, i.e. the ``source`` shown
+in hits.
+
+Files in a store generation:
+
+  attrs.json   bucket and extension names (bitset row order) and the file
+               paths, sorted
+  attrs.bits   one packed bitset row of ceil(N/8) bytes per bucket, then one
+               per extension
+  files.u64    [F+1] offsets into files.i4
+  files.i4     the slots of each file, in attrs.json file order
+"""
+from __future__ import annotations
+
+import json
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+BUCKETS = ("core", "administrative", "liquidity", "rewards", "misc")
+
+
+def payrox_bucket(path: str) -> str:
+    """Lightweight heuristic: map a file path to one of BUCKETS."""
+    p = path.lower()
+    if "liquid" in p or "liquidity" in p:
+        return "liquidity"
+    if "reward" in p or "distrib" in p:
+        return "rewards"
+    if "admin" in p or "govern" in p:
+        return "administrative"
+    if "core" in p or "impl" in p:
+        return "core"
+    return "misc"
+
+
+def _ext(path: str) -> str:
+    return PurePosixPath(path.replace("\\", "/")).suffix.lower()
+
+
+@dataclass(frozen=True)
+class DocFilter:
+    """Restricts a query to files in ``bucket``, under ``path_prefix`` and with ``ext``.
+
+    Unset fields do not restrict; build instances with of() to get normalized
+    values. An all-unset filter is falsy.
+    """
+
+    bucket: Optional[str] = None
+    path_prefix: Optional[str] = None
+    ext: Optional[str] = None
+
+    @classmethod
+    def of(cls, bucket: Optional[str] = None, path_prefix: Optional[str] = None, ext: Optional[str] = None) -> "DocFilter":
+        if bucket:
+            bucket = bucket.strip().lower()
+            if bucket not in BUCKETS:
+                raise ValueError(f"unknown bucket {bucket!r}; expected one of {', '.join(BUCKETS)}")
+        if path_prefix:
+            path_prefix = path_prefix.replace("\\", "/")
+            while path_prefix.startswith("./"):
+                path_prefix = path_prefix[2:]
+            path_prefix = path_prefix.lstrip("/")
+        if ext:
+            ext = "." + ext.strip().lower().lstrip(".")
+        return cls(bucket or None, path_prefix or None, ext or None)
+
+    def __bool__(self) -> bool:
+        return bool(self.bucket or self.path_prefix or self.ext)
+
+    def key(self) -> Tuple[Hashable, ...]:
+        return (self.bucket, self.path_prefix, self.ext)
+
+    def matches(self, path: str) -> bool:
+        """Whether the file ``path`` passes the filter (the per-path rule behind mask())."""
+        path = path.replace("\\", "/")
+        return (
+            (not self.bucket or payrox_bucket(path) == self.bucket)
+            and (not self.path_prefix or path.startswith(self.path_prefix))
+            and (not self.ext or _ext(path) == self.ext)
+        )
+
+    def locate(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """``doc`` with id/source/start/end of its first occurrence that passes the filter.
+
+        A deduplicated chunk passes when any of its files does; its first
+        occurrence may lie outside the filter, a later one (``duplicates``) is
+        reported instead. Returned unchanged when the first occurrence passes.
+        """
+        if not self or self.matches(doc["source"]):
+            return doc
+        for dup in doc.get("duplicates", ()):
+            if self.matches(dup["source"]):
+                return doc | dup
+        return doc
+
+
+class DocAttributes:
+    def __init__(
+        self,
+        n_slots: int,
+        buckets: Dict[str, np.ndarray],
+        exts: Dict[str, np.ndarray],
+        files: List[str],
+        file_off: np.ndarray,
+        file_slots: np.ndarray,
+    ):
+        self.n_slots = n_slots
+        self.buckets = buckets
+        self.exts = exts
+        self.files = files
+        self._file_off = file_off
+        self._file_slots = file_slots
+        self._masks: Dict[Tuple[Hashable, ...], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_manifest(cls, manifest: Dict[str, Dict[str, Any]], n_slots: int) -> "DocAttributes":
+        by_file: Dict[str, List[int]] = {}
+        for entry in manifest.values():
+            by_file.setdefault(entry["rel"].replace("\\", "/"), []).extend(entry["chunks"])
+        files = sorted(by_file)
+        slots = [np.unique(np.asarray(by_file[f], dtype=np.int32)) for f in files]
+        buckets: Dict[str, np.ndarray] = {}
+        exts: Dict[str, np.ndarray] = {}
+        for f, s in zip(files, slots):
+            for table, name in ((buckets, payrox_bucket(f)), (exts, _ext(f))):
+                mask = table.get(name)
+                if mask is None:
+                    mask = table[name] = np.zeros(n_slots, dtype=bool)
+                mask[s] = True
+        file_off = np.concatenate(([0], np.cumsum([len(s) for s in slots]))).astype(np.int64)
+        file_slots = np.concatenate(slots) if slots else np.empty(0, dtype=np.int32)
+        return cls(n_slots, buckets, exts, files, file_off, file_slots)
+
+    # ------------------------------------------------------------------
+    def save(self, out: Path) -> None:
+        names = {"buckets": sorted(self.buckets), "exts": sorted(self.exts), "files": self.files}
+        (out / "attrs.json").write_text(json.dumps(names), encoding="utf-8")
+        rows = [self.buckets[b] for b in names["buckets"]] + [self.exts[e] for e in names["exts"]]
+        with open(out / "attrs.bits", "wb") as f:
+            for row in rows:
+                f.write(np.packbits(row).tobytes())
+        np.ascontiguousarray(self._file_off, dtype="<u8").tofile(out / "files.u64")
+        np.ascontiguousarray(self._file_slots, dtype="<i4").tofile(out / "files.i4")
+
+    @classmethod
+    def load(cls, path: Path, n_slots: int) -> "DocAttributes":
+        names = json.loads((path / "attrs.json").read_text(encoding="utf-8"))
+        bits = np.fromfile(path / "attrs.bits", dtype=np.uint8)
+        width = (n_slots + 7) // 8
+        rows = [np.unpackbits(bits[i * width : (i + 1) * width], count=n_slots).astype(bool) for i in range(len(names["buckets"]) + len(names["exts"]))]
+        n_b = len(names["buckets"])
+        file_off = np.fromfile(path / "files.u64", dtype="<u8").astype(np.int64)
+        file_slots = np.fromfile(path / "files.i4", dtype="<i4")
+        return cls(
+            n_slots,
+            dict(zip(names["buckets"], rows[:n_b])),
+            dict(zip(names["exts"], rows[n_b:])),
+            names["files"],
+            file_off,
+            file_slots,
+        )
+
+    # ------------------------------------------------------------------
+    def _prefix_mask(self, prefix: str) -> np.ndarray:
+        # paths sharing a prefix are contiguous in sorted order, and so are their slots
+        lo = bisect_left(self.files, prefix)
+        hi = bisect_left(self.files, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        mask = np.zeros(self.n_slots, dtype=bool)
+        mask[self._file_slots[self._file_off[lo] : self._file_off[hi]]] = True
+        return mask
+
+    def mask(self, flt: Optional[DocFilter]) -> Optional[np.ndarray]:
+        """Bool array over slots allowed by ``flt``; None when it does not restrict."""
+        if not flt:
+            return None
+        key = flt.key()
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask
+        mask = np.ones(self.n_slots, dtype=bool)
+        none = np.zeros(self.n_slots, dtype=bool)
+        if flt.bucket:
+            mask &= self.buckets.get(flt.bucket, none)
+        if flt.ext:
+            mask &= self.exts.get(flt.ext, none)
+        if flt.path_prefix:
+            mask &= self._prefix_mask(flt.path_prefix)
+        mask.setflags(write=False)
+        with self._lock:
+            if len(self._masks) >= 256:
+                self._masks.clear()
+            self._masks[key] = mask
+        return mask
+
+
+def write_attributes(out: Path, manifest: Dict[str, Dict[str, Any]], n_slots: int) -> None:
+    DocAttributes.from_manifest(manifest, n_slots).save(out)
@@ -0,0 +1,727 @@
+"""Incrementally updatable BM25 index for the contracts RAG endpoints.
+
+Provides:
+- SourceFile: a file to index (absolute path, path relative to its root, kind)
+- Bm25Scorer: query-side BM25 (scoring, top-k, batched multi-query scoring)
+  over packed postings; shared by RagIndex and the memory-mapped store reader
+  (app.utils.rag_store.MappedIndex)
+- RagIndex: BM25 (Okapi) index with in-place add/remove of whole files and a
+  per-file manifest (size, mtime, sha256 -> chunk ids)
+- load_sources: read/chunk/tokenize changed files on threads or worker processes
+
+Terms are interned to dense int ids (app.utils.rag_tokenizer.Vocabulary).
+Postings are kept as term id -> {doc id: tf} for cheap updates and packed on
+first use into int32 doc-id / float32 tf arrays. A query resolves each of its
+terms to an id once and only touches the packed postings of those ids, so its
+cost follows term frequency, not corpus size. Long queries are cut further by
+MaxScore pruning (Bm25Scorer.score_pruned): the long postings of common terms
+are only probed for docs that can still reach the top k.
+
+Scores match rank_bm25.BM25Okapi (same idf floor and length normalisation), so
+swapping the index in does not change retrieval results. Chunk ids are slots in
+``docs``; slots freed by deleted files are reused by later additions.
+
+Chunks are content-addressed: a text that occurs in several places (vendored
+libraries, copied facets) is indexed once. The doc keeps its first occurrence
+in id/source/start/end and lists the others under ``duplicates``; the slot is
+freed only when its last occurrence goes away.
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.rag_tokenizer import Vocabulary
+
+Chunker = Callable[["SourceFile", str], List[Dict[str, Any]]]
+Tokenizer = Callable[[str], List[str]]
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    path: Path
+    rel: str
+    kind: str = "sol"
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+OCCURRENCE_KEYS = ("id", "source", "start", "end")
+
+
+def occurrence(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Where a chunk occurs: its id/source/start/end fields."""
+    return {k: doc[k] for k in OCCURRENCE_KEYS if k in doc}
+
+
+def doc_sources(doc: Dict[str, Any]) -> List[str]:
+    """Every source file containing this chunk, first occurrence first."""
+    return list(dict.fromkeys([doc["source"]] + [d["source"] for d in doc.get("duplicates", ())]))
+
+
+# Below this many changed files a build stays on threads: starting worker
+# processes costs more than the chunking they would take off the main process.
+PROCESS_POOL_MIN_FILES = 256
+
+LoadItem = Tuple[SourceFile, Dict[str, Any], Optional[str]]
+# a chunk ready to index: (chunk dict, {term: tf}); terms are interned by the
+# index, so worker processes never need the vocabulary
+Chunk = Tuple[Dict[str, Any], Dict[str, int]]
+Loaded = Optional[Tuple[SourceFile, Dict[str, Any], Optional[List[Chunk]]]]
+
+
+def load_source(item: LoadItem, chunker: Chunker, tokenizer: Tokenizer) -> Loaded:
+    """Read, hash, chunk and tokenize one file.
+
+    ``item`` is (source, stat meta, previous sha256). Returns None if the file
+    vanished, (src, meta, None) if its content is unchanged, otherwise
+    (src, meta, [(chunk dict, term frequencies), ...]). Counting terms here
+    keeps it in the workers and shrinks what is sent back to the builder.
+    """
+    src, meta, prev_sha = item
+    try:
+        data = src.path.read_bytes()
+    except OSError:
+        return None
+    meta = dict(meta, sha256=file_digest(data))
+    if prev_sha == meta["sha256"]:
+        return src, meta, None
+    text = data.decode("utf-8", errors="ignore")
+    return src, meta, [(doc, dict(Counter(tokenizer(doc["text"])))) for doc in chunker(src, text)]
+
+
+def _load_batch(batch: List[LoadItem], chunker: Chunker, tokenizer: Tokenizer) -> List[Loaded]:
+    return [load_source(item, chunker, tokenizer) for item in batch]
+
+
+def _pool_context():
+    # forking a server that already runs threads can deadlock the child
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _map_window(ex: Executor, fn: Callable[..., Any], items: Iterable[Any], window: int, *args: Any) -> Iterator[Any]:
+    """``fn(item, *args)`` for each item on ``ex``, in order, with at most ``window`` calls ahead of the consumer.
+
+    Executor.map submits everything at once, and results the consumer has not
+    reached yet pile up in finished futures; here a result is only produced
+    ahead of the consumer for the next ``window`` items.
+    """
+    pending: deque = deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(ex.submit(fn, item, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+def load_sources(
+    items: List[LoadItem],
+    chunker: Chunker,
+    tokenizer: Tokenizer,
+    max_workers: int = 8,
+    processes: int = 0,
+    batch_size: int = 64,
+) -> Iterator[Loaded]:
+    """load_source() over ``items``, in order.
+
+    With ``processes`` > 1 and enough files, batches of files are fanned out to
+    a ProcessPoolExecutor so chunking and tokenizing (pure Python, GIL-bound)
+    use every core; ``chunker`` and ``tokenizer`` must then be picklable
+    module-level functions. Otherwise files are loaded on a thread pool, which
+    only overlaps the I/O. Either way at most two batches (files) per worker
+    are in flight or waiting for the consumer, so a slow consumer (the
+    streaming builder writing postings) bounds how much loaded text is held.
+    """
+    if processes > 1 and len(items) >= PROCESS_POOL_MIN_FILES:
+        batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+        with ProcessPoolExecutor(max_workers=processes, mp_context=_pool_context()) as ex:
+            for results in _map_window(ex, _load_batch, batches, 2 * processes, chunker, tokenizer):
+                yield from results
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        yield from _map_window(ex, load_source, items, 2 * max_workers, chunker, tokenizer)
+
+
+def select_top_k(ids: np.ndarray, scores: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+    """Partial top-k of a sparse score vector: highest score first, lower id wins ties.
+
+    Uses an O(n) partition to find the k-th best score and only sorts the
+    candidates at or above it, instead of sorting all n scores.
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return [], []
+    if n > k:
+        kth = np.partition(scores, n - k)[n - k]
+        sel = np.flatnonzero(scores >= kth)
+        ids, scores = ids[sel], scores[sel]
+    order = np.lexsort((ids, -scores))[:k]
+    return ids[order].tolist(), scores[order].tolist()
+
+
+class Bm25Scorer(ABC):
+    """BM25 (Okapi) query evaluation over per-term (int32 ids, float32 tfs) postings.
+
+    Subclasses provide the corpus: term ids, term weights (idf) and packed
+    postings by term id, the doc length array and which slots hold live docs.
+    The hooks are abstract, so a subclass that misses one cannot be constructed.
+    """
+
+    k1: float
+    b: float
+    # below this many postings across a query's terms, exhaustive scoring is cheaper than pruning
+    prune_min_postings = 4096
+
+    @property
+    @abstractmethod
+    def avgdl(self) -> float:
+        ...
+
+    @property
+    @abstractmethod
+    def n_slots(self) -> int:
+        ...
+
+    @abstractmethod
+    def term_ids(self, terms: List[str]) -> List[int]:
+        """Id of each term, -1 for terms not in the vocabulary."""
+
+    @abstractmethod
+    def _term_weight(self, tid: int) -> float:
+        ...
+
+    @abstractmethod
+    def _term_postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        ...
+
+    @abstractmethod
+    def _doc_len_array(self) -> np.ndarray:
+        ...
+
+    @abstractmethod
+    def _live_slots(self) -> Iterator[int]:
+        ...
+
+    @abstractmethod
+    def _term_bound(self, tid: int) -> float:
+        """Largest per-doc BM25 factor of ``tid`` (idf not applied); see top_k()."""
+
+    def _factors(self, ids: np.ndarray, tfs: np.ndarray, avgdl: float) -> np.ndarray:
+        """Per-doc BM25 factor ``tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))``."""
+        k1, b = self.k1, self.b
+        tf = tfs.astype(np.float64)
+        return tf * (k1 + 1) / (tf + k1 * (1 - b + b * self._doc_len_array()[ids] / avgdl))
+
+    def _postings_within(self, tid: int, within: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Postings of ``tid`` restricted to the slots set in the bool mask ``within``."""
+        ids, tfs = self._term_postings(tid)
+        if within is None:
+            return ids, tfs
+        keep = within[ids]
+        return ids[keep], tfs[keep]
+
+    def _query_weights(self, query: List[str]) -> Dict[int, float]:
+        """Summed idf per distinct query term id, in first-seen order."""
+        weights: Dict[int, float] = {}
+        for tid in self.term_ids(query):
+            idf = self._term_weight(tid) if tid >= 0 else 0.0
+            if idf:
+                weights[tid] = weights.get(tid, 0.0) + idf
+        return weights
+
+    def score(self, query: List[str], within: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Sparse BM25 scores: (doc ids ascending, scores) for docs matching any query term.
+
+        Repeated query terms count once per occurrence, as in BM25Okapi.
+        ``within`` (bool array over slots) limits scoring to those docs; the
+        scores of the docs it keeps do not change.
+        """
+        avgdl = self.avgdl
+        weights = self._query_weights(query)
+        if not weights or not avgdl:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+
+        all_ids: List[np.ndarray] = []
+        all_contrib: List[np.ndarray] = []
+        for tid, w in weights.items():
+            ids, tfs = self._postings_within(tid, within)
+            all_ids.append(ids)
+            all_contrib.append(w * self._factors(ids, tfs, avgdl))
+        if len(all_ids) == 1:
+            return all_ids[0], all_contrib[0]
+        ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        return ids, np.bincount(inverse, weights=np.concatenate(all_contrib))
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        """Dense BM25 score for every slot (BM25Okapi-compatible); freed slots score 0."""
+        dense = np.zeros(self.n_slots)
+        ids, scores = self.score(query)
+        dense[ids] = scores
+        return dense
+
+    def top_k(
+        self,
+        query: List[str],
+        k: int,
+        min_score: Optional[float] = None,
+        prune: bool = True,
+        within: Optional[np.ndarray] = None,
+    ) -> Tuple[List[int], List[float]]:
+        """Best ``k`` live doc ids with their scores, ties broken by lower doc id.
+
+        Like sorting BM25Okapi.get_scores, zero-score docs fill the tail when
+        fewer than ``k`` docs match. With ``min_score`` set, docs scoring below
+        it are dropped instead (a positive cutoff disables the zero-score fill).
+        Multi-term queries are evaluated with MaxScore pruning (see
+        score_pruned); ``prune=False`` scores every matching doc. Both give
+        identical results. ``within`` restricts the result to those slots
+        (see score()), zero-score fill included.
+        """
+        scored = self.score_pruned(query, k, min_score, within) if prune else None
+        ids, scores = scored if scored is not None else self.score(query, within)
+        return self.select(ids, scores, k, min_score, within)
+
+    def score_pruned(
+        self, query: List[str], k: int, min_score: Optional[float] = None, within: Optional[np.ndarray] = None
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Exact scores of the docs that can still make the top ``k`` (MaxScore).
+
+        A term's contribution to any doc is at most idf * _term_bound(). Terms
+        are scored exhaustively in decreasing bound order (the rare, short
+        ones first) while tracking the k-th best partial score. Once the bounds
+        of the remaining terms sum below it (or below ``min_score``), no unseen
+        doc can enter the top k: the remaining, typically long, postings are
+        only probed for the surviving candidates, which are dropped as soon as
+        their partial score plus the remaining bounds falls short.
+
+        Survivors are re-summed in query-term order, so their scores equal
+        score() bit for bit. Returns None when pruning would not pay off:
+        single-term queries and queries touching fewer than
+        ``prune_min_postings`` postings in total (inside ``within``, estimated).
+        """
+        avgdl = self.avgdl
+        weights = self._query_weights(query)
+        if len(weights) < 2 or not avgdl or k <= 0:
+            return None
+        postings = sum(len(self._term_postings(tid)[0]) for tid in weights)
+        if within is not None:
+            # expected share of the postings inside the filter
+            postings *= np.count_nonzero(within) / max(len(within), 1)
+        if postings < self.prune_min_postings:
+            return None
+        bound = {tid: w * self._term_bound(tid) for tid, w in weights.items()}
+        order = sorted(weights, key=bound.__getitem__, reverse=True)
+        remaining, done = sum(bound.values()), 0.0
+        floor = min_score if min_score is not None and min_score > 0 else 0.0
+        acc = np.zeros(self.n_slots)
+        seen = np.zeros(self.n_slots, dtype=bool)
+        cand: Optional[np.ndarray] = None  # set once unseen docs are ruled out
+        parts: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+        def threshold(scores: np.ndarray) -> float:
+            # k-th best partial score: a lower bound of the final k-th score.
+            # The slack absorbs rounding between partial and final sums.
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k] if len(scores) >= k else 0.0
+            limit = max(float(kth), floor)
+            return limit - 1e-9 * limit
+
+        for tid in order:
+            ids, tfs = self._term_postings(tid)
+            if cand is not None:
+                # candidates are already inside ``within``
+                at = np.minimum(np.searchsorted(ids, cand), max(len(ids) - 1, 0))
+                hit = ids[at] == cand if len(ids) else np.zeros(len(cand), dtype=bool)
+                ids, tfs = cand[hit], tfs[at[hit]]
+            else:
+                if within is not None:
+                    keep = within[ids]
+                    ids, tfs = ids[keep], tfs[keep]
+                seen[ids] = True
+            contrib = weights[tid] * self._factors(ids, tfs, avgdl)
+            acc[ids] += contrib
+            parts[tid] = (ids, contrib)
+            remaining -= bound[tid]
+            done += bound[tid]
+            if cand is None:
+                # no partial score exceeds ``done``: skip the O(slots) check until it could pass
+                if remaining >= max(done, floor):
+                    continue
+                touched = np.flatnonzero(seen)
+                limit = threshold(acc[touched])
+                if not (0 < limit and remaining < limit):
+                    continue
+                cand = touched
+            else:
+                limit = threshold(acc[cand])
+            cand = cand[acc[cand] + remaining >= limit]
+        if cand is None:
+            cand = np.flatnonzero(seen)
+
+        scores = np.zeros(len(cand))
+        for tid in weights:
+            ids, contrib = parts[tid]
+            if not len(ids):
+                continue
+            at = np.minimum(np.searchsorted(ids, cand), len(ids) - 1)
+            hit = ids[at] == cand
+            scores[hit] += contrib[at[hit]]
+        return cand, scores
+
+    def score_batch(
+        self, queries: List[List[str]], max_entries: int = 1 << 22, within: Optional[np.ndarray] = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """score() for many queries at once, with identical results.
+
+        Each distinct term is resolved and its per-doc BM25 factor computed once
+        per batch; the sparse (query x term) idf-weight matrix is then
+        multiplied against those postings as one scatter-add per sub-batch of
+        at most ``max_entries`` postings, instead of one pass per query.
+        """
+        results: List[Tuple[np.ndarray, np.ndarray]] = [
+            (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)) for _ in queries
+        ]
+        avgdl = self.avgdl
+        if not avgdl or not queries:
+            return results
+        distinct = list(dict.fromkeys(t for q in queries for t in q))
+        tid_of = dict(zip(distinct, self.term_ids(distinct)))
+
+        # query-term weight matrix in COO form: one entry per (query, distinct
+        # term), queries in order and terms in first-seen order within each
+        e_query: List[int] = []
+        e_term: List[int] = []
+        e_weight: List[float] = []
+        column: Dict[int, int] = {}
+        for qi, q in enumerate(queries):
+            weights: Dict[int, float] = {}
+            for t in q:
+                tid = tid_of[t]
+                idf = self._term_weight(tid) if tid >= 0 else 0.0
+                if idf:
+                    weights[tid] = weights.get(tid, 0.0) + idf
+            for tid, w in weights.items():
+                e_query.append(qi)
+                e_term.append(column.setdefault(tid, len(column)))
+                e_weight.append(w)
+        if not column:
+            return results
+
+        # per-doc BM25 factor of each distinct term, flattened
+        post_ids: List[np.ndarray] = []
+        post_f: List[np.ndarray] = []
+        for tid in column:
+            ids, tfs = self._postings_within(tid, within)
+            post_ids.append(ids)
+            post_f.append(self._factors(ids, tfs, avgdl))
+        lens = np.array([len(ids) for ids in post_ids], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lens)))
+        flat_ids = np.concatenate(post_ids).astype(np.int64)
+        flat_f = np.concatenate(post_f)
+
+        eq = np.array(e_query, dtype=np.int64)
+        et = np.array(e_term, dtype=np.int64)
+        ew = np.array(e_weight)
+        elen = lens[et]
+        # sub-batches of whole queries holding about max_entries postings each
+        n_slots = max(self.n_slots, 1)
+        cum = np.cumsum(np.bincount(eq, weights=elen, minlength=len(queries)))
+        q_lo = 0
+        while q_lo < len(queries):
+            base = cum[q_lo - 1] if q_lo else 0.0
+            q_hi = min(len(queries), max(q_lo + 1, int(np.searchsorted(cum, base + max_entries, side="right"))))
+            e_lo, e_hi = np.searchsorted(eq, [q_lo, q_hi])
+            if e_lo < e_hi:
+                n = elen[e_lo:e_hi]
+                # postings positions of every entry, concatenated in entry order
+                pos = np.repeat(offsets[et[e_lo:e_hi]] - np.concatenate(([0], np.cumsum(n)[:-1])), n) + np.arange(n.sum())
+                keys = flat_ids[pos] + np.repeat(eq[e_lo:e_hi], n) * n_slots
+                uniq, inverse = np.unique(keys, return_inverse=True)
+                sums = np.bincount(inverse, weights=np.repeat(ew[e_lo:e_hi], n) * flat_f[pos])
+                bounds = np.searchsorted(uniq, np.arange(q_lo, q_hi + 1, dtype=np.int64) * n_slots)
+                for qi in range(q_lo, q_hi):
+                    lo, hi = bounds[qi - q_lo], bounds[qi - q_lo + 1]
+                    if lo < hi:
+                        results[qi] = ((uniq[lo:hi] - qi * n_slots).astype(np.int32), sums[lo:hi])
+            q_lo = q_hi
+        return results
+
+    def top_k_batch(
+        self, queries: List[List[str]], k: int, min_score: Optional[float] = None, within: Optional[np.ndarray] = None
+    ) -> List[Tuple[List[int], List[float]]]:
+        """top_k() for each query, scored together with score_batch()."""
+        return [self.select(ids, scores, k, min_score, within) for ids, scores in self.score_batch(queries, within=within)]
+
+    def select(
+        self,
+        ids: np.ndarray,
+        scores: np.ndarray,
+        k: int,
+        min_score: Optional[float] = None,
+        within: Optional[np.ndarray] = None,
+    ) -> Tuple[List[int], List[float]]:
+        """top_k() selection over a sparse score vector from score()/score_batch()."""
+        if min_score is not None:
+            keep = scores >= min_score
+            ids, scores = ids[keep], scores[keep]
+        top_ids, top_scores = select_top_k(ids, scores, k)
+        if len(top_ids) < k and (min_score is None or min_score <= 0):
+            taken = set(ids.tolist())
+            # a ``within`` mask only covers live slots (DocAttributes masks are built from the manifest)
+            fill = self._live_slots() if within is None else iter(np.flatnonzero(within).tolist())
+            for slot in fill:
+                if len(top_ids) >= k:
+                    break
+                if slot not in taken:
+                    top_ids.append(slot)
+                    top_scores.append(0.0)
+        return top_ids, top_scores
+
+
+class RagIndex(Bm25Scorer):
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.docs: List[Optional[Dict[str, Any]]] = []
+        self.doc_len: List[int] = []
+        self.vocab = Vocabulary()
+        self.doc_terms: List[Optional[Dict[int, int]]] = []
+        self.postings: Dict[int, Dict[int, int]] = {}
+        self.idf: Dict[int, float] = {}
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        self.by_digest: Dict[str, int] = {}
+        self.free: List[int] = []
+        self.n_live = 0
+        self.n_chunks = 0  # chunk occurrences across files, duplicates included
+        self.total_len = 0
+        self._packed: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        self._dl: Optional[np.ndarray] = None
+        self._bounds: Dict[int, float] = {}
+
+    # ------------------------------------------------------------------
+    # Corpus statistics
+    # ------------------------------------------------------------------
+    @property
+    def avgdl(self) -> float:
+        return self.total_len / self.n_live if self.n_live else 0.0
+
+    @property
+    def n_slots(self) -> int:
+        return len(self.docs)
+
+    def _refresh_idf(self) -> None:
+        """Recompute idf for the whole vocabulary (same floor as BM25Okapi)."""
+        self.idf = {}
+        if not self.postings:
+            return
+        n = self.n_live
+        idf_sum = 0.0
+        negative: List[int] = []
+        for tid, plist in self.postings.items():
+            df = len(plist)
+            idf = math.log(n - df + 0.5) - math.log(df + 0.5)
+            self.idf[tid] = idf
+            idf_sum += idf
+            if idf < 0:
+                negative.append(tid)
+        eps = self.epsilon * (idf_sum / len(self.idf))
+        for tid in negative:
+            self.idf[tid] = eps
+
+    # ------------------------------------------------------------------
+    # Document / file updates
+    # ------------------------------------------------------------------
+    def _add_doc(self, doc: Dict[str, Any], terms: Dict[str, int]) -> int:
+        freqs = self.vocab.intern_counts(terms)
+        length = sum(freqs.values())
+        if self.free:
+            slot = self.free.pop()
+            self.docs[slot] = doc
+            self.doc_len[slot] = length
+            self.doc_terms[slot] = freqs
+        else:
+            slot = len(self.docs)
+            self.docs.append(doc)
+            self.doc_len.append(length)
+            self.doc_terms.append(freqs)
+        for tid, tf in freqs.items():
+            self.postings.setdefault(tid, {})[slot] = tf
+            self._packed.pop(tid, None)
+        self._dl = None
+        self._bounds = {}
+        self.n_live += 1
+        self.total_len += length
+        return slot
+
+    def _remove_doc(self, slot: int) -> None:
+        freqs = self.doc_terms[slot]
+        if freqs is None:
+            return
+        for tid in freqs:
+            plist = self.postings.get(tid)
+            if plist is None:
+                continue
+            plist.pop(slot, None)
+            self._packed.pop(tid, None)
+            if not plist:
+                del self.postings[tid]
+        self._dl = None
+        self._bounds = {}
+        self.n_live -= 1
+        self.total_len -= self.doc_len[slot]
+        self.by_digest.pop(chunk_digest(self.docs[slot]["text"]), None)
+        self.docs[slot] = None
+        self.doc_terms[slot] = None
+        self.doc_len[slot] = 0
+        self.free.append(slot)
+
+    def remove_file(self, key: str) -> int:
+        entry = self.manifest.pop(key, None)
+        if not entry:
+            return 0
+        rel = entry["rel"]
+        for slot in dict.fromkeys(entry["chunks"]):
+            doc = self.docs[slot]
+            if doc is None:
+                continue
+            keep = [o for o in [occurrence(doc)] + doc.get("duplicates", []) if o["source"] != rel]
+            if not keep:
+                self._remove_doc(slot)
+                continue
+            # another file still has this text: promote its occurrence
+            for k in OCCURRENCE_KEYS:
+                doc.pop(k, None)
+            doc.update(keep[0])
+            doc.pop("duplicates", None)
+            if len(keep) > 1:
+                doc["duplicates"] = keep[1:]
+        self.n_chunks -= len(entry["chunks"])
+        return len(entry["chunks"])
+
+    def add_file(self, key: str, meta: Dict[str, Any], chunks: List[Chunk]) -> List[int]:
+        self.remove_file(key)
+        slots = []
+        for doc, freqs in chunks:
+            digest = chunk_digest(doc["text"])
+            slot = self.by_digest.get(digest)
+            if slot is None:
+                slot = self.by_digest[digest] = self._add_doc(doc, freqs)
+            else:
+                self.docs[slot].setdefault("duplicates", []).append(occurrence(doc))
+            slots.append(slot)
+        self.n_chunks += len(slots)
+        self.manifest[key] = dict(meta, chunks=slots)
+        return slots
+
+    def sync(
+        self,
+        sources: Iterable[SourceFile],
+        chunker: Chunker,
+        tokenizer: Tokenizer,
+        max_workers: int = 8,
+        processes: int = 0,
+    ) -> Dict[str, int]:
+        """Bring the index in line with ``sources``.
+
+        Files whose size and mtime match the manifest are skipped without being
+        read. Files that did change are hashed; only those whose sha256 differs
+        are re-chunked and re-tokenized. Manifest entries with no matching
+        source are dropped. Cost scales with the number of changed files.
+        ``processes`` > 1 chunks and tokenizes in worker processes (see
+        load_sources); postings are always merged here, in source order.
+        """
+        stats = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+        seen: Dict[str, SourceFile] = {}
+        candidates: List[Tuple[SourceFile, Dict[str, Any]]] = []
+        for src in sources:
+            key = str(src.path)
+            seen[key] = src
+            try:
+                st = src.path.stat()
+            except OSError:
+                continue
+            meta = {"rel": src.rel, "kind": src.kind, "size": st.st_size, "mtime": st.st_mtime_ns}
+            prev = self.manifest.get(key)
+            if prev and prev["size"] == meta["size"] and prev["mtime"] == meta["mtime"]:
+                stats["unchanged"] += 1
+                continue
+            candidates.append((src, meta))
+
+        for key in [k for k in self.manifest if k not in seen]:
+            self.remove_file(key)
+            stats["removed"] += 1
+
+        items = [(src, meta, (self.manifest.get(str(src.path)) or {}).get("sha256")) for src, meta in candidates]
+        for res in load_sources(items, chunker, tokenizer, max_workers=max_workers, processes=processes):
+            if res is None:
+                continue
+            src, meta, chunks = res
+            key = str(src.path)
+            prev = self.manifest.get(key)
+            if chunks is None:
+                # touched but identical content: refresh stat fields only
+                prev.update(meta)
+                stats["unchanged"] += 1
+                continue
+            stats["changed" if prev else "added"] += 1
+            self.add_file(key, meta, chunks)
+
+        self._refresh_idf()
+        return stats
+
+    # ------------------------------------------------------------------
+    # Bm25Scorer hooks
+    # ------------------------------------------------------------------
+    def term_ids(self, terms: List[str]) -> List[int]:
+        get = self.vocab.get
+        return [get(t) for t in terms]
+
+    def _term_weight(self, tid: int) -> float:
+        return self.idf.get(tid, 0.0)
+
+    def _term_postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        packed = self._packed.get(tid)
+        if packed is None:
+            plist = self.postings.get(tid, {})
+            ids = np.fromiter(plist.keys(), dtype=np.int32, count=len(plist))
+            tfs = np.fromiter(plist.values(), dtype=np.float32, count=len(plist))
+            order = np.argsort(ids, kind="stable")
+            packed = self._packed[tid] = (ids[order], tfs[order])
+        return packed
+
+    def _doc_len_array(self) -> np.ndarray:
+        if self._dl is None:
+            self._dl = np.asarray(self.doc_len, dtype=np.float32)
+        return self._dl
+
+    def _live_slots(self) -> Iterator[int]:
+        return (slot for slot, doc in enumerate(self.docs) if doc is not None)
+
+    def _term_bound(self, tid: int) -> float:
+        # every add/remove moves avgdl, so the cache is dropped on any change
+        bound = self._bounds.get(tid)
+        if bound is None:
+            ids, tfs = self._term_postings(tid)
+            bound = self._bounds[tid] = float(self._factors(ids, tfs, self.avgdl).max()) if len(ids) else 0.0
+        return bound
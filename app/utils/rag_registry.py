@@ -0,0 +1,131 @@
+"""Per-root registry of RAG index stores and the snapshots opened from them.
+
+Provides:
+- root_slug(root): cache subdirectory name of a (resolved) contracts root
+- snapshot_bytes(snap): bytes of index data a loaded snapshot holds
+- IndexRegistry: one store directory per root under a base directory, and an
+  LRU of opened snapshots bounded by their total snapshot_bytes
+
+Switching the served root only changes which store directory a server reads
+and writes; the other roots' generations stay on disk, and the snapshots of
+recently used roots stay open, so switching back (or querying another root
+directly) neither rebuilds nor reopens anything. Evicting a snapshot only
+drops the registry's reference: requests that pinned it keep using it.
+
+Only root_dir() creates anything: a server registers a root when it starts
+serving it (and builds there); reads (get, store_dir, known) never touch the
+disk, so querying an unknown root leaves no trace.
+
+Layout of ``<base>/<root slug>/``: ``root.txt`` (the resolved root path),
+``index/`` (the store directory, see app.utils.rag_store) and whatever else a
+server keeps per root (the trigram index).
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.utils.rag_store import IndexSnapshot, current_generation, open_snapshot
+
+
+def root_slug(root: Path) -> str:
+    """``<dir name>-<hash of the full path>``: readable, and distinct for equally named roots."""
+    digest = hashlib.sha1(str(root).encode("utf-8")).hexdigest()[:12]
+    return f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', root.name) or 'root'}-{digest}"
+
+
+def snapshot_bytes(snap: IndexSnapshot) -> int:
+    """Size of the generation's files, all mapped (its embedding matrix is one of them)."""
+    return sum(p.stat().st_size for p in snap.index.path.iterdir() if p.is_file())
+
+
+class IndexRegistry:
+    def __init__(
+        self,
+        base: Path,
+        max_bytes: int = 1 << 30,
+        opener: Callable[[Path], Optional[IndexSnapshot]] = open_snapshot,
+    ):
+        self.base = base
+        self.max_bytes = max_bytes
+        self.opener = opener
+        self.opens = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._loaded: "OrderedDict[str, Tuple[IndexSnapshot, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def root_dir(self, root: Path) -> Path:
+        """``root``'s directory, created (and the root registered) if needed."""
+        path = self.base / root_slug(root)
+        if not (path / "root.txt").exists():
+            path.mkdir(parents=True, exist_ok=True)
+            (path / "root.txt").write_text(str(root), encoding="utf-8")
+        return path
+
+    def store_dir(self, root: Path) -> Path:
+        return self.base / root_slug(root) / "index"
+
+    def known(self, root: Path) -> bool:
+        """Whether ``root`` was registered with root_dir()."""
+        return (self.base / root_slug(root) / "root.txt").exists()
+
+    def get(self, root: Path) -> Optional[IndexSnapshot]:
+        """Snapshot of ``root``'s current generation, opened if needed; None if it was never built."""
+        if not self.known(root):
+            return None
+        store_dir = self.store_dir(root)
+        gen = current_generation(store_dir)
+        if gen is None:
+            return None
+        with self._lock:
+            item = self._loaded.get(str(root))
+            if item is not None and item[0].generation == gen:
+                self._loaded.move_to_end(str(root))
+                return item[0]
+        snap = self.opener(store_dir)
+        if snap is not None:
+            self.opens += 1
+            self.put(root, snap)
+        return snap
+
+    def put(self, root: Path, snap: IndexSnapshot) -> None:
+        """Keep ``snap`` as ``root``'s loaded snapshot (most recently used)."""
+        size = snapshot_bytes(snap)
+        with self._lock:
+            old = self._loaded.pop(str(root), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._loaded[str(root)] = (snap, size)
+            self._bytes += size
+            # the snapshot just put stays, even if it alone is over budget
+            while self._bytes > self.max_bytes and len(self._loaded) > 1:
+                _, (_, evicted) = self._loaded.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def roots(self) -> List[Dict[str, Any]]:
+        """Every root with a store under ``base``: path, current generation, whether loaded."""
+        with self._lock:
+            loaded = {key: snap.generation for key, (snap, _) in self._loaded.items()}
+        out = []
+        for path in sorted(self.base.glob("*/root.txt")):
+            root = path.read_text(encoding="utf-8").strip()
+            gen = current_generation(path.parent / "index")
+            if gen is not None:
+                out.append({"root": root, "generation": gen, "loaded": loaded.get(root) == gen})
+        return out
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "loaded": len(self._loaded),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "opens": self.opens,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,566 @@
+"""Memory-mapped on-disk format for the RAG index.
+
+Provides:
+- write_store(index, store_dir): persist a RagIndex as a new store generation
+- open_store(store_dir): MappedIndex for the current generation (or None)
+- current_generation(store_dir): name of the generation CURRENT points at
+- to_rag_index(store): rehydrate a mutable RagIndex for incremental builds
+- IndexSnapshot / open_snapshot(store_dir): the immutable unit a server
+  publishes with one reference swap
+- new_generation_dir / compress_docs / publish_generation / discard_generation:
+  for writers that stream a generation (app.utils.rag_builder)
+- store_lock(store_dir): the cross-process lock of a store directory
+
+Every file of a generation is a flat little-endian array opened with mmap, so
+loading is O(1), uvicorn workers share the same page-cache pages, and chunk
+text is only decoded for the hits that are returned. No pickle is involved.
+
+Docs (chunk JSON, mostly text) are the bulk of a store, yet a request reads
+only its k hits. They are stored as zlib blocks of whole docs (about
+DOC_BLOCK_BYTES uncompressed each, ~5x smaller on Solidity); reading a doc
+inflates just its block, and a small per-generation LRU keeps hot blocks.
+
+Layout of ``<store_dir>/<generation>/`` (STORE_VERSION 4; version 2 marks
+stores tokenized with app.utils.rag_tokenizer, version 3 adds the document
+attribute files, version 4 compresses docs):
+
+  meta.json       format, version, counts (n_chunks: occurrences before
+                  dedup), BM25 parameters
+  vocab.bin       utf-8 terms, sorted by bytes; a term's position is its id
+  vocab.u64       [V+1] offsets into vocab.bin
+  postings.u64    [V+1] offsets (in postings) of each term's list
+  idf.f64         [V]   idf per term
+  postings.bin    [P] int32 doc ids followed by [P] float32 term frequencies
+  doclen.f32      [N]   doc lengths (0 for free slots)
+  docs.u64        [N+1] offsets of each doc in the uncompressed doc stream
+                  (one utf-8 JSON object per doc; empty for free slots)
+  docs.bin        that stream as independently zlib-compressed blocks
+  blocks.u64      [B+1] offsets of the blocks in docs.bin
+  blocks.raw.u64  [B+1] uncompressed stream offset at which each block starts
+  manifest.json   per-file manifest (size, mtime, sha256 -> chunk ids)
+  attrs.json, attrs.bits, files.u64, files.i4
+                  per-doc bucket / extension bitsets and path -> chunk ids,
+                  for filtered queries (app.utils.rag_filters)
+  dense-<model>.f32, dense-<model>.json
+                  optional embedding matrix of the generation (app.utils.rag_dense)
+
+``<store_dir>/CURRENT`` names the live generation and is replaced atomically
+after a generation is fully written; readers notice and reopen. A generation of
+another format version reads as no store at all, so the next build is a full one.
+
+Several processes (uvicorn workers, watchers) may share a store directory.
+``<store_dir>/LOCK`` is flock()ed (store_lock): exclusively to number a new
+generation and to publish/prune, shared by open_snapshot() while it reads the
+generation's files, so a generation is never pruned half-opened. A snapshot
+reads its side files (attributes, dense matrix) while it is opened and maps
+the rest, so it stays usable after its directory is pruned. A publish never
+moves CURRENT back to an older generation. ``<store_dir>/PUBLISHED`` lists the
+last KEEP_GENERATIONS published generations; pruning keeps those and any
+generation whose ``BUILDING`` marker is still flock()ed by its builder, and
+removes the rest. Without fcntl (Windows) there is no cross-process lock, and
+a build that died leaves its directory behind.
+"""
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import Sequence
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process store lock
+    fcntl = None
+
+from app.utils.rag_dense import DenseIndex, load_dense
+from app.utils.rag_filters import DocAttributes, write_attributes
+from app.utils.rag_index import Bm25Scorer, RagIndex, chunk_digest
+from app.utils.rag_tokenizer import Vocabulary
+
+
+STORE_FORMAT = "payrox-rag-index"
+STORE_VERSION = 4
+KEEP_GENERATIONS = 2
+# uncompressed size a docs block grows to before it is cut (at a doc boundary)
+DOC_BLOCK_BYTES = 16 * 1024
+# decompressed docs blocks kept per open generation
+DOC_BLOCK_CACHE = 64
+
+
+def _write_array(path: Path, arr: np.ndarray, dtype: str) -> None:
+    np.ascontiguousarray(arr, dtype=dtype).tofile(path)
+
+
+def _map_array(path: Path, dtype: str, count: int, offset: int = 0) -> np.ndarray:
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    # a plain ndarray view of the mapping: slicing np.memmap itself pays for
+    # subclass bookkeeping on every postings lookup
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,)).view(np.ndarray)
+
+
+def current_generation(store_dir: Path) -> Optional[str]:
+    try:
+        return (store_dir / "CURRENT").read_text(encoding="utf-8").strip() or None
+    except OSError:
+        return None
+
+
+@contextmanager
+def store_lock(store_dir: Path, shared: bool = False) -> Iterator[None]:
+    """flock() ``<store_dir>/LOCK``: exclusive for writers, ``shared`` for readers."""
+    store_dir.mkdir(parents=True, exist_ok=True)
+    with open(store_dir / "LOCK", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        # closing the file releases the lock
+        yield
+
+
+def _generation_number(name: str) -> int:
+    return int(name[1:]) if name[:1] == "g" and name[1:].isdigit() else -1
+
+
+def _next_generation(store_dir: Path) -> str:
+    gens = [_generation_number(p.name) for p in store_dir.glob("g*")]
+    return f"g{max(gens, default=0) + 1:06d}"
+
+
+# generation dir -> its open BUILDING marker, flock()ed until published or discarded
+_BUILDING: Dict[str, Any] = {}
+_BUILDING_LOCK = threading.Lock()
+
+
+def new_generation_dir(store_dir: Path) -> Path:
+    """Create the directory for the next generation (not yet visible to readers).
+
+    The caller must publish_generation() or discard_generation() it.
+    """
+    with store_lock(store_dir):
+        out = store_dir / _next_generation(store_dir)
+        out.mkdir()
+        marker = open(out / "BUILDING", "wb")
+        if fcntl is not None:
+            fcntl.flock(marker.fileno(), fcntl.LOCK_EX)
+    with _BUILDING_LOCK:
+        _BUILDING[str(out)] = marker
+    return out
+
+
+def _end_build(out: Path) -> None:
+    with _BUILDING_LOCK:
+        marker = _BUILDING.pop(str(out), None)
+    if marker is not None:
+        marker.close()
+    (out / "BUILDING").unlink(missing_ok=True)
+
+
+def discard_generation(out: Path) -> None:
+    """Remove an unpublished generation dir from new_generation_dir()."""
+    _end_build(out)
+    shutil.rmtree(out, ignore_errors=True)
+
+
+def _being_built(gen_dir: Path) -> bool:
+    """Whether some process is still writing ``gen_dir`` (holds its BUILDING marker)."""
+    try:
+        marker = open(gen_dir / "BUILDING", "rb")
+    except OSError:
+        return False
+    with marker:
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(marker.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        # left behind by a build that died
+        return False
+
+
+def store_meta(**counts: Any) -> Dict[str, Any]:
+    return {"format": STORE_FORMAT, "version": STORE_VERSION, **counts}
+
+
+def compress_docs(out: Path, level: int = 6) -> None:
+    """Replace the raw doc stream ``docs.raw`` of generation dir ``out`` by zlib blocks.
+
+    ``docs.u64`` (offsets into the raw stream) must be written already; it is
+    kept as is. Blocks hold whole docs, so a doc is read from a single block.
+    """
+    offsets = np.fromfile(out / "docs.u64", dtype="<u8")
+    total = int(offsets[-1]) if len(offsets) else 0
+    comp, raw = [0], [0]
+    with open(out / "docs.raw", "rb") as src, open(out / "docs.bin", "wb") as dst:
+        while raw[-1] < total:
+            # the first doc end at or past the target size closes the block
+            i = int(np.searchsorted(offsets, raw[-1] + DOC_BLOCK_BYTES, side="left"))
+            stop = int(offsets[min(i, len(offsets) - 1)])
+            comp.append(comp[-1] + dst.write(zlib.compress(src.read(stop - raw[-1]), level)))
+            raw.append(stop)
+    _write_array(out / "blocks.u64", np.array(comp), "<u8")
+    _write_array(out / "blocks.raw.u64", np.array(raw), "<u8")
+    os.remove(out / "docs.raw")
+
+
+def publish_generation(store_dir: Path, gen: str) -> bool:
+    """Atomically point CURRENT at ``gen`` and prune older generations.
+
+    Returns False (and drops ``gen``) when another process has published a
+    newer generation meanwhile: it was started later, so it is at least as fresh.
+    """
+    with store_lock(store_dir):
+        current = current_generation(store_dir)
+        if current is not None and _generation_number(current) > _generation_number(gen):
+            discard_generation(store_dir / gen)
+            return False
+        _end_build(store_dir / gen)
+        published = (_published(store_dir) + [gen])[-KEEP_GENERATIONS:]
+        tmp = store_dir / f"CURRENT.{os.getpid()}.tmp"
+        tmp.write_text("\n".join(published), encoding="utf-8")
+        os.replace(tmp, store_dir / "PUBLISHED")
+        tmp.write_text(gen, encoding="utf-8")
+        os.replace(tmp, store_dir / "CURRENT")
+        _prune_generations(store_dir, published)
+    return True
+
+
+def write_store(index: RagIndex, store_dir: Path, before_publish: Optional[Callable[[Path], None]] = None) -> str:
+    """Write ``index`` as a new generation and make it current. Returns its name.
+
+    ``before_publish(generation_dir)`` runs once the generation is complete but
+    before readers can see it (to add derived files such as the dense matrix).
+    """
+    out = new_generation_dir(store_dir)
+    try:
+        _write_generation(index, out)
+        if before_publish is not None:
+            before_publish(out)
+    except BaseException:
+        discard_generation(out)
+        raise
+    publish_generation(store_dir, out.name)
+    return out.name
+
+
+def _write_generation(index: RagIndex, out: Path) -> None:
+    vocab = index.vocab.terms
+    tids = sorted(index.postings, key=lambda tid: vocab[tid].encode("utf-8"))
+    encoded = [vocab[tid].encode("utf-8") for tid in tids]
+    with open(out / "vocab.bin", "wb") as f:
+        f.write(b"".join(encoded))
+    _write_array(out / "vocab.u64", np.cumsum([0] + [len(e) for e in encoded]), "<u8")
+    _write_array(out / "idf.f64", np.array([index.idf.get(tid, 0.0) for tid in tids]), "<f8")
+
+    packed = [index._term_postings(tid) for tid in tids]
+    _write_array(out / "postings.u64", np.cumsum([0] + [len(ids) for ids, _ in packed]), "<u8")
+    with open(out / "postings.bin", "wb") as f:
+        for ids, _ in packed:
+            f.write(np.ascontiguousarray(ids, dtype="<i4").tobytes())
+        for _, tfs in packed:
+            f.write(np.ascontiguousarray(tfs, dtype="<f4").tobytes())
+
+    _write_array(out / "doclen.f32", np.asarray(index.doc_len), "<f4")
+    offsets = [0]
+    with open(out / "docs.raw", "wb") as f:
+        for doc in index.docs:
+            if doc is not None:
+                offsets.append(offsets[-1] + f.write(json.dumps(doc, ensure_ascii=False).encode("utf-8")))
+            else:
+                offsets.append(offsets[-1])
+    _write_array(out / "docs.u64", np.array(offsets), "<u8")
+    compress_docs(out)
+
+    (out / "manifest.json").write_text(json.dumps({"files": index.manifest}), encoding="utf-8")
+    write_attributes(out, index.manifest, len(index.docs))
+    meta = store_meta(
+        n_terms=len(tids),
+        n_postings=int(sum(len(ids) for ids, _ in packed)),
+        n_slots=len(index.docs),
+        n_live=index.n_live,
+        n_chunks=index.n_chunks,
+        total_len=index.total_len,
+        k1=index.k1,
+        b=index.b,
+        epsilon=index.epsilon,
+    )
+    (out / "meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+
+def _published(store_dir: Path) -> List[str]:
+    """The last KEEP_GENERATIONS published generations, oldest first."""
+    try:
+        return (store_dir / "PUBLISHED").read_text(encoding="utf-8").split()
+    except OSError:
+        # a store written before PUBLISHED existed
+        return [g for g in [current_generation(store_dir)] if g]
+
+
+def _prune_generations(store_dir: Path, published: List[str]) -> None:
+    # keep the previous generations around for workers that still have them
+    # mapped, and builds in progress (they drop themselves if they lose, see
+    # publish_generation). Callers hold store_lock().
+    for old in store_dir.glob("g*"):
+        if old.is_dir() and old.name not in published and _generation_number(old.name) >= 0 and not _being_built(old):
+            shutil.rmtree(old, ignore_errors=True)
+
+
+class MappedDocs(Sequence):
+    """Read-only ``DOCS`` view: inflates a doc's block and decodes its JSON only when it is accessed."""
+
+    def __init__(self, blob: Any, offsets: np.ndarray, blocks: np.ndarray, block_raw: np.ndarray, cache_blocks: int = DOC_BLOCK_CACHE):
+        self._blob = blob
+        self._offsets = offsets
+        self._blocks = blocks
+        self._block_raw = block_raw.tolist()  # bisected per doc read; one entry per block
+        self._cache: "OrderedDict[int, bytes]" = OrderedDict()
+        self._cache_blocks = cache_blocks
+        self._lock = threading.Lock()
+        self.inflated = 0
+
+    def __len__(self) -> int:
+        return max(0, len(self._offsets) - 1)
+
+    def _block(self, b: int) -> bytes:
+        with self._lock:
+            data = self._cache.get(b)
+            if data is not None:
+                self._cache.move_to_end(b)
+                return data
+        data = zlib.decompress(self._blob[int(self._blocks[b]) : int(self._blocks[b + 1])])
+        with self._lock:
+            self.inflated += 1
+            self._cache[b] = data
+            while len(self._cache) > self._cache_blocks:
+                self._cache.popitem(last=False)
+        return data
+
+    def __getitem__(self, i: int) -> Optional[Dict[str, Any]]:
+        if i < 0:
+            i += len(self)
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        if start == end:
+            return None
+        b = bisect_right(self._block_raw, start) - 1
+        base = self._block_raw[b]
+        return json.loads(self._block(b)[start - base : end - base].decode("utf-8"))
+
+    def is_live(self, i: int) -> bool:
+        return self._offsets[i + 1] > self._offsets[i]
+
+
+class MappedIndex(Bm25Scorer):
+    """Read-only BM25 index backed by the mmapped files of one store generation."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.generation = path.name
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("format") != STORE_FORMAT or meta.get("version") != STORE_VERSION:
+            raise ValueError(f"unsupported index store {meta.get('format')} v{meta.get('version')}")
+        self.meta = meta
+        self.k1 = float(meta["k1"])
+        self.b = float(meta["b"])
+        self.n_live = int(meta["n_live"])
+        self.n_chunks = int(meta.get("n_chunks", self.n_live))
+        self.total_len = int(meta["total_len"])
+        n_terms, n_post, n_slots = int(meta["n_terms"]), int(meta["n_postings"]), int(meta["n_slots"])
+
+        self._vocab = self._map_bytes(path / "vocab.bin")
+        self._vocab_off = _map_array(path / "vocab.u64", "<u8", n_terms + 1)
+        self._post_off = _map_array(path / "postings.u64", "<u8", n_terms + 1)
+        self._idf = _map_array(path / "idf.f64", "<f8", n_terms)
+        self._post_ids = _map_array(path / "postings.bin", "<i4", n_post)
+        self._post_tfs = _map_array(path / "postings.bin", "<f4", n_post, offset=4 * n_post)
+        self._dl = _map_array(path / "doclen.f32", "<f4", n_slots)
+        n_blocks = (path / "blocks.u64").stat().st_size // 8
+        self.docs = MappedDocs(
+            self._map_bytes(path / "docs.bin"),
+            _map_array(path / "docs.u64", "<u8", n_slots + 1),
+            _map_array(path / "blocks.u64", "<u8", n_blocks),
+            _map_array(path / "blocks.raw.u64", "<u8", n_blocks),
+        )
+        self._n_terms = n_terms
+        self._bounds: Optional[np.ndarray] = None
+        self._attributes: Optional[DocAttributes] = None
+
+    @staticmethod
+    def _map_bytes(path: Path) -> Any:
+        if path.stat().st_size == 0:
+            return b""
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _term_bytes(self, i: int) -> bytes:
+        return self._vocab[int(self._vocab_off[i]) : int(self._vocab_off[i + 1])]
+
+    def term_id(self, term: str) -> int:
+        """Binary search of the sorted vocabulary; -1 when the term is unknown."""
+        key = term.encode("utf-8")
+        lo, hi = 0, self._n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._n_terms and self._term_bytes(lo) == key else -1
+
+    def terms(self) -> Iterator[str]:
+        for i in range(self._n_terms):
+            yield self._term_bytes(i).decode("utf-8")
+
+    def load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        return json.loads((self.path / "manifest.json").read_text(encoding="utf-8"))["files"]
+
+    @property
+    def attributes(self) -> DocAttributes:
+        """Per-doc bucket / extension / path attributes, read on first use."""
+        if self._attributes is None:
+            self._attributes = DocAttributes.load(self.path, len(self.docs))
+        return self._attributes
+
+    # Bm25Scorer hooks -------------------------------------------------
+    @property
+    def avgdl(self) -> float:
+        return self.total_len / self.n_live if self.n_live else 0.0
+
+    @property
+    def n_slots(self) -> int:
+        return len(self.docs)
+
+    def term_ids(self, terms: List[str]) -> List[int]:
+        return [self.term_id(t) for t in terms]
+
+    def _term_weight(self, tid: int) -> float:
+        return float(self._idf[tid])
+
+    def _term_postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = int(self._post_off[tid]), int(self._post_off[tid + 1])
+        return self._post_ids[start:end], self._post_tfs[start:end]
+
+    def _doc_len_array(self) -> np.ndarray:
+        return self._dl
+
+    def _live_slots(self) -> Iterator[int]:
+        return (i for i in range(len(self.docs)) if self.docs.is_live(i))
+
+    def _term_bound(self, tid: int) -> float:
+        if self._bounds is None:
+            # all terms at once on first use: one pass over the postings
+            bounds = np.zeros(self._n_terms)
+            if len(self._post_ids):
+                starts = self._post_off[:-1].astype(np.int64)
+                nonempty = starts < self._post_off[1:].astype(np.int64)
+                factors = self._factors(self._post_ids, self._post_tfs, self.avgdl)
+                bounds[nonempty] = np.maximum.reduceat(factors, starts[nonempty])
+            self._bounds = bounds
+        return float(self._bounds[tid])
+
+    def iter_docs(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self.docs)):
+            doc = self.docs[i]
+            if doc is not None:
+                yield doc
+
+
+def open_store(store_dir: Path) -> Optional[MappedIndex]:
+    gen = current_generation(store_dir)
+    if not gen or not (store_dir / gen / "meta.json").exists():
+        return None
+    try:
+        return MappedIndex(store_dir / gen)
+    except ValueError:
+        # written by another store version / tokenizer
+        return None
+
+
+@dataclass(frozen=True)
+class IndexSnapshot:
+    """One published index generation, served as a unit.
+
+    Servers hold the live snapshot in a single reference and replace it
+    wholesale; a request reads that reference once and uses the snapshot it
+    got until it finishes, so a concurrent publish never mixes two generations
+    in one response. Nothing here is mutated after construction (the mapped
+    files of a generation are never rewritten), and a pinned snapshot keeps
+    its mappings valid even after the generation directory is pruned.
+    ``dense`` is the generation's embedding matrix when dense retrieval is on.
+    """
+
+    index: MappedIndex
+    generation: str
+    loaded_at: float = field(default_factory=time.time)
+    dense: Optional[DenseIndex] = None
+
+    @property
+    def docs(self) -> MappedDocs:
+        return self.index.docs
+
+    @property
+    def n_live(self) -> int:
+        return self.index.n_live
+
+    @property
+    def n_chunks(self) -> int:
+        return self.index.n_chunks
+
+
+def open_snapshot(store_dir: Path, dense_model: Optional[str] = None) -> Optional[IndexSnapshot]:
+    """Snapshot of the current generation, with ``dense_model``'s matrix when stored.
+
+    Everything the snapshot reads from its directory is read or mapped here,
+    under the shared store lock, so pruning the generation later is harmless.
+    """
+    if not store_dir.is_dir():
+        return None
+    with store_lock(store_dir, shared=True):
+        store = open_store(store_dir)
+        if store is None:
+            return None
+        store.attributes  # loaded now: attrs.json goes when the generation is pruned
+        dense = load_dense(store.path, dense_model) if dense_model else None
+    return IndexSnapshot(store, store.generation, dense=dense)
+
+
+def to_rag_index(store: MappedIndex) -> RagIndex:
+    """Rehydrate a mutable RagIndex (postings dicts + manifest) from a mapped store.
+
+    Only needed for the first incremental build in a process; afterwards the
+    builder is kept in memory.
+    """
+    meta = store.meta
+    index = RagIndex(k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"])
+    n = len(store.docs)
+    index.docs = [store.docs[i] for i in range(n)]
+    index.doc_len = [int(x) for x in store._dl]
+    index.doc_terms = [({} if d is not None else None) for d in index.docs]
+    index.free = [i for i, d in enumerate(index.docs) if d is None]
+    # ids are interned in store order, so term id == store term id
+    index.vocab = Vocabulary(store.terms())
+    for tid in range(len(index.vocab)):
+        start, end = int(store._post_off[tid]), int(store._post_off[tid + 1])
+        ids = store._post_ids[start:end].tolist()
+        tfs = store._post_tfs[start:end].astype(np.int64).tolist()
+        index.postings[tid] = dict(zip(ids, tfs))
+        for slot, tf in zip(ids, tfs):
+            index.doc_terms[slot][tid] = tf
+    index.n_live = store.n_live
+    index.total_len = store.total_len
+    index.manifest = store.load_manifest()
+    index.n_chunks = sum(len(entry["chunks"]) for entry in index.manifest.values())
+    index.by_digest = {chunk_digest(d["text"]): i for i, d in enumerate(index.docs) if d is not None}
+    index._refresh_idf()
+    return index
@@ -0,0 +1,100 @@
+"""Solidity-aware tokenizer and term vocabulary for the RAG index.
+
+Provides:
+- tokenize(s): index/query tokens for Solidity and its comments
+- Vocabulary: append-only term <-> dense int id table
+
+tokenize() keeps every identifier whole (lower-cased) and also emits its
+camelCase / snake_case parts, so ``facetAddress`` is indexed as
+``facetaddress facet address``: the query "facet address lookup" matches it
+through the parts, and the query "facetAddress" ranks exact uses first through
+the rarer compound. Hex literals are normalized to lower case with the 0x
+prefix kept, so a 4-byte selector or an address is one token however it was
+checksummed. Keywords, elementary type names and English filler that occur in
+nearly every chunk are dropped.
+
+Identifiers repeat heavily across a codebase, so the per-word expansion is
+memoized; a chunk costs one regex scan plus a cache lookup per word.
+"""
+from __future__ import annotations
+
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+_WORD = re.compile(r"\w+")
+_HEX = re.compile(r"0x[0-9a-f]+")
+_PARTS = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+_TYPE = re.compile(r"u?int\d*|bytes\d*|u?fixed[\dx]*")
+
+STOPWORDS = frozenset(
+    """
+    function returns return memory calldata external public internal private view pure
+    virtual override pragma solidity spdx license identifier bool string
+    if else for while do break continue emit new delete true false this
+    the a an and or of to in is it be by as at on with that are from not
+    """.split()
+)
+
+
+@lru_cache(maxsize=1 << 16)
+def _expand(word: str) -> Tuple[str, ...]:
+    lower = word.lower()
+    if lower.startswith("0x") and _HEX.fullmatch(lower):
+        return (lower,)
+    if lower.isdigit():
+        return (lower,)
+    if lower in STOPWORDS or _TYPE.fullmatch(lower):
+        return ()
+    parts = [p.lower() for p in _PARTS.findall(word)]
+    whole = lower.strip("_")
+    out = [whole] if whole else []
+    if len(parts) > 1:
+        out.extend(p for p in parts if len(p) > 1 and not p.isdigit() and p not in STOPWORDS and p != whole)
+    return tuple(out)
+
+
+def tokenize(s: str) -> List[str]:
+    out: List[str] = []
+    for word in _WORD.findall(s):
+        out.extend(_expand(word))
+    return out
+
+
+class Vocabulary:
+    """Term <-> id table; ids are dense, assigned in first-seen order and never reused.
+
+    A store generation's sorted vocab.bin is the persisted form: rehydrating a
+    RagIndex builds its Vocabulary from it, so ids equal store term ids.
+    """
+
+    def __init__(self, terms: Iterable[str] = ()):
+        self.terms: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for term in terms:
+            self.intern(term)
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def intern(self, term: str) -> int:
+        tid = self.ids.get(term)
+        if tid is None:
+            tid = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return tid
+
+    def get(self, term: str) -> int:
+        """Id of ``term``, or -1 if it was never interned."""
+        return self.ids.get(term, -1)
+
+    def intern_counts(self, freqs: Dict[str, int]) -> Dict[int, int]:
+        intern = self.intern
+        return {intern(term): tf for term, tf in freqs.items()}
+
+    def encode(self, tokens: Iterable[str]) -> np.ndarray:
+        """int32 ids of ``tokens`` (-1 for unknown terms)."""
+        get = self.ids.get
+        return np.fromiter((get(t, -1) for t in tokens), dtype=np.int32)
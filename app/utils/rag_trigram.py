@@ -0,0 +1,387 @@
+"""Persistent trigram index for substring and regex search over the contracts tree.
+
+Provides:
+- trigrams(text): sorted unique trigram codes of lower-cased text
+- required_literals(pattern, flags): literal strings every regex match must contain
+- substring_matcher / regex_matcher: (start, end) iterators over a file's text
+- match_files(root, files, matcher, limit): the hits of a matcher in files
+- RegexRunner: a small pool of worker processes that match user regexes
+  under a deadline (RegexTimeout when it is exceeded)
+- TrigramIndex: per-file trigram sets plus trigram -> files postings, refreshed
+  incrementally from (size, mtime) and saved under .rag_cache
+
+A query is narrowed to the files containing every trigram of its literals and
+only those files are read and matched, so a search costs a few set
+intersections plus the candidates' I/O instead of a read of the whole tree.
+Trigrams are taken from lower-cased text, so the filter holds for
+case-insensitive queries too. Patterns without a literal run of length >= 3
+(e.g. ``a.b``) fall back to reading every indexed file.
+
+Python's ``re`` cannot be interrupted, and a pattern with catastrophic
+backtracking can run for hours on one file. Untrusted regexes are therefore
+matched by RegexRunner in separate processes: a worker that overruns the
+deadline is killed (and replaced on the next search) instead of pinning a
+server thread.
+
+The saved form is one .npz (manifest JSON + concatenated uint64 codes) replaced
+atomically; a different root or format version starts from empty.
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+try:  # Python 3.11+
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover - older interpreters
+    import sre_constants
+    import sre_parse
+
+TRIGRAM_FORMAT = "payrox-trigram"
+TRIGRAM_VERSION = 1
+
+Matcher = Callable[[str], Iterator[Tuple[int, int]]]
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, "POSSESSIVE_REPEAT"):
+    _REPEATS.add(sre_constants.POSSESSIVE_REPEAT)
+
+
+def trigrams(text: str) -> np.ndarray:
+    """Sorted unique trigram codes (3 x 21-bit code points) of ``text.lower()``."""
+    if len(text) < 3:
+        return np.empty(0, dtype=np.uint64)
+    cps = np.frombuffer(text.lower().encode("utf-32-le"), dtype="<u4").astype(np.uint64)
+    if len(cps) < 3:
+        return np.empty(0, dtype=np.uint64)
+    return np.unique((cps[:-2] << np.uint64(42)) | (cps[1:-1] << np.uint64(21)) | cps[2:])
+
+
+def required_literals(pattern: str, flags: int = 0) -> List[str]:
+    """Literal runs that every match of ``pattern`` contains.
+
+    Walks the parsed pattern: consecutive literals (across groups and
+    zero-width assertions) form a run; alternations, classes, wildcards and
+    optional parts end it. Repeats with a minimum of one contribute their own
+    runs. An empty list means no narrowing is possible.
+    """
+    runs: List[str] = []
+
+    def flush(run: List[str]) -> None:
+        if len(run) >= 3:
+            runs.append("".join(run))
+
+    def walk(seq: Iterable[Tuple[Any, Any]], run: List[str]) -> List[str]:
+        for op, av in seq:
+            if op is sre_constants.LITERAL:
+                run.append(chr(av))
+            elif op is sre_constants.AT:
+                continue
+            elif op is sre_constants.SUBPATTERN:
+                run = walk(av[-1], run)
+            else:
+                flush(run)
+                run = []
+                if op in _REPEATS and av[0] >= 1:
+                    flush(walk(av[2], []))
+        return run
+
+    flush(walk(sre_parse.parse(pattern, flags), []))
+    return runs
+
+
+def regex_matcher(pattern: "re.Pattern[str]") -> Matcher:
+    def find_all(text: str) -> Iterator[Tuple[int, int]]:
+        for m in pattern.finditer(text):
+            yield m.span()
+
+    return find_all
+
+
+def substring_matcher(needle: str, ignore_case: bool = True) -> Matcher:
+    """Non-overlapping occurrences of ``needle``; str.find on lower-cased text is
+    several times faster than an IGNORECASE regex."""
+    fallback = regex_matcher(re.compile(re.escape(needle), re.IGNORECASE if ignore_case else 0))
+    n = needle.lower() if ignore_case else needle
+
+    def find_all(text: str) -> Iterator[Tuple[int, int]]:
+        hay = text.lower() if ignore_case else text
+        if len(hay) != len(text) or len(n) != len(needle):
+            # lower() changed some lengths (rare non-ASCII); offsets would drift
+            yield from fallback(text)
+            return
+        i = hay.find(n)
+        while i >= 0:
+            yield i, i + len(n)
+            i = hay.find(n, i + max(1, len(n)))
+
+    return find_all
+
+
+def match_files(root: Path, files: Iterable[str], matcher: Matcher, limit: int = 100) -> Dict[str, Any]:
+    """Every match in ``files`` (relative to ``root``), with 1-based line/column, up to ``limit``."""
+    hits: List[Dict[str, Any]] = []
+    scanned = 0
+    truncated = False
+    for rel in files:
+        try:
+            text = (root / rel).read_text(encoding="utf-8", errors="ignore")
+        except OSError:
+            continue
+        scanned += 1
+        line, last = 1, 0
+        for i, end in matcher(text):
+            line += text.count("\n", last, i)
+            last = i
+            hits.append({
+                "file": rel,
+                "line": line,
+                "column": i - text.rfind("\n", 0, i),
+                "match": text[i:min(end, i + 200)],
+                "snippet": text[max(0, i - 80) : i + 80].replace("\n", " "),
+            })
+            if len(hits) >= limit:
+                truncated = True
+                break
+        if truncated:
+            break
+    return {"hits": hits, "files_scanned": scanned, "truncated": truncated}
+
+
+class RegexTimeout(TimeoutError):
+    pass
+
+
+def _regex_worker(conn: Any) -> None:
+    while True:
+        try:
+            root, files, pattern, flags, limit = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(match_files(Path(root), files, regex_matcher(re.compile(pattern, flags)), limit))
+        except Exception as exc:
+            conn.send({"error": str(exc)})
+
+
+class RegexRunner:
+    """Matches regexes in up to ``workers`` processes, each search within ``timeout`` seconds.
+
+    Workers are started on demand (spawned: safe from threaded servers) and
+    reused; the wait for a free worker counts against the deadline too.
+    """
+
+    def __init__(self, timeout: float = 2.0, workers: int = 2):
+        self.timeout = timeout
+        self.kills = 0
+        self._ctx = multiprocessing.get_context("spawn")
+        self._slots = threading.BoundedSemaphore(max(1, workers))
+        self._idle: List[Tuple[Any, Any]] = []
+        self._lock = threading.Lock()
+
+    def _worker(self) -> Tuple[Any, Any]:
+        with self._lock:
+            while self._idle:
+                proc, conn = self._idle.pop()
+                if proc.is_alive():
+                    return proc, conn
+        parent, child = self._ctx.Pipe()
+        proc = self._ctx.Process(target=_regex_worker, args=(child,), name="rag-regex", daemon=True)
+        proc.start()
+        child.close()
+        return proc, parent
+
+    def search(self, root: Path, files: List[str], pattern: str, flags: int = 0, limit: int = 100) -> Dict[str, Any]:
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RegexTimeout(f"no regex worker free within {self.timeout}s")
+        try:
+            proc, conn = self._worker()
+            # the deadline covers the match, not a worker's start-up
+            conn.send((str(root), files, pattern, flags, limit))
+            if not conn.poll(self.timeout):
+                proc.kill()
+                proc.join()
+                conn.close()
+                self.kills += 1
+                raise RegexTimeout(f"regex search exceeded {self.timeout}s")
+            try:
+                res = conn.recv()
+            except EOFError:
+                # the worker died (e.g. out of memory): start a new one next time
+                conn.close()
+                raise RuntimeError("regex worker exited")
+            with self._lock:
+                self._idle.append((proc, conn))
+        finally:
+            self._slots.release()
+        if "error" in res:
+            raise ValueError(res["error"])
+        return res
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for proc, conn in idle:
+            conn.close()
+            proc.join(1)
+            if proc.is_alive():
+                proc.kill()
+
+
+class TrigramIndex:
+    def __init__(self, root: Path, path: Optional[Path] = None, suffixes: Iterable[str] = (".sol",)):
+        self.root = Path(root)
+        self.path = path
+        self.suffixes = tuple(suffixes)
+        # rel -> (size, mtime_ns, trigram codes)
+        self.files: Dict[str, Tuple[int, int, np.ndarray]] = {}
+        self.postings: Dict[int, Set[str]] = {}
+        self.refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    @classmethod
+    def load(cls, root: Path, path: Path, suffixes: Iterable[str] = (".sol",)) -> "TrigramIndex":
+        """Open the index saved at ``path`` for ``root``; empty if missing or stale."""
+        index = cls(root, path, suffixes)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(data["manifest"].tobytes().decode("utf-8"))
+                codes = data["codes"]
+        except (OSError, KeyError, ValueError):
+            return index
+        if (
+            meta.get("format") != TRIGRAM_FORMAT
+            or meta.get("version") != TRIGRAM_VERSION
+            or meta.get("root") != str(index.root)
+        ):
+            return index
+        pos = 0
+        for rel, size, mtime_ns, count in meta["files"]:
+            index._add(rel, size, mtime_ns, codes[pos : pos + count])
+            pos += count
+        return index
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        files = sorted(self.files.items())
+        meta = {
+            "format": TRIGRAM_FORMAT,
+            "version": TRIGRAM_VERSION,
+            "root": str(self.root),
+            "files": [[rel, size, mtime_ns, len(codes)] for rel, (size, mtime_ns, codes) in files],
+        }
+        codes = np.concatenate([c for _, (_, _, c) in files]) if files else np.empty(0, dtype=np.uint64)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as fh:
+            np.savez(fh, manifest=np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8), codes=codes)
+        os.replace(tmp, self.path)
+
+    # ------------------------------------------------------------------
+    def _add(self, rel: str, size: int, mtime_ns: int, codes: np.ndarray) -> None:
+        self.files[rel] = (size, mtime_ns, codes)
+        for code in codes.tolist():
+            s = self.postings.get(code)
+            if s is None:
+                self.postings[code] = {rel}
+            else:
+                s.add(rel)
+
+    def _remove(self, rel: str) -> None:
+        entry = self.files.pop(rel, None)
+        if entry is None:
+            return
+        for code in entry[2].tolist():
+            s = self.postings.get(code)
+            if s is not None:
+                s.discard(rel)
+                if not s:
+                    del self.postings[code]
+
+    def _scan(self) -> Dict[str, Tuple[Path, int, int]]:
+        out: Dict[str, Tuple[Path, int, int]] = {}
+        for suffix in self.suffixes:
+            for p in self.root.rglob(f"*{suffix}"):
+                try:
+                    st = p.stat()
+                    if p.is_file():
+                        out[str(p.relative_to(self.root))] = (p, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+        return out
+
+    @staticmethod
+    def _read_codes(path: Path) -> Optional[np.ndarray]:
+        try:
+            return trigrams(path.read_text(encoding="utf-8", errors="ignore"))
+        except OSError:
+            return None
+
+    def refresh(self, max_workers: int = 8) -> Dict[str, int]:
+        """Re-index files whose size/mtime changed and drop deleted ones; saves if anything changed."""
+        current = self._scan()
+        with self._lock:
+            removed = [rel for rel in self.files if rel not in current]
+            todo = [
+                (rel, p, size, mtime_ns)
+                for rel, (p, size, mtime_ns) in current.items()
+                if self.files.get(rel, (None, None))[:2] != (size, mtime_ns)
+            ]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            loaded = list(pool.map(self._read_codes, [t[1] for t in todo]))
+        stats = {"added": 0, "changed": 0, "removed": len(removed), "unchanged": len(current) - len(todo)}
+        with self._lock:
+            for rel in removed:
+                self._remove(rel)
+            for (rel, _p, size, mtime_ns), codes in zip(todo, loaded):
+                stats["changed" if rel in self.files else "added"] += 1
+                self._remove(rel)
+                if codes is not None:
+                    self._add(rel, size, mtime_ns, codes)
+            if removed or todo:
+                self.save()
+            self.refreshed_at = time.time()
+        return stats
+
+    # ------------------------------------------------------------------
+    def candidates(self, literals: Iterable[str]) -> List[str]:
+        """Files containing every trigram of ``literals`` (all files if there are none)."""
+        with self._lock:
+            sets: List[Set[str]] = []
+            for lit in literals:
+                for code in trigrams(lit).tolist():
+                    s = self.postings.get(code)
+                    if s is None:
+                        return []
+                    sets.append(s)
+            if not sets:
+                return sorted(self.files)
+            sets.sort(key=len)
+            out = set(sets[0])
+            for s in sets[1:]:
+                out &= s
+                if not out:
+                    break
+            return sorted(out)
+
+    def search(self, matcher: Matcher, literals: Iterable[str], limit: int = 100) -> Dict[str, Any]:
+        """Every match in the candidate files, with 1-based line/column."""
+        cands = self.candidates(literals)
+        return dict(match_files(self.root, cands, matcher, limit), candidates=len(cands))
+
+    def search_regex(self, runner: RegexRunner, pattern: str, flags: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """search() for an untrusted regex: matched by ``runner`` (may raise RegexTimeout)."""
+        cands = self.candidates(required_literals(pattern, flags))
+        return dict(runner.search(self.root, cands, pattern, flags, limit), candidates=len(cands))
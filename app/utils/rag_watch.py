@@ -0,0 +1,303 @@
+"""Background filesystem watcher that keeps the RAG index live.
+
+Provides:
+- SourceWatcher: watches source roots (inotify on Linux, stat polling
+  elsewhere or when inotify is unavailable), debounces bursts of changes
+  (e.g. a git checkout) and hands them to a callback on its own thread
+
+The callback is expected to run an incremental re-index; request threads never
+wait on it. A batch whose callback raises is kept (with any newer changes) and
+retried after retry_backoff seconds, doubling up to max_backoff while it keeps
+failing. status() reports the lag: how long the oldest change the served index
+does not cover yet has been waiting (0 once indexed_through reaches
+last_change).
+"""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# inotify(7) event bits
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = struct.Struct("iIII")
+
+OnChange = Callable[[Set[str]], None]
+
+
+class _Inotify:
+    """Minimal recursive inotify wrapper over libc via ctypes (Linux only)."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+        self.dirs: Dict[int, Path] = {}
+
+    def watch_tree(self, root: Path) -> None:
+        for dirpath, _dirnames, _files in os.walk(root):
+            self._watch_dir(Path(dirpath))
+
+    def _watch_dir(self, path: Path) -> None:
+        wd = self._add(self.fd, os.fsencode(str(path)), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT:
+                return
+            raise OSError(err, f"inotify_add_watch failed for {path}")
+        self.dirs[wd] = path
+
+    def read(self, timeout: float) -> List[Tuple[Path, int]]:
+        """Changed paths since the last read; a Q_OVERFLOW yields the root dirs."""
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        out: List[Tuple[Path, int]] = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, pos)
+            raw = data[pos + _EVENT.size : pos + _EVENT.size + length].rstrip(b"\0")
+            pos += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                out.extend((p, IN_Q_OVERFLOW) for p in self.dirs.values())
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            base = self.dirs.get(wd)
+            if base is None:
+                continue
+            path = base / os.fsdecode(raw) if raw else base
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # new subtree (mkdir, git checkout of a directory): watch it and
+                # report the files it already contains
+                self.watch_tree(path)
+                out.extend((p, IN_CREATE) for p in path.rglob("*") if p.is_file())
+            out.append((path, mask))
+        return out
+
+    def close(self) -> None:
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class SourceWatcher:
+    def __init__(
+        self,
+        roots: Iterable[Path],
+        on_change: OnChange,
+        suffixes: Optional[Set[str]] = None,
+        debounce: float = 1.0,
+        max_delay: float = 10.0,
+        poll_interval: float = 2.0,
+        use_inotify: bool = True,
+        retry_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.roots = [Path(r) for r in roots if r]
+        self.on_change = on_change
+        self.suffixes = {s.lower() for s in suffixes} if suffixes else None
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and sys.platform.startswith("linux")
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.backend = "none"
+
+        self._stop = threading.Event()
+        self._kick = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pending: Set[str] = set()
+        self._first_pending: Optional[float] = None
+        self._last_event: Optional[float] = None
+        # oldest change the index does not cover yet (pending or being synced)
+        self._stale_since: Optional[float] = None
+        self._retry_at: Optional[float] = None
+        self.failures = 0
+
+        self.last_change: Optional[float] = None
+        self.indexed_through: Optional[float] = None
+        self.last_sync: Optional[float] = None
+        self.last_sync_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.syncs = 0
+
+    # ------------------------------------------------------------------
+    def start(self) -> "SourceWatcher":
+        self._thread = threading.Thread(target=self._run, name="rag-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._kick.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def trigger(self, reason: str = "manual") -> None:
+        """Schedule a sync without a filesystem event (e.g. after the root changed)."""
+        self._record([reason])
+        self._kick.set()
+
+    # ------------------------------------------------------------------
+    def _relevant(self, path: Path) -> bool:
+        return self.suffixes is None or path.suffix.lower() in self.suffixes or path.suffix == ""
+
+    def _record(self, paths: Iterable[str]) -> None:
+        paths = list(paths)
+        if not paths:
+            return
+        now = time.time()
+        with self._lock:
+            self._pending.update(paths)
+            if self._first_pending is None:
+                self._first_pending = now
+            if self._stale_since is None:
+                self._stale_since = now
+            self._last_event = now
+            self.last_change = now
+
+    def _due(self) -> Optional[float]:
+        """Seconds until the pending batch should be flushed (0 = now), None if idle."""
+        with self._lock:
+            if not self._pending:
+                return None
+            now = time.time()
+            quiet = self._last_event + self.debounce - now
+            hard = self._first_pending + self.max_delay - now
+            retry = self._retry_at - now if self._retry_at is not None else 0.0
+            return max(0.0, min(quiet, hard), retry)
+
+    def _flush(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, set()
+            first, through = self._first_pending, self._last_event
+            self._first_pending = self._last_event = None
+        started = time.time()
+        try:
+            self.on_change(batch)
+        except Exception as exc:
+            self.last_error = str(exc)
+            self.failures += 1
+            # put the batch back (changes recorded meanwhile join it) and retry later
+            with self._lock:
+                self._pending |= batch
+                self._first_pending = min(first, self._first_pending or first)
+                self._last_event = max(through, self._last_event or through)
+                self._retry_at = time.time() + min(self.max_backoff, self.retry_backoff * 2 ** (self.failures - 1))
+        else:
+            with self._lock:
+                self.indexed_through = through
+                self._stale_since = self._first_pending
+                self._retry_at = None
+            self.failures = 0
+            self.last_error = None
+        self.syncs += 1
+        self.last_sync = time.time()
+        self.last_sync_seconds = self.last_sync - started
+
+    def _run(self) -> None:
+        inotify = None
+        if self.use_inotify:
+            try:
+                inotify = _Inotify()
+                for root in self.roots:
+                    inotify.watch_tree(root)
+                self.backend = "inotify"
+            except OSError:
+                # e.g. fs.inotify.max_user_watches exhausted: fall back to polling
+                if inotify is not None:
+                    inotify.close()
+                inotify = None
+        if inotify is None:
+            self.backend = "poll"
+            snapshot = self._snapshot()
+        try:
+            while not self._stop.is_set():
+                due = self._due()
+                if due == 0.0:
+                    self._flush()
+                    continue
+                wait = self.poll_interval if due is None else min(due, self.poll_interval)
+                if inotify is not None:
+                    changed = [str(p) for p, mask in inotify.read(wait) if mask & IN_Q_OVERFLOW or self._relevant(p)]
+                    self._record(changed)
+                else:
+                    self._kick.wait(wait)
+                    current = self._snapshot()
+                    changed = [p for p in current.keys() | snapshot.keys() if current.get(p) != snapshot.get(p)]
+                    snapshot = current
+                    self._record(changed)
+                self._kick.clear()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        out: Dict[str, Tuple[int, int]] = {}
+        for root in self.roots:
+            for p in root.rglob("*"):
+                try:
+                    if self.suffixes is not None and p.suffix.lower() not in self.suffixes:
+                        continue
+                    st = p.stat()
+                    if p.is_file():
+                        out[str(p)] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+        return out
+
+    # ------------------------------------------------------------------
+    def status(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            pending = len(self._pending)
+            stale_since = self._stale_since
+            retry_at = self._retry_at
+        return {
+            "watching": self._thread is not None and self._thread.is_alive(),
+            "backend": self.backend,
+            "roots": [str(r) for r in self.roots],
+            "pending_changes": pending,
+            "last_change": self.last_change,
+            "indexed_through": self.indexed_through,
+            # how far the served index trails the newest change on disk
+            "lag_seconds": round(now - stale_since, 3) if stale_since is not None else 0.0,
+            "last_sync": self.last_sync,
+            "last_sync_seconds": self.last_sync_seconds,
+            "syncs": self.syncs,
+            "last_error": self.last_error,
+            "failures": self.failures,
+            "retry_in": round(max(0.0, retry_at - now), 3) if retry_at is not None else None,
+        }
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Benchmark: RAG index build throughput vs. number of worker processes.
+
+Usage:
+  python scripts/bench_rag_build.py [--files 50000] [--workers 1,2,4,8] [--corpus DIR]
+
+Generates a synthetic Solidity corpus (kept in --corpus if given, else a temp
+dir), then times, for each worker count:
+  - load:  read + hash + chunk + tokenize of every file (the parallel stage)
+  - build: a full RagIndex.sync, i.e. load plus the serial postings merge
+workers=1 is the in-process thread pool path used for small/incremental builds.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from app.utils.rag_chunking import chunk_source  # noqa: E402
+from app.utils.rag_index import RagIndex, SourceFile, load_sources  # noqa: E402
+from app.utils.rag_tokenizer import tokenize  # noqa: E402
+
+WORDS = (
+    "amount owner balance facet selector diamond storage slot reward liquidity pool "
+    "token transfer approve allowance role admin upgrade init dispatcher manifest"
+).split()
+
+
+def write_corpus(root: Path, n_files: int) -> None:
+    rng = random.Random(0)
+    for i in range(n_files):
+        d = root / f"pkg{i % 200:03d}"
+        d.mkdir(parents=True, exist_ok=True)
+        lines = [f"// SPDX-License-Identifier: MIT\npragma solidity ^0.8.20;\n\ncontract C{i} {{"]
+        for f in range(rng.randint(3, 12)):
+            body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120)))
+            lines.append(f"    function fn{f}_{rng.choice(WORDS)}(uint256 {rng.choice(WORDS)}) external {{\n        // {body}\n    }}")
+        lines.append("}\n")
+        (d / f"C{i}.sol").write_text("\n".join(lines), encoding="utf-8")
+
+
+def sources(root: Path):
+    return [SourceFile(p, str(p.relative_to(root)), "sol") for p in sorted(root.rglob("*.sol"))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--files", type=int, default=50_000)
+    ap.add_argument("--workers", default=",".join(str(w) for w in (1, 2, 4, 8, 16) if w <= (os.cpu_count() or 1)) or "1")
+    ap.add_argument("--corpus", type=Path, default=None)
+    args = ap.parse_args()
+
+    tmp = None
+    root = args.corpus
+    if root is None:
+        tmp = tempfile.TemporaryDirectory(prefix="rag-bench-")
+        root = Path(tmp.name)
+    if not any(root.rglob("*.sol")):
+        t0 = time.perf_counter()
+        write_corpus(root, args.files)
+        print(f"generated {args.files} files in {time.perf_counter() - t0:.1f}s under {root}")
+
+    srcs = sources(root)
+    items = [(s, {"rel": s.rel, "kind": s.kind}, None) for s in srcs]
+    print(f"files={len(srcs)} cpus={os.cpu_count()}")
+    print(f"{'workers':>7} {'load s':>8} {'speedup':>8} {'build s':>8} {'speedup':>8} {'chunks':>9}")
+    base_load = base_build = None
+    for w in (int(x) for x in args.workers.split(",")):
+        t0 = time.perf_counter()
+        chunks = sum(len(r[2]) for r in load_sources(items, chunk_source, tokenize, processes=w) if r)
+        load_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        RagIndex().sync(srcs, chunk_source, tokenize, processes=w)
+        build_s = time.perf_counter() - t0
+
+        base_load = base_load or load_s
+        base_build = base_build or build_s
+        print(f"{w:>7} {load_s:>8.2f} {base_load / load_s:>7.2f}x {build_s:>8.2f} {base_build / build_s:>7.2f}x {chunks:>9}")
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Benchmark: MaxScore-pruned vs exhaustive BM25 top-k on long queries.
+
+Usage:
+  python scripts/bench_rag_prune.py [--chunks 200000] [--vocab 50000] [--k 6]
+                                    [--lengths 2,4,8,16,32] [--queries 200]
+
+Builds a synthetic index whose term frequencies follow a Zipf law (so, as in
+real code, a few terms occur in most chunks and most terms are rare), writes
+it as a store generation and times MappedIndex.top_k with and without
+pruning, for queries of each length sampled from the chunks themselves. Every
+pruned result is checked against the exhaustive one.
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from app.utils.rag_index import RagIndex  # noqa: E402
+from app.utils.rag_store import open_store, write_store  # noqa: E402
+
+
+def build(n_chunks: int, n_vocab: int, rng: np.random.Generator):
+    index = RagIndex()
+    # Zipf(1.1) term ranks, truncated to the vocabulary
+    p = 1.0 / np.arange(1, n_vocab + 1) ** 1.1
+    p /= p.sum()
+    docs = []
+    for i in range(n_chunks // 10):
+        chunks = []
+        for j in range(10):
+            terms = rng.choice(n_vocab, size=rng.integers(20, 200), p=p)
+            uniq, counts = np.unique(terms, return_counts=True)
+            freqs = {f"t{t}": int(c) for t, c in zip(uniq, counts)}
+            docs.append(list(freqs))
+            chunks.append(({"id": f"f{i}#{j}", "source": f"f{i}.sol", "text": f"f{i}#{j}"}, freqs))
+        index.add_file(f"f{i}.sol", {"rel": f"f{i}.sol", "kind": "sol", "size": 0, "mtime": 0}, chunks)
+    index._refresh_idf()
+    return index, docs
+
+
+def timeit(fn, queries) -> float:
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chunks", type=int, default=200_000)
+    ap.add_argument("--vocab", type=int, default=50_000)
+    ap.add_argument("--k", type=int, default=6)
+    ap.add_argument("--lengths", default="2,4,8,16,32")
+    ap.add_argument("--queries", type=int, default=200)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    t0 = time.perf_counter()
+    index, docs = build(args.chunks, args.vocab, rng)
+    with tempfile.TemporaryDirectory(prefix="rag-prune-") as tmp:
+        write_store(index, Path(tmp))
+        store = open_store(Path(tmp))
+        print(f"{args.chunks} chunks, {len(index.vocab)} terms, built in {time.perf_counter() - t0:.1f}s; k={args.k}")
+        store.top_k(["t0", "t1"], args.k)  # term bounds are computed on first use
+
+        print(f"{'terms':>6} {'exhaustive':>12} {'pruned':>12} {'speedup':>8}")
+        for n in (int(s) for s in args.lengths.split(",")):
+            queries = [list(rng.choice(docs[rng.integers(len(docs))], size=n)) for _ in range(args.queries)]
+            for q in queries:
+                assert store.top_k(q, args.k) == store.top_k(q, args.k, prune=False), q
+            full = timeit(lambda q: store.top_k(q, args.k, prune=False), queries)
+            pruned = timeit(lambda q: store.top_k(q, args.k), queries)
+            print(f"{n:>6} {full * 1e3:>10.2f}ms {pruned * 1e3:>10.2f}ms {full / pruned:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
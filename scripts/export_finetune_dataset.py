@@ -10,22 +10,31 @@ Usage:
   set PYTHONPATH=%CD%  (Windows PowerShell: $env:PYTHONPATH = (Get-Location).Path )
   python scripts/export_finetune_dataset.py
 
+Reads the index of PRX_CONTRACTS_ROOT (default ./contracts), from the same
+per-root store under .rag_cache/roots/ the server builds it into.
+
 Notes:
   - This script does NOT call any model; 'output' fields are left blank for
     human / later model fill-in.
   - Adjust MAX_CHUNK_CHARS to cap record size for models with smaller context windows.
 """
 from __future__ import annotations
-import json, re
+import json, os, re, sys
 from pathlib import Path
 from typing import Iterable
 
 ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from app.utils.rag_registry import IndexRegistry  # noqa: E402
+from app.utils.rag_store import open_store  # noqa: E402
+
 CACHE_DIR = ROOT / '.rag_cache'
 DATASETS_DIR = ROOT / 'datasets'
 DATASETS_DIR.mkdir(exist_ok=True)
 
-DOCS_JSON = CACHE_DIR / 'docs.json'
+CONTRACTS_ROOT = Path(os.getenv('PRX_CONTRACTS_ROOT', ROOT / 'contracts')).resolve()
+# one store per contracts root, located like server/main.py does
+STORE_DIR = IndexRegistry(CACHE_DIR / 'roots').store_dir(CONTRACTS_ROOT)
 
 MAX_CHUNK_CHARS = 1800  # keep examples compact
 
@@ -33,7 +42,7 @@ FUNC_RE = re.compile(r"function\s+([A-Za-z0-9_]+)\s*\(([^)]*)\)[^{;]*?{", re.MUL
 
 
 def iter_sol_files() -> Iterable[Path]:
-    for p in (ROOT / 'contracts').rglob('*.sol'):
+    for p in CONTRACTS_ROOT.rglob('*.sol'):
         if p.is_file():
             yield p
 
@@ -82,7 +91,7 @@ def export_function_signatures():
                 line_idx = text[:char_pos].count('\n')
                 surrounding = grab_surrounding(lines, line_idx)
                 rec = {
-                    "file": str(sol.relative_to(ROOT)),
+                    "file": str(sol.relative_to(CONTRACTS_ROOT.parent)),
                     "signature": sig_full,
                     "surrounding_code": surrounding[:MAX_CHUNK_CHARS],
                     "instruction": "Explain the purpose of this Solidity function.",
@@ -93,11 +102,11 @@ def export_function_signatures():
 
 
 def main():
-    if not DOCS_JSON.exists():
-        raise SystemExit("RAG docs.json not found. Run scripts/rag_build.py first.")
-    chunks = json.loads(DOCS_JSON.read_text(encoding='utf-8'))
-    raw_path = export_raw_chunks(chunks)
-    sum_path = export_summarization(chunks)
+    store = open_store(STORE_DIR)
+    if store is None:
+        raise SystemExit(f"RAG index for {CONTRACTS_ROOT} not found. Run scripts/rag_build.py first.")
+    raw_path = export_raw_chunks(store.iter_docs())
+    sum_path = export_summarization(store.iter_docs())
     func_path = export_function_signatures()
     print("Export complete:")
     print(" -", raw_path)
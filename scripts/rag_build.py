@@ -2,31 +2,43 @@
 """Build the local BM25 RAG index for the PayRox-Go-Beyond contracts.
 
 Usage:
-  python scripts/rag_build.py
+  python scripts/rag_build.py [--incremental] [--root DIR]
 
-Creates .rag_cache/docs.json and bm25.pkl for retrieval endpoints /rag/ask.
+Indexes DIR (default: the repo's contracts/) and writes a memory-mapped index
+generation to that root's store, .rag_cache/roots/<name>-<hash>/index/, which
+the retrieval endpoints (/rag/ask, ?root=) read. The root is switched the way
+POST /admin/set-root does it, so the store and trigram index follow it.
+With --incremental only files added/changed since the last build are re-chunked.
+Full builds stream to disk; PRX_RAG_BUILD_MEMORY_MB caps the in-memory postings buffer.
 """
+import argparse
 from pathlib import Path
 from server import main as m
 
 def main():
     repo_root = Path(__file__).resolve().parents[1]
-    contracts_dir = repo_root / 'contracts'
-    if not contracts_dir.exists():
+    parser = argparse.ArgumentParser(description="Build the local BM25 RAG index.")
+    parser.add_argument('--incremental', action='store_true', help="only re-chunk files added/changed since the last build")
+    parser.add_argument('--root', type=Path, default=repo_root / 'contracts', help="contracts root to index")
+    args = parser.parse_args()
+    contracts_dir = args.root.resolve()
+    if not contracts_dir.is_dir():
         raise SystemExit(f"Contracts directory not found: {contracts_dir}")
-    # Point server module globals at repo contracts
-    m.CONTRACTS_ROOT = contracts_dir.resolve()
+    # Point the server at the root: CONTRACTS_ROOT, STORE_DIR and SEARCH_INDEX_PATH together
+    m.admin_set_root(str(contracts_dir))
     # Build
-    info = m.rag_build()
-    print(f"Indexed {info['indexed_chunks']} chunks from {info['source_root']}")
-    cache_dir = repo_root / '.rag_cache'
-    if cache_dir.exists():
-        print(f"Cache directory created: {cache_dir}")
-        docs_json = cache_dir / 'docs.json'
-        if docs_json.exists():
-            print(f"docs.json size: {docs_json.stat().st_size} bytes")
+    info = m.rag_build(incremental=args.incremental)
+    print(f"Indexed {info['indexed_chunks']} chunks from {info['source_root']} (files: {info['files']})")
+    build = info['build']
+    print(f"Build took {build['seconds']}s, peak RSS {build['peak_rss_mb']} MB"
+          + (f", {build['segments']} postings segment(s)" if 'segments' in build else ""))
+    gen_dir = m.STORE_DIR / m.SNAPSHOT.generation if m.SNAPSHOT is not None else None
+    if gen_dir is not None and gen_dir.exists():
+        size = sum(p.stat().st_size for p in gen_dir.iterdir())
+        print(f"Store directory: {m.STORE_DIR}")
+        print(f"index generation {m.SNAPSHOT.generation} size: {size} bytes")
     else:
-        print("Cache directory not found after build.")
+        print(f"No index generation found under {m.STORE_DIR} after build.")
 
 if __name__ == '__main__':
     main()
@@ -2,26 +2,60 @@ from __future__ import annotations
 
 import os
 import json
-import pickle
 import re
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Literal, Optional, Tuple
 import subprocess
+import threading
+import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Query, Body
+from fastapi import FastAPI, HTTPException, Query, Body, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from rank_bm25 import BM25Okapi
-from ollama import Client
+import anyio
+from starlette.concurrency import run_in_threadpool
+
+from app.utils.llm_cache import CACHE_MODES, LlmCache
+from app.utils.llm_gateway import LlmGateway
+from app.utils.llm_scheduler import LlmScheduler, QueueFull
+from app.utils.rag_builder import peak_rss_bytes, reset_peak_rss, stream_build
+from app.utils.rag_cache import RetrievalCache, query_key
+from app.utils.rag_chunking import chunk_source
+from app.utils.rag_dense import EmbeddingCache, build_dense, hybrid_top_k, load_dense, make_embedder, write_dense
+from app.utils.rag_filters import DocFilter, payrox_bucket
+from app.utils.rag_index import RagIndex, SourceFile, doc_sources
+from app.utils.rag_registry import IndexRegistry
+from app.utils.rag_store import (
+    IndexSnapshot, MappedIndex, current_generation, open_snapshot, open_store, to_rag_index, write_store,
+)
+from app.utils.rag_tokenizer import tokenize
+from app.utils.rag_trigram import RegexRunner, RegexTimeout, TrigramIndex, substring_matcher
+from app.utils.rag_watch import SourceWatcher
 
 # -----------------------------------------------------------------------------
 # App
 # -----------------------------------------------------------------------------
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    global LLM
+    _on_startup()
+    yield
+    _on_shutdown()
+    REGEX_RUNNER.close()
+    with _LLM_LOCK:
+        llm, LLM = LLM, None
+    # the next lifespan (or _llm() call) builds a fresh pool
+    if llm is not None:
+        await llm.aclose()
+
+
 app = FastAPI(
     title="Contracts RAG",
     version="1.3.0",
     openapi_version="3.1.0",
     openapi_url="/openapi.json",
+    lifespan=_lifespan,
 )
 
 # Optional CORS (safe localhost defaults)
@@ -49,20 +83,6 @@ except Exception:
 # default k=8 (tunable via `k` query param)
 # ~4k token context window (model-dependent)
 
-# Solidity chunking
-FUNC_SPLIT = re.compile(r"(?=^\s*(contract|library|interface|function|event|struct|modifier)\b)", re.M)
-
-
-def chunk_text(text: str, size: int = 1500, overlap: int = 150) -> List[str]:
-    out: List[str] = []
-    step = max(1, size - overlap)
-    text_len = len(text)
-    for i in range(0, text_len, step):
-        out.append(text[i : i + size])
-        if i + size >= text_len:
-            break
-    return out
-
 
 # -----------------------------------------------------------------------------
 # Globals / helpers (minimal defaults so module imports cleanly)
@@ -85,14 +105,203 @@ SCRIPTS_ROOT = Path(SCRIPTS_ROOT_ENV).resolve() if SCRIPTS_ROOT_ENV else None
 
 INDEX_DIR = Path('.rag_cache')
 INDEX_DIR.mkdir(exist_ok=True)
-DOCS_JSON = INDEX_DIR / 'docs.json'
-BM25_PKL = INDEX_DIR / 'bm25.pkl'
 
-BM25 = None
-DOCS: List[Dict[str, Any]] = []
+# One store per contracts root, under INDEX_DIR/roots/<name>-<hash>/. Snapshots of
+# recently used roots stay open (least recently used first out once they hold more
+# than PRX_RAG_ROOTS_MB of index data), so switching back to a root is instant and
+# retrieval endpoints can query any built root with ?root=. STORE_DIR is the
+# current root's store; builds write there.
+REGISTRY = IndexRegistry(
+    INDEX_DIR / 'roots',
+    max_bytes=int(float(os.getenv('PRX_RAG_ROOTS_MB', '1024')) * 1024 * 1024),
+    opener=lambda store_dir: _open_snapshot(store_dir),
+)
+STORE_DIR = REGISTRY.store_dir(CONTRACTS_ROOT)
+
+# The served index: one immutable snapshot of a store generation (opened from
+# STORE_DIR). Only ever replaced through _publish_snapshot(); readers take a
+# local reference once per request and never look at the global again.
+SNAPSHOT: Optional[IndexSnapshot] = None
+_SNAPSHOT_LOCK = threading.Lock()
+
+# _retrieve() result cache; bumped whenever SNAPSHOT is replaced
+RETRIEVAL_CACHE = RetrievalCache(
+    max_entries=int(os.getenv('PRX_RAG_CACHE_ENTRIES', '512')),
+    max_bytes=int(float(os.getenv('PRX_RAG_CACHE_MB', '64')) * 1024 * 1024),
+)
+
+# Most queries accepted by one POST /contracts/search-index/batch request
+RAG_BATCH_MAX = int(os.getenv('PRX_RAG_BATCH_MAX', '64'))
+
+# Optional dense retrieval fused with BM25: PRX_RAG_DENSE=ollama embeds chunks with
+# PRX_RAG_EMBED_MODEL on OLLAMA_HOST, =hash uses a local stand-in. Embeddings are
+# cached by chunk content hash, so rebuilds only embed new chunks.
+# PRX_RAG_DENSE_WEIGHT is the BM25 share of the fused score.
+RAG_DENSE = os.getenv('PRX_RAG_DENSE', '')
+RAG_EMBED_MODEL = os.getenv('PRX_RAG_EMBED_MODEL', 'nomic-embed-text')
+RAG_DENSE_WEIGHT = float(os.getenv('PRX_RAG_DENSE_WEIGHT', '0.5'))
+# embeddings go through the shared (pooled) LLM gateway client
+EMBEDDER = make_embedder(RAG_DENSE, RAG_EMBED_MODEL, OLLAMA_HOST, client=lambda: _llm().client)
+EMBED_CACHE = EmbeddingCache(INDEX_DIR / 'embeddings', EMBEDDER.name) if EMBEDDER is not None else None
+
+# Builds mutate a private RagIndex and publish it as a new store generation;
+# requests are always served from the read-only mapped generation.
+_BUILDER: Optional[RagIndex] = None
+_BUILDER_GENERATION: Optional[str] = None
+_BUILD_LOCK = threading.Lock()
+
+# Worker processes for chunking/tokenizing during builds (<= 1: threads only)
+RAG_BUILD_WORKERS = int(os.getenv('PRX_RAG_BUILD_WORKERS', str(os.cpu_count() or 1)))
+# Postings buffered in memory by a full (streaming) build before spilling a segment
+RAG_BUILD_MEMORY_MB = float(os.getenv('PRX_RAG_BUILD_MEMORY_MB', '256'))
+
+# Optional background watcher that keeps the index in sync with the source roots
+RAG_WATCH = os.getenv('PRX_RAG_WATCH', '0').lower() in ('1', 'true', 'yes')
+RAG_WATCH_DEBOUNCE = float(os.getenv('PRX_RAG_WATCH_DEBOUNCE', '1.0'))
+WATCHER: Optional[SourceWatcher] = None
+
+# Optional warm-up at startup, so the first requests after a deploy do not pay for
+# it: PRX_RAG_PRELOAD=1 opens the index, answers each PRX_RAG_WARMUP_QUERIES entry
+# (';'-separated, or @path for one query per line) at each PRX_RAG_WARMUP_K to fill
+# RETRIEVAL_CACHE, and sends PRX_WARMUP_MODEL (empty: skip) an empty generate so
+# Ollama loads it and keeps it for PRX_WARMUP_KEEP_ALIVE. GET /health stays the
+# liveness check; GET /health/ready answers 503 until warm-up has finished.
+RAG_PRELOAD = os.getenv('PRX_RAG_PRELOAD', '0').lower() in ('1', 'true', 'yes')
+RAG_WARMUP_QUERIES = os.getenv('PRX_RAG_WARMUP_QUERIES', '')
+RAG_WARMUP_K = [int(k) for k in os.getenv('PRX_RAG_WARMUP_K', '8,20,4').split(',') if k.strip()]
+WARMUP_MODEL = os.getenv('PRX_WARMUP_MODEL', 'codellama:7b')
+WARMUP_KEEP_ALIVE = os.getenv('PRX_WARMUP_KEEP_ALIVE', '30m')
+WARMUP: Dict[str, Any] = {"state": "pending" if RAG_PRELOAD else "ready"}
+
+# Trigram index behind /contracts/search, persisted next to the RAG store. Without
+# the watcher, searches re-stat the tree at most every PRX_SEARCH_RESCAN_SECONDS.
+SEARCH_INDEX_PATH = REGISTRY.root_dir(CONTRACTS_ROOT) / 'trigram.npz'
+SEARCH_RESCAN_SECONDS = float(os.getenv('PRX_SEARCH_RESCAN_SECONDS', '1.0'))
+SEARCH_INDEX: Optional[TrigramIndex] = None
+_SEARCH_LOCK = threading.Lock()
+_SEARCH_REFRESH = threading.Lock()
+# Regex searches come from unauthenticated requests: patterns are capped at
+# PRX_SEARCH_REGEX_MAX_LEN characters and matched in PRX_SEARCH_REGEX_WORKERS worker
+# processes, each search killed after PRX_SEARCH_REGEX_TIMEOUT seconds (408).
+SEARCH_REGEX_MAX_LEN = int(os.getenv('PRX_SEARCH_REGEX_MAX_LEN', '256'))
+REGEX_RUNNER = RegexRunner(
+    timeout=float(os.getenv('PRX_SEARCH_REGEX_TIMEOUT', '2.0')),
+    workers=int(os.getenv('PRX_SEARCH_REGEX_WORKERS', '2')),
+)
 
 NETWORK = os.getenv('PRX_NETWORK', 'localhost')
 
+# One gateway to Ollama per process (pooled sync + async clients, created in the
+# lifespan) instead of a new client and connection pool per request.
+# PRX_LLM_MAX_CONNECTIONS / PRX_LLM_MAX_KEEPALIVE bound the pool, PRX_LLM_TIMEOUT
+# is the read timeout of one call in seconds (0: none) and PRX_LLM_KEEP_ALIVE how
+# long Ollama keeps a model loaded after a call (unset: the server's default).
+LLM_MAX_CONNECTIONS = int(os.getenv('PRX_LLM_MAX_CONNECTIONS', '16'))
+LLM_MAX_KEEPALIVE = int(os.getenv('PRX_LLM_MAX_KEEPALIVE', '8'))
+LLM_TIMEOUT = float(os.getenv('PRX_LLM_TIMEOUT', '600'))
+LLM_KEEP_ALIVE = os.getenv('PRX_LLM_KEEP_ALIVE') or None
+# Concurrent identical async generate requests share one upstream generation
+LLM_COALESCE = os.getenv('PRX_LLM_COALESCE', '1').lower() not in ('0', 'false', 'no', 'off')
+
+# LLM admission control: at most PRX_LLM_CONCURRENCY generations per model run at
+# once (PRX_LLM_MODEL_CONCURRENCY="model=n,..." overrides it per model), up to
+# PRX_LLM_QUEUE more wait, /rag/ask first, and beyond that requests get a 429 with
+# Retry-After instead of piling up in Ollama's own queue.
+LLM_SCHEDULER = LlmScheduler(
+    concurrency=int(os.getenv('PRX_LLM_CONCURRENCY', '2')),
+    max_queue=int(os.getenv('PRX_LLM_QUEUE', '32')),
+    limits={
+        name.strip(): int(n)
+        for name, _, n in (item.rpartition('=') for item in os.getenv('PRX_LLM_MODEL_CONCURRENCY', '').split(','))
+        if name.strip()
+    },
+)
+
+# Persistent LLM response cache (SQLite, INDEX_DIR/llm_cache.sqlite) keyed by model,
+# model digest, prompt, format and options; PRX_LLM_CACHE=0 turns it off. Requests
+# sampled at temperature <= PRX_LLM_CACHE_MAX_TEMPERATURE are cached by default and
+# the endpoints' cache=auto|use|refresh|bypass overrides that per request. Entries
+# expire after PRX_LLM_CACHE_TTL seconds; the least recently used go once the cache
+# holds more than PRX_LLM_CACHE_MB.
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv('PRX_LLM_CACHE_MAX_TEMPERATURE', '0.1'))
+LLM_CACHE = (
+    LlmCache(
+        INDEX_DIR / 'llm_cache.sqlite',
+        max_bytes=int(float(os.getenv('PRX_LLM_CACHE_MB', '256')) * 1024 * 1024),
+        ttl=float(os.getenv('PRX_LLM_CACHE_TTL', str(7 * 24 * 3600))),
+    )
+    if os.getenv('PRX_LLM_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+    else None
+)
+LLM: Optional[LlmGateway] = None
+_LLM_LOCK = threading.Lock()
+
+
+def _llm() -> LlmGateway:
+    """The shared LLM gateway; created on first use when the lifespan did not run (scripts, tests)."""
+    global LLM
+    with _LLM_LOCK:
+        if LLM is None:
+            LLM = LlmGateway(
+                OLLAMA_HOST,
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive=LLM_MAX_KEEPALIVE,
+                timeout=LLM_TIMEOUT or None,
+                keep_alive=LLM_KEEP_ALIVE,
+                cache=LLM_CACHE,
+                cache_max_temperature=LLM_CACHE_MAX_TEMPERATURE,
+                coalesce=LLM_COALESCE,
+                scheduler=LLM_SCHEDULER,
+            )
+        return LLM
+
+
+def _llm_busy(exc: QueueFull) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(exc), headers={"Retry-After": str(exc.retry_after)})
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _sse_response(request: Request, meta: Dict[str, Any], **generate: Any) -> StreamingResponse:
+    """A generation streamed as Server-Sent Events.
+
+    Events: ``meta`` (sent before the model starts, e.g. used_chunks), one
+    ``token`` per part Ollama produces, then ``done`` with Ollama's timing
+    stats, or ``error``. When the client goes away the upstream request is
+    closed, which makes Ollama stop generating. A full LLM queue is answered
+    with a 429 before the stream starts.
+    """
+    try:
+        _llm().admit(generate["model"], generate.get("priority", "batch"))
+    except QueueFull as exc:
+        raise _llm_busy(exc)
+
+    async def events():
+        yield _sse("meta", meta)
+        parts = _llm().astream(**generate)
+        try:
+            async for part in parts:
+                if await request.is_disconnected():
+                    break
+                if part.get("response"):
+                    yield _sse("token", {"response": part["response"]})
+                if part.get("done"):
+                    yield _sse("done", {k: v for k, v in part.items() if k not in ("response", "context")})
+        except QueueFull as exc:
+            yield _sse("error", {"detail": str(exc), "retry_after": exc.retry_after})
+        except Exception as exc:
+            yield _sse("error", {"detail": f"Ollama error: {exc}"})
+        finally:
+            # also runs when the response task is cancelled on disconnect
+            with anyio.CancelScope(shield=True):
+                await parts.aclose()
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 class EchoIn(BaseModel):
     text: str
@@ -129,22 +338,6 @@ NODE_BIN = os.getenv('NODE_BIN', 'node')
 REPO_ROOT = Path(os.getenv('REPO_ROOT', '.')).resolve()
 
 
-def tokenize(s: str) -> List[str]:
-    return [tok for tok in re.findall(r"\w+", s.lower())]
-
-
-def split_solidity(text: str) -> List[str]:
-    # Split on common Solidity tokens, fallback to chunk_text
-    parts = [p.strip() for p in FUNC_SPLIT.split(text) if p and p.strip()]
-    if not parts:
-        return chunk_text(text)
-    out: List[str] = []
-    for p in parts:
-        for c in chunk_text(p, size=1500, overlap=150):
-            out.append(c)
-    return out
-
-
 def _load_pinned_context() -> str:
     try:
         # Prefer PRX_PINNED_FILE, then ARCH facts.json as a fallback
@@ -157,17 +350,16 @@ def _load_pinned_context() -> str:
     return ""
 
 
-def _scan_scripts_docs() -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
+def _index_sources() -> List[SourceFile]:
+    """Files covered by the RAG index: contracts (*.sol) + scripts/docs if PRX_SCRIPTS_ROOT set."""
+    out = [SourceFile(p, str(p.relative_to(CONTRACTS_ROOT)), 'sol') for p in CONTRACTS_ROOT.rglob('*.sol')]
     if not SCRIPTS_ROOT:
         return out
     exts = {'.ts', '.js', '.json', '.md'}
     for p in SCRIPTS_ROOT.rglob('*'):
         try:
             if p.suffix.lower() in exts and p.is_file():
-                text = p.read_text(encoding='utf-8', errors='ignore')
-                rel = str(p.relative_to(SCRIPTS_ROOT))
-                out.append({'id': rel, 'text': text[:8000], 'source': rel})
+                out.append(SourceFile(p, str(p.relative_to(SCRIPTS_ROOT)), 'script'))
         except Exception:
             continue
     return out
@@ -187,48 +379,221 @@ def _read_text_safely(p: Path) -> str:
         raise HTTPException(status_code=404, detail=f'File not found: {p}')
 
 
-def _retrieve(query: str, k: int = 6) -> List[Dict[str, Any]]:
-    global BM25, DOCS
-    if BM25 is None or not DOCS:
-        if not _load_index_if_present():
-            raise HTTPException(status_code=400, detail="Index not built. POST /rag/build first.")
-    scores = BM25.get_scores(tokenize(query))
-    top = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
-    return [DOCS[i] | {"score": float(scores[i])} for i in top]
+def _pin_snapshot(root: Optional[Path] = None) -> IndexSnapshot:
+    """The snapshot a request should use from start to finish.
+
+    Picks up a generation published by another worker; raises 400 when no
+    index has been built yet. ``root`` selects another root's index (REGISTRY).
+    """
+    if root is not None and root != CONTRACTS_ROOT:
+        snap = REGISTRY.get(root)
+        if snap is None or not snap.n_live:
+            raise HTTPException(status_code=400, detail=f"No index for {root}. Switch to it with POST /admin/set-root and POST /rag/build first.")
+        return snap
+    snap = SNAPSHOT
+    if snap is None or snap.generation != current_generation(STORE_DIR):
+        snap = _load_index_if_present() or snap
+    if snap is None or not snap.n_live:
+        raise HTTPException(status_code=400, detail="Index not built. POST /rag/build first.")
+    return snap
+
+
+def _rank(
+    snap: IndexSnapshot,
+    tokens: List[str],
+    qvec: Optional[Any],
+    k: int,
+    min_score: Optional[float],
+    lexical: Optional[Tuple[Any, Any]] = None,
+    filters: Optional[DocFilter] = None,
+) -> List[Dict[str, Any]]:
+    """Hits for one tokenized query on ``snap``; ``lexical`` is its BM25 score() if already computed.
+
+    ``lexical`` must have been scored within ``filters`` too. A filtered hit
+    reports the first of its files that passes the filter (DocFilter.locate).
+    """
+    within = snap.index.attributes.mask(filters)
+    # identical chunks are indexed once; the hit names every file containing it
+    hits = []
+    if qvec is not None:
+        top, scores, bm25, dense = hybrid_top_k(
+            snap.index, snap.dense, tokens, qvec, k, weight=RAG_DENSE_WEIGHT, min_score=min_score,
+            lexical=lexical, within=within,
+        )
+        for i, s, b, d in zip(top, scores, bm25, dense):
+            doc = filters.locate(snap.docs[i]) if filters else snap.docs[i]
+            hits.append(doc | {"score": float(s), "bm25": b, "dense": d, "sources": doc_sources(doc)})
+    else:
+        if lexical is not None:
+            top, scores = snap.index.select(*lexical, k, min_score=min_score, within=within)
+        else:
+            top, scores = snap.index.top_k(tokens, k, min_score=min_score, within=within)
+        for i, s in zip(top, scores):
+            doc = filters.locate(snap.docs[i]) if filters else snap.docs[i]
+            hits.append(doc | {"score": float(s), "sources": doc_sources(doc)})
+    return hits
+
+
+def _filter_key(filters: Optional[DocFilter]) -> Tuple[Any, ...]:
+    return filters.key() if filters else ()
+
+
+def _retrieve(
+    query: str,
+    k: int = 6,
+    min_score: Optional[float] = None,
+    filters: Optional[DocFilter] = None,
+    root: Optional[Path] = None,
+) -> List[Dict[str, Any]]:
+    snap = _pin_snapshot(root)
+    tokens = tokenize(query)
+    # keyed by generation directory (unique across roots), so hits scored on a
+    # snapshot that was swapped out mid-request can never be served for the new one
+    key = (snap.index.path, snap.dense is not None) + query_key(tokens, k, min_score) + _filter_key(filters)
+    cached = RETRIEVAL_CACHE.get(key)
+    if cached is not None:
+        return cached
+    qvec = None
+    if snap.dense is not None:
+        try:
+            qvec = EMBEDDER.embed([query])[0]
+        except Exception:
+            pass  # embedding backend unavailable: answer from BM25 alone, uncached
+    hits = _rank(snap, tokens, qvec, k, min_score, filters=filters)
+    if qvec is not None or snap.dense is None:
+        RETRIEVAL_CACHE.put(key, hits)
+    return hits
+
+
+def _retrieve_batch(
+    queries: List[str],
+    k: int = 6,
+    min_score: Optional[float] = None,
+    filters: Optional[DocFilter] = None,
+    root: Optional[Path] = None,
+) -> List[List[Dict[str, Any]]]:
+    """_retrieve() for several queries against one pinned snapshot.
+
+    Cached queries are answered from RETRIEVAL_CACHE; the rest are BM25-scored
+    together (Bm25Scorer.score_batch) and, with dense retrieval on, embedded in
+    a single call. Results equal per-query _retrieve().
+    """
+    snap = _pin_snapshot(root)
+    tokens = [tokenize(q) for q in queries]
+    keys = [(snap.index.path, snap.dense is not None) + query_key(t, k, min_score) + _filter_key(filters) for t in tokens]
+    out: List[Optional[List[Dict[str, Any]]]] = [RETRIEVAL_CACHE.get(key) for key in keys]
+    todo = [i for i, hits in enumerate(out) if hits is None]
+    if not todo:
+        return out
+    qvecs = None
+    if snap.dense is not None:
+        try:
+            qvecs = EMBEDDER.embed([queries[i] for i in todo])
+        except Exception:
+            pass  # as in _retrieve: BM25 alone, uncached
+    within = snap.index.attributes.mask(filters)
+    lexical = snap.index.score_batch([tokens[i] for i in todo], within=within)
+    for j, i in enumerate(todo):
+        qvec = qvecs[j] if qvecs is not None else None
+        out[i] = _rank(snap, tokens[i], qvec, k, min_score, lexical=lexical[j], filters=filters)
+        if qvec is not None or snap.dense is None:
+            RETRIEVAL_CACHE.put(keys[i], out[i])
+    return out
 
 
 def _payrox_bucket_for_file(file_path: str) -> str:
     """Lightweight heuristic: map file path to a small bucket used as a hint.
 
-    Buckets: core, administrative, liquidity, rewards, misc
+    Buckets: core, administrative, liquidity, rewards, misc. The index stores
+    the same classification per chunk for bucket-filtered retrieval.
     """
-    p = file_path.lower()
-    if 'liquid' in p or 'liquidity' in p:
-        return 'liquidity'
-    if 'reward' in p or 'distrib' in p:
-        return 'rewards'
-    if 'admin' in p or 'govern' in p:
-        return 'administrative'
-    if 'core' in p or 'impl' in p:
-        return 'core'
-    return 'misc'
-
-
-def _load_index_if_present() -> bool:
-    """Try to lazily load a persisted DOCS/BM25 index from disk.
-
-    Returns True if loaded, False otherwise.
+    return payrox_bucket(file_path)
+
+
+def _doc_filter(bucket: Optional[str], path_prefix: Optional[str], ext: Optional[str]) -> Optional[DocFilter]:
+    try:
+        filters = DocFilter.of(bucket=bucket, path_prefix=path_prefix, ext=ext)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return filters or None
+
+
+def _index_root(root: Optional[str]) -> Optional[Path]:
+    """The ``root`` query parameter of retrieval endpoints, resolved like /admin/set-root does.
+
+    Only the current root and roots served before (registered by /admin/set-root)
+    can be queried; anything else is a 400.
     """
-    global BM25, DOCS
+    if not root:
+        return None
+    p = Path(root).resolve()
+    if p != CONTRACTS_ROOT and not (p.is_dir() and REGISTRY.known(p)):
+        raise HTTPException(status_code=400, detail=f"Unknown contracts root: {p}. Switch to it with POST /admin/set-root first.")
+    return p
+
+
+def _publish_snapshot(snap: Optional[IndexSnapshot]) -> None:
+    """Make ``snap`` the served index with a single reference swap.
+
+    Requests already running keep the snapshot they pinned; new ones see
+    ``snap``. There is no window in which no index (or half of one) is served.
+    """
+    global SNAPSHOT
+    SNAPSHOT = snap
+    RETRIEVAL_CACHE.bump()
+
+
+def _store_dense(gen_dir: Path) -> Dict[str, Any]:
+    """Build the embedding matrix of the generation in ``gen_dir`` and store it there (dense retrieval on).
+
+    Runs where generations are written (builds, before they are published), never
+    in a request. Chunks already in EMBED_CACHE are not re-embedded. If the
+    embedding backend fails, the generation is served BM25-only and the error is
+    reported.
+    """
+    if EMBEDDER is None:
+        return {}
     try:
-        if DOCS_JSON.exists() and BM25_PKL.exists():
-            DOCS = json.loads(DOCS_JSON.read_text(encoding="utf-8"))
-            with open(BM25_PKL, "rb") as f:
-                BM25 = pickle.load(f)
-            return True
-    except Exception:
-        pass
-    return False
+        dense, info = build_dense(MappedIndex(gen_dir), EMBEDDER, EMBED_CACHE)
+        write_dense(gen_dir, dense)
+    except Exception as exc:
+        return {"model": EMBEDDER.name, "error": str(exc)}
+    return info
+
+
+def _open_snapshot(store_dir: Path) -> Optional[IndexSnapshot]:
+    """open_snapshot() with the generation's stored embedding matrix (memory-mapped), if any."""
+    return open_snapshot(store_dir, EMBEDDER.name if EMBEDDER is not None else None)
+
+
+def _backfill_dense() -> None:
+    """Store the embedding matrix of a generation written without one (older builds)."""
+    with _BUILD_LOCK:
+        gen = current_generation(STORE_DIR)
+        if gen is None or load_dense(STORE_DIR / gen, EMBEDDER.name) is not None:
+            return
+        _store_dense(STORE_DIR / gen)
+        with _SNAPSHOT_LOCK:
+            _publish_snapshot(_open_snapshot(STORE_DIR))
+
+
+def _load_index_if_present() -> Optional[IndexSnapshot]:
+    """Try to lazily open the persisted (memory-mapped) index from STORE_DIR.
+
+    Returns the published snapshot, or None if there is no usable store.
+    """
+    with _SNAPSHOT_LOCK:
+        snap = SNAPSHOT
+        # concurrent requests that noticed the same new generation open it once
+        if snap is not None and snap.generation == current_generation(STORE_DIR):
+            return snap
+        try:
+            snap = _open_snapshot(STORE_DIR)
+        except Exception:
+            return None
+        if snap is not None:
+            _publish_snapshot(snap)
+        return snap
 
 
 def run_cmd(cmd: List[str], cwd: Optional[Path] = None, timeout: int = 60) -> Tuple[int, str, str]:
@@ -356,11 +721,13 @@ def health():
         scripts_root_str = ""
 
     try:
-        indexed_flag = (BM25 is not None) and bool(DOCS)
-        doc_chunks = len(DOCS) if DOCS else 0
+        snap = SNAPSHOT
+        indexed_flag = snap is not None and snap.n_live > 0
+        doc_chunks = snap.n_live if snap is not None else 0
+        chunk_occurrences = snap.n_chunks if snap is not None else 0
     except Exception:
         indexed_flag = False
-        doc_chunks = 0
+        doc_chunks = chunk_occurrences = 0
 
     try:
         pinned_len = len(PINNED_CONTEXT or "")
@@ -374,10 +741,28 @@ def health():
         "pinned_bytes": pinned_len,
         "indexed": indexed_flag,
         "doc_chunks": doc_chunks,
+        "dedup": {
+            "chunk_occurrences": chunk_occurrences,
+            "unique_chunks": doc_chunks,
+            # occurrences per indexed chunk (1.0 = no duplicates)
+            "dedup_ratio": round(chunk_occurrences / doc_chunks, 3) if doc_chunks else None,
+        },
         "scripts_root": scripts_root_str,
+        "retrieval_cache": RETRIEVAL_CACHE.stats(),
+        "llm_cache": LLM_CACHE.stats() if LLM_CACHE is not None else None,
+        "llm": LLM.stats() if LLM is not None else None,
+        "llm_queue": LLM_SCHEDULER.stats(),
+        "ready": WARMUP["state"] == "ready",
     }
 
 
+@app.get("/health/ready")
+def health_ready():
+    """Readiness: 503 until the startup warm-up has finished (/health is liveness)."""
+    ready = WARMUP["state"] == "ready"
+    return JSONResponse(status_code=200 if ready else 503, content=dict(WARMUP, ready=ready))
+
+
 @app.post("/kb/reload")
 def kb_reload() -> dict:
     global PINNED_CONTEXT
@@ -404,16 +789,40 @@ def admin_get_root():
     return {"contracts_root": str(CONTRACTS_ROOT)}
 
 
+@app.get("/admin/roots")
+def admin_roots():
+    """Roots with an index store, and which of them are loaded (REGISTRY)."""
+    return {"contracts_root": str(CONTRACTS_ROOT), "roots": REGISTRY.roots(), "registry": REGISTRY.stats()}
+
+
 @app.post("/admin/set-root")
 def admin_set_root(new_root: str = Body(..., embed=True)):
-    global CONTRACTS_ROOT, BM25, DOCS
+    """Serve ``new_root``'s index: the loaded snapshot if it was used recently, else its store."""
+    global CONTRACTS_ROOT, STORE_DIR, SEARCH_INDEX_PATH, _BUILDER
     p = Path(new_root).resolve()
     if not p.exists() or not p.is_dir():
         raise HTTPException(status_code=400, detail=f"Path not found: {p}")
-    CONTRACTS_ROOT = p
-    # reset in-memory index so users remember to rebuild
-    BM25, DOCS = None, []
-    return {"contracts_root": str(CONTRACTS_ROOT), "indexed": False}
+    # wait for a running build: it writes to the current root's store
+    with _BUILD_LOCK:
+        if SNAPSHOT is not None:
+            REGISTRY.put(CONTRACTS_ROOT, SNAPSHOT)
+        CONTRACTS_ROOT = p
+        STORE_DIR = REGISTRY.store_dir(p)
+        SEARCH_INDEX_PATH = REGISTRY.root_dir(p) / 'trigram.npz'
+        # the builder mirrors the old root's store
+        _BUILDER = None
+        snap = REGISTRY.get(p)
+        with _SNAPSHOT_LOCK:
+            _publish_snapshot(snap)
+    if WATCHER is not None:
+        # the watcher follows the new root and re-indexes it in the background
+        _start_watcher()
+    return {
+        "contracts_root": str(CONTRACTS_ROOT),
+        "indexed": snap is not None and snap.n_live > 0,
+        "index_generation": snap.generation if snap is not None else None,
+        "reindexing": WATCHER is not None,
+    }
 
 
 # -----------------------------------------------------------------------------
@@ -458,27 +867,40 @@ def list_contracts(
 def search_contracts(
     q: str = Query(..., min_length=1),
     limit: int = Query(100, ge=1, le=1000),
+    regex: bool = Query(False, description="Treat q as a Python regular expression (^/$ match per line)"),
+    case_sensitive: bool = Query(False),
 ):
-    hits: List[dict] = []
-    ql = q.lower()
-    for p in CONTRACTS_ROOT.rglob("*.sol"):
+    """Substring or regex search over CONTRACTS_ROOT/*.sol, reporting every hit with its line.
+
+    The trigram index narrows the files to read; only candidates are matched.
+    """
+    if regex:
+        if len(q) > SEARCH_REGEX_MAX_LEN:
+            raise HTTPException(status_code=400, detail=f"Regex longer than {SEARCH_REGEX_MAX_LEN} characters.")
+        flags = re.MULTILINE | (0 if case_sensitive else re.IGNORECASE)
         try:
-            text = p.read_text(encoding="utf-8", errors="ignore")
-        except Exception:
-            continue
-        tl = text.lower()
-        if ql in tl:
-            i = tl.index(ql)
-            snippet = text[max(0, i - 80) : i + 80].replace("\n", " ")
-            hits.append({"file": str(p.relative_to(CONTRACTS_ROOT)), "snippet": snippet})
-            if len(hits) >= limit:
-                break
-    return {"root": str(CONTRACTS_ROOT), "query": q, "count": len(hits), "results": hits}
+            re.compile(q, flags)
+        except re.error as exc:
+            raise HTTPException(status_code=400, detail=f"Invalid regex: {exc}")
+        try:
+            res = _search_index().search_regex(REGEX_RUNNER, q, flags, limit)
+        except RegexTimeout as exc:
+            raise HTTPException(status_code=408, detail=f"Regex search stopped: {exc}")
+    else:
+        res = _search_index().search(substring_matcher(q, ignore_case=not case_sensitive), [q], limit)
+    return {
+        "root": str(CONTRACTS_ROOT),
+        "query": q,
+        "regex": regex,
+        "count": len(res["hits"]),
+        "truncated": res["truncated"],
+        "candidates": res["candidates"],
+        "files_scanned": res["files_scanned"],
+        "results": res["hits"],
+    }
 
 
-@app.get("/contracts/search-index")
-def search_index(q: str = Query(..., min_length=2), k: int = Query(20, ge=1, le=100)):
-    hits = _retrieve(q, k=k)
+def _search_index_result(q: str, hits: List[Dict[str, Any]]) -> Dict[str, Any]:
     return {
         "query": q,
         "count": len(hits),
@@ -489,6 +911,46 @@ def search_index(q: str = Query(..., min_length=2), k: int = Query(20, ge=1, le=
     }
 
 
+@app.get("/contracts/search-index")
+def search_index(
+    q: str = Query(..., min_length=2),
+    k: int = Query(20, ge=1, le=100),
+    min_score: Optional[float] = Query(None, ge=0, description="Drop chunks scoring below this BM25 score"),
+    bucket: Optional[str] = Query(None, description="Only chunks of files in this bucket (core, administrative, liquidity, rewards, misc)"),
+    path_prefix: Optional[str] = Query(None, description="Only chunks of files under this path prefix"),
+    ext: Optional[str] = Query(None, description="Only chunks of files with this extension (e.g. sol)"),
+    root: Optional[str] = Query(None, description="Contracts root to query (default: the current root); it must have been built"),
+):
+    filters = _doc_filter(bucket, path_prefix, ext)
+    return _search_index_result(q, _retrieve(q, k=k, min_score=min_score, filters=filters, root=_index_root(root)))
+
+
+class SearchIndexBatchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, description="Queries to run (at most PRX_RAG_BATCH_MAX)")
+    k: int = Field(20, ge=1, le=100)
+    min_score: Optional[float] = Field(None, ge=0, description="Drop chunks scoring below this BM25 score")
+    bucket: Optional[str] = Field(None, description="Only chunks of files in this bucket")
+    path_prefix: Optional[str] = Field(None, description="Only chunks of files under this path prefix")
+    ext: Optional[str] = Field(None, description="Only chunks of files with this extension (e.g. sol)")
+    root: Optional[str] = Field(None, description="Contracts root to query (default: the current root)")
+
+
+@app.post("/contracts/search-index/batch")
+def search_index_batch(req: SearchIndexBatchRequest):
+    """Several /contracts/search-index queries in one request, scored together."""
+    if len(req.queries) > RAG_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {RAG_BATCH_MAX} queries per batch")
+    short = [i for i, q in enumerate(req.queries) if len(q) < 2]
+    if short:
+        raise HTTPException(status_code=422, detail=f"Queries must be at least 2 characters (index {short[0]})")
+    filters = _doc_filter(req.bucket, req.path_prefix, req.ext)
+    results = _retrieve_batch(req.queries, k=req.k, min_score=req.min_score, filters=filters, root=_index_root(req.root))
+    return {
+        "count": len(results),
+        "results": [_search_index_result(q, hits) for q, hits in zip(req.queries, results)],
+    }
+
+
 @app.get("/contracts/read")
 def read_contract(path: str = Query(...)):
     abs_path = _safe_path(path)
@@ -531,16 +993,27 @@ def list_selectors(limit_files: int = 200):
 # Compatibility shim expected by some UIs
 # -----------------------------------------------------------------------------
 @app.post("/api/analyze")
-def api_analyze(body: dict):
-    """Accepts { prompt, model?, max_tokens? } and returns {"model","response","raw"}."""
+async def api_analyze(body: dict, request: Request):
+    """Accepts { prompt, model?, max_tokens?, stream?, cache? } and returns {"model","response","raw"}.
+
+    With ``stream: true`` the response is Server-Sent Events (see _sse_response).
+    ``cache`` is the LLM response cache policy (auto, use, refresh, bypass).
+    """
     prompt = body.get("prompt") or body.get("query") or body.get("q")
     if not prompt:
         raise HTTPException(status_code=400, detail="Missing 'prompt' in request body.")
     model = body.get("model", "codellama:7b")
     max_tokens = int(body.get("max_tokens", 256))
-    client = Client()
+    cache = body.get("cache", "auto")
+    if cache not in CACHE_MODES:
+        raise HTTPException(status_code=400, detail=f"'cache' must be one of {', '.join(CACHE_MODES)}")
+    generate = dict(model=model, prompt=prompt, options={"num_predict": max_tokens}, cache=cache)
+    if body.get("stream"):
+        return _sse_response(request, {"model": model}, **generate)
     try:
-        resp = client.generate(model=model, prompt=prompt, options={"num_predict": max_tokens})
+        resp = await _llm().agenerate(**generate)
+    except QueueFull as exc:
+        raise _llm_busy(exc)
     except Exception as exc:
         raise HTTPException(status_code=502, detail=f"AI backend error: {exc}")
     return {"model": model, "response": resp.get("response", ""), "raw": resp}
@@ -548,106 +1021,232 @@ def api_analyze(body: dict):
 # -----------------------------------------------------------------------------
 # RAG (build + ask)
 # -----------------------------------------------------------------------------
+def _build_index(incremental: bool, empty_detail: str) -> Dict[str, Any]:
+    """Build (or incrementally update) the BM25 index and publish it to STORE_DIR.
+
+    A full build streams chunks and postings to disk (stream_build), so memory
+    stays within PRX_RAG_BUILD_MEMORY_MB plus the files being loaded (at most
+    two batches per loader worker, see load_sources). An
+    incremental build reuses this process's builder (or rehydrates one from the
+    current store generation) and only re-chunks files whose sha256 changed;
+    without a store it builds fully. Builds are serialized and never touch the
+    served snapshot: queries keep running against it until the new generation
+    is on disk and published with one swap. The response reports the build's
+    peak RSS.
+    """
+    global _BUILDER, _BUILDER_GENERATION
+    with _BUILD_LOCK:
+        reset_peak_rss()
+        started = time.time()
+        index = None
+        if incremental:
+            if _BUILDER is not None and _BUILDER_GENERATION == current_generation(STORE_DIR):
+                index = _BUILDER
+            else:
+                store = open_store(STORE_DIR)
+                if store is not None:
+                    index = to_rag_index(store)
+
+        # a build that fails halfway leaves the builder unusable
+        _BUILDER = None
+        build: Dict[str, Any] = {}
+        dense_info: Dict[str, Any] = {}
+
+        def before_publish(gen_dir: Path) -> None:
+            dense_info.update(_store_dense(gen_dir))
+
+        if index is None:
+            info = stream_build(
+                _index_sources(), chunk_source, tokenize, STORE_DIR,
+                memory_limit_mb=RAG_BUILD_MEMORY_MB, processes=RAG_BUILD_WORKERS, before_publish=before_publish,
+            )
+            if info["generation"] is None:
+                raise HTTPException(status_code=404, detail=empty_detail)
+            stats = info["files"]
+            build = {"segments": info["segments"], "memory_limit_mb": info["memory_limit_mb"]}
+        else:
+            stats = index.sync(_index_sources(), chunk_source, tokenize, processes=RAG_BUILD_WORKERS)
+            _BUILDER, _BUILDER_GENERATION = index, current_generation(STORE_DIR)
+            if not index.n_live:
+                raise HTTPException(status_code=404, detail=empty_detail)
+            _BUILDER_GENERATION = write_store(index, STORE_DIR, before_publish=before_publish)
+
+        snap = _open_snapshot(STORE_DIR)
+        if dense_info:
+            build["dense"] = dense_info
+        with _SNAPSHOT_LOCK:
+            _publish_snapshot(snap)
+        peak = peak_rss_bytes()
+        build |= {
+            "seconds": round(time.time() - started, 3),
+            "peak_rss_mb": round(peak / 2**20, 1) if peak else None,
+        }
+    return {"indexed_chunks": snap.n_live, "incremental": index is not None, "files": stats, "build": build}
+
+
 @app.post("/rag/build")
-def rag_build() -> dict:
+def rag_build(incremental: bool = Query(False, description="Only re-chunk files added/changed since the last build")) -> dict:
     """Scan contracts folder in parallel, chunk, tokenize, and build a BM25 index."""
-    global BM25, DOCS
-    DOCS = []
+    info = _build_index(incremental, "No .sol files found to index.")
+    return info | {"source_root": str(CONTRACTS_ROOT)}
 
-    files = [p for p in CONTRACTS_ROOT.rglob("*.sol")]
 
-    def read_and_chunk(p: Path):
-        try:
-            text = p.read_text(encoding="utf-8", errors="ignore")
-            rel = str(p.relative_to(CONTRACTS_ROOT))
-            out = []
-            for i, chunk in enumerate(split_solidity(text)):
-                out.append({"id": f"{rel}#{i}", "text": chunk, "source": rel})
-            return out
-        except Exception:
-            return []
+@app.post("/rag/build_all")
+def rag_build_all(incremental: bool = Query(False, description="Only re-chunk files added/changed since the last build")) -> dict:
+    """Build index from contracts (*.sol) + scripts (ts/js/json/md if PRX_SCRIPTS_ROOT set)."""
+    info = _build_index(incremental, "No source files found to index.")
+    return info | {
+        "source_root": str(CONTRACTS_ROOT),
+        "scripts_root": (str(SCRIPTS_ROOT) if SCRIPTS_ROOT else None),
+    }
+
 
-    with ThreadPoolExecutor(max_workers=8) as ex:
-        futures = [ex.submit(read_and_chunk, p) for p in files]
-        for fut in as_completed(futures):
+def _search_index() -> TrigramIndex:
+    """The trigram index for the current CONTRACTS_ROOT, brought up to date if due.
+
+    Loading and rescanning happen outside _SEARCH_LOCK: one request refreshes
+    while the others search the index as it is (they only wait for the first
+    refresh of a freshly loaded index).
+    """
+    global SEARCH_INDEX
+    with _SEARCH_LOCK:
+        idx = SEARCH_INDEX
+    if idx is None or idx.root != CONTRACTS_ROOT:
+        loaded = TrigramIndex.load(CONTRACTS_ROOT, SEARCH_INDEX_PATH)
+        with _SEARCH_LOCK:
+            if SEARCH_INDEX is None or SEARCH_INDEX.root != loaded.root:
+                SEARCH_INDEX = loaded
+            idx = SEARCH_INDEX
+    # while the watcher runs it refreshes the index on every change
+    watched = WATCHER is not None and idx.refreshed_at is not None
+    if not watched and (idx.refreshed_at is None or time.time() - idx.refreshed_at >= SEARCH_RESCAN_SECONDS):
+        if _SEARCH_REFRESH.acquire(blocking=idx.refreshed_at is None):
             try:
-                DOCS.extend(fut.result())
-            except Exception:
-                continue
+                if idx.refreshed_at is None or time.time() - idx.refreshed_at >= SEARCH_RESCAN_SECONDS:
+                    idx.refresh()
+            finally:
+                _SEARCH_REFRESH.release()
+    return idx
 
-    # Backwards-compatible: if SCRIPTS_ROOT was set earlier, include scripts/docs
-    if SCRIPTS_ROOT:
-        try:
-            DOCS.extend(_scan_scripts_docs())
-        except Exception:
-            pass
 
-    if not DOCS:
-        raise HTTPException(status_code=404, detail="No .sol files found to index.")
+def _watch_sync(changed: set) -> None:
+    if SEARCH_INDEX is not None and SEARCH_INDEX.root == CONTRACTS_ROOT:
+        SEARCH_INDEX.refresh()
+    _build_index(True, "No source files found to index.")
 
-    token_lists = [tokenize(d["text"]) for d in DOCS]
-    BM25 = BM25Okapi(token_lists)
-    DOCS_JSON.write_text(json.dumps(DOCS, ensure_ascii=False), encoding="utf-8")
-    with open(BM25_PKL, "wb") as f:
-        pickle.dump(BM25, f)
-    return {"indexed_chunks": len(DOCS), "source_root": str(CONTRACTS_ROOT)}
 
+def _start_watcher() -> None:
+    """(Re)start the watcher on the current roots; any previous watcher is stopped."""
+    global WATCHER
+    if WATCHER is not None:
+        WATCHER.stop()
+    suffixes = {'.sol'} | ({'.ts', '.js', '.json', '.md'} if SCRIPTS_ROOT else set())
+    WATCHER = SourceWatcher(
+        [CONTRACTS_ROOT, SCRIPTS_ROOT], _watch_sync, suffixes=suffixes, debounce=RAG_WATCH_DEBOUNCE
+    ).start()
+    # pick up edits made while nobody was watching
+    WATCHER.trigger('start')
 
-@app.post("/rag/build_all")
-def rag_build_all() -> dict:
-    """Build index from contracts (*.sol) + scripts (ts/js/json/md if PRX_SCRIPTS_ROOT set)."""
-    global BM25, DOCS
-    DOCS = []
-    # Contracts
-    for p in CONTRACTS_ROOT.rglob("*.sol"):
-        try:
-            text = p.read_text(encoding="utf-8", errors="ignore")
-        except Exception:
-            continue
-        rel = str(p.relative_to(CONTRACTS_ROOT))
-        for i, chunk in enumerate(split_solidity(text)):
-            DOCS.append({"id": f"{rel}#{i}", "text": chunk, "source": rel})
-    # Scripts
-    DOCS.extend(_scan_scripts_docs())
 
-    if not DOCS:
-        raise HTTPException(status_code=404, detail="No source files found to index.")
+def _warmup_queries() -> List[str]:
+    spec = RAG_WARMUP_QUERIES.strip()
+    lines = Path(spec[1:]).read_text(encoding='utf-8').splitlines() if spec.startswith('@') else spec.split(';')
+    return [q.strip() for q in lines if q.strip()]
 
-    token_lists = [tokenize(d["text"]) for d in DOCS]
-    BM25 = BM25Okapi(token_lists)
 
-    DOCS_JSON.write_text(json.dumps(DOCS, ensure_ascii=False), encoding="utf-8")
-    with open(BM25_PKL, "wb") as f:
-        pickle.dump(BM25, f)
+def _warm_up() -> None:
+    """Open the index, prime RETRIEVAL_CACHE and load WARMUP_MODEL, then report ready.
 
-    return {
-        "indexed_chunks": len(DOCS),
-        "source_root": str(CONTRACTS_ROOT),
-        "scripts_root": (str(SCRIPTS_ROOT) if SCRIPTS_ROOT else None),
+    Failures are recorded in WARMUP but do not hold readiness back: an app that
+    cannot warm up serves exactly as it would have without warming up.
+    """
+    started = time.time()
+    errors: List[str] = []
+    WARMUP.update(state="running", errors=errors)
+    snap = _load_index_if_present()
+    WARMUP["index_generation"] = snap.generation if snap is not None else None
+    if snap is not None and snap.n_live:
+        try:
+            queries = _warmup_queries()
+            for k in RAG_WARMUP_K:
+                for q in queries:
+                    _retrieve(q, k=k)
+            WARMUP["queries"] = len(queries)
+        except Exception as exc:
+            errors.append(f"retrieval: {exc}")
+    if WARMUP_MODEL:
+        try:
+            _llm().generate(model=WARMUP_MODEL, prompt="", keep_alive=WARMUP_KEEP_ALIVE, cache="bypass")
+        except Exception as exc:
+            errors.append(f"model {WARMUP_MODEL}: {exc}")
+    WARMUP.update(state="ready", seconds=round(time.time() - started, 3))
+
+
+def _on_startup() -> None:
+    _llm()
+    if RAG_WATCH:
+        _start_watcher()
+    if RAG_PRELOAD:
+        # in the background: /health answers (liveness) while /health/ready is 503
+        threading.Thread(target=_warm_up, name="rag-warmup", daemon=True).start()
+    if EMBEDDER is not None:
+        threading.Thread(target=_backfill_dense, name="rag-dense", daemon=True).start()
+
+
+def _on_shutdown() -> None:
+    if WATCHER is not None:
+        WATCHER.stop()
+
+
+@app.get("/rag/status")
+def rag_status() -> dict:
+    """Served index generation and, when watching, how far it trails the source tree."""
+    snap = SNAPSHOT
+    out: Dict[str, Any] = {
+        "index_generation": snap.generation if snap is not None else None,
+        "indexed_chunks": snap.n_live if snap is not None else 0,
+        "watch_enabled": RAG_WATCH,
+        "roots": REGISTRY.stats(),
+        "dense": {
+            "enabled": EMBEDDER is not None,
+            "model": EMBEDDER.name if EMBEDDER is not None else None,
+            "attached": snap is not None and snap.dense is not None,
+            "cached_embeddings": len(EMBED_CACHE) if EMBED_CACHE is not None else 0,
+        },
     }
+    if WATCHER is not None:
+        out |= WATCHER.status()
+    return out
 
 
 @app.get("/diag/ollama")
-def diag_ollama():
+async def diag_ollama():
     try:
-        client = Client()  # uses OLLAMA_HOST or defaults to localhost:11434
-        listing = client.list()  # {'models': [...]} or similar
-        models = [m.get("name") or m.get("model") for m in listing.get("models", [])]
-        return {"ok": True, "models": models}
+        return {"ok": True, "models": await _llm().alist()}
     except Exception as exc:
         raise HTTPException(status_code=502, detail=f"Cannot reach Ollama: {exc}")
 
 
 @app.get("/rag/ask")
-def rag_ask(
+async def rag_ask(
+    request: Request,
     q: str = Query(..., min_length=3, description="Your question (no commands/URLs)"),
     model: str = Query("codellama:7b", description="Ollama model name"),
     k: int = Query(8, ge=1, le=12),
+    min_score: Optional[float] = Query(None, ge=0, description="Drop chunks scoring below this BM25 score"),
+    bucket: Optional[str] = Query(None, description="Only chunks of files in this bucket (core, administrative, liquidity, rewards, misc)"),
+    path_prefix: Optional[str] = Query(None, description="Only chunks of files under this path prefix"),
+    ext: Optional[str] = Query(None, description="Only chunks of files with this extension (e.g. sol)"),
+    root: Optional[str] = Query(None, description="Contracts root to query (default: the current root); it must have been built"),
+    stream: bool = Query(False, description="Answer as Server-Sent Events: used_chunks first, then tokens as they are generated"),
+    cache: Literal["auto", "use", "refresh", "bypass"] = Query("auto", description="LLM response cache: auto (deterministic requests only), use, refresh or bypass"),
 ):
     if re.search(r"(curl|http(s)?://|cmd\s*/c)", q, re.IGNORECASE):
         raise HTTPException(status_code=400, detail="Pass only the question text in 'q' (no commands/URLs).")
 
-    hits = _retrieve(q, k=k)
+    hits = await run_in_threadpool(
+        _retrieve, q, k=k, min_score=min_score, filters=_doc_filter(bucket, path_prefix, ext), root=_index_root(root)
+    )
     context = "\n\n---\n".join(f"[{h['source']}] {h['text']}" for h in hits)
 
     # add pinned facts and light bucket hints
@@ -664,26 +1263,42 @@ def rag_ask(
         f"BucketHints:\n{', '.join(bucket_hints)}\n\nAnswer:"
     )
 
+    used_chunks = [{"source": h["source"], "score": h["score"]} for h in hits]
+    if stream:
+        return _sse_response(
+            request, {"model": model, "used_chunks": used_chunks}, model=model, prompt=prompt, cache=cache, priority="interactive"
+        )
     try:
-        client = Client()
-        resp = client.generate(model=model, prompt=prompt, stream=False)
+        resp = await _llm().agenerate(model=model, prompt=prompt, stream=False, cache=cache, priority="interactive")
+    except QueueFull as exc:
+        raise _llm_busy(exc)
     except Exception as exc:
         raise HTTPException(status_code=502, detail=f"Ollama error: {exc}")
 
     return {
         "model": model,
         "answer": resp.get("response", ""),
-        "used_chunks": [{"source": h["source"], "score": h["score"]} for h in hits],
+        "used_chunks": used_chunks,
     }
 
 
 @app.get("/rag/ask-with-context")
-def rag_ask_with_context(
+async def rag_ask_with_context(
+    request: Request,
     q: str = Query(..., min_length=3),
     model: str = Query("codellama:7b"),
     k: int = Query(8, ge=1, le=12),
+    min_score: Optional[float] = Query(None, ge=0, description="Drop chunks scoring below this BM25 score"),
+    bucket: Optional[str] = Query(None, description="Only chunks of files in this bucket (core, administrative, liquidity, rewards, misc)"),
+    path_prefix: Optional[str] = Query(None, description="Only chunks of files under this path prefix"),
+    ext: Optional[str] = Query(None, description="Only chunks of files with this extension (e.g. sol)"),
+    root: Optional[str] = Query(None, description="Contracts root to query (default: the current root); it must have been built"),
+    stream: bool = Query(False, description="Answer as Server-Sent Events: used_chunks first, then tokens as they are generated"),
+    cache: Literal["auto", "use", "refresh", "bypass"] = Query("auto", description="LLM response cache: auto (deterministic requests only), use, refresh or bypass"),
 ):
-    hits = _retrieve(q, k=k)
+    hits = await run_in_threadpool(
+        _retrieve, q, k=k, min_score=min_score, filters=_doc_filter(bucket, path_prefix, ext), root=_index_root(root)
+    )
     context = "\n\n---\n".join(f"[{h['source']}] {h['text']}" for h in hits)
     pinned = _load_pinned_context()
     prompt = (
@@ -691,16 +1306,21 @@ def rag_ask_with_context(
         f"PinnedFacts:\n{pinned}\n\n"
         f"Question:\n{q}\n\nContext:\n{context}\n\nAnswer:"
     )
+    used_chunks = [{"source": h["source"], "score": h["score"]} for h in hits]
+    if stream:
+        meta = {"model": model, "used_chunks": used_chunks, "context": context}
+        return _sse_response(request, meta, model=model, prompt=prompt, cache=cache, priority="interactive")
     try:
-        client = Client()
-        resp = client.generate(model=model, prompt=prompt, stream=False)
+        resp = await _llm().agenerate(model=model, prompt=prompt, stream=False, cache=cache, priority="interactive")
+    except QueueFull as exc:
+        raise _llm_busy(exc)
     except Exception as exc:
         raise HTTPException(status_code=502, detail=f"Ollama error: {exc}")
 
     return {
         "model": model,
         "answer": resp.get("response", ""),
-        "used_chunks": [{"source": h["source"], "score": h["score"]} for h in hits],
+        "used_chunks": used_chunks,
         "context": context,
     }
 
@@ -709,10 +1329,16 @@ def rag_ask_with_context(
 # Diamond plan (JSON, CPU-friendly)
 # -----------------------------------------------------------------------------
 @app.get("/diamond/plan")
-def diamond_plan(
+async def diamond_plan(
     q: str = Query("Propose a Diamond manifest from the codebase"),
     model: str = Query("codellama:7b-instruct"),
     k: int = Query(4, ge=1, le=12),
+    min_score: Optional[float] = Query(None, ge=0, description="Drop chunks scoring below this BM25 score"),
+    bucket: Optional[str] = Query(None, description="Only chunks of files in this bucket (core, administrative, liquidity, rewards, misc)"),
+    path_prefix: Optional[str] = Query(None, description="Only chunks of files under this path prefix"),
+    ext: Optional[str] = Query(None, description="Only chunks of files with this extension (e.g. sol)"),
+    root: Optional[str] = Query(None, description="Contracts root to query (default: the current root); it must have been built"),
+    cache: Literal["auto", "use", "refresh", "bypass"] = Query("auto", description="LLM response cache: auto (deterministic requests only), use, refresh or bypass"),
 ):
     """
     Propose a Diamond (EIP-2535) facet plan as strict JSON.
@@ -722,7 +1348,9 @@ def diamond_plan(
     return STRICT JSON matching the schema. If the model output isn't valid
     JSON, _json_or_repair will attempt one repair pass.
     """
-    hits = _retrieve(q, k=k)
+    hits = await run_in_threadpool(
+        _retrieve, q, k=k, min_score=min_score, filters=_doc_filter(bucket, path_prefix, ext), root=_index_root(root)
+    )
     retrieved = "\n\n---\n".join(f"[{h['source']}] {h['text']}" for h in hits)
 
     # precompute dispatcher hint from facts.json (if present)
@@ -799,23 +1427,26 @@ Guidelines:
 - Use pinned facts for expected_hashes if present; otherwise add 'missing_info'.
 """
 
-    client = Client()
-    resp = client.generate(
-        model=model,
-        prompt=prompt,
-        format="json",
-        options={"temperature": 0.1, "num_ctx": 2048, "num_predict": 800},
-    )
+    try:
+        resp = await _llm().agenerate(
+            model=model,
+            prompt=prompt,
+            format="json",
+            options={"temperature": 0.1, "num_ctx": 2048, "num_predict": 800},
+            cache=cache,
+        )
+    except QueueFull as exc:
+        raise _llm_busy(exc)
     text = resp.get("response", "").strip()
 
     try:
-        plan = _json_or_repair(client, model, text, schema_txt)
+        plan = await _json_or_repair(model, text, schema_txt, cache)
         return {"plan": plan, "used_chunks": [{"source": h["source"], "score": h["score"]} for h in hits]}
     except Exception as e:
         return {"raw": text, "error": f"JSON parse failed: {e}", "used_chunks": [{"source": h["source"], "score": h["score"]} for h in hits]}
 
 
-def _json_or_repair(client: Client, model: str, raw_text: str, schema_txt: str) -> Any:
+async def _json_or_repair(model: str, raw_text: str, schema_txt: str, cache: str = "auto") -> Any:
     """Try to parse JSON, else ask model to repair once and parse.
 
     This is intentionally simple: one parse attempt, then one repair attempt via the model.
@@ -825,7 +1456,7 @@ def _json_or_repair(client: Client, model: str, raw_text: str, schema_txt: str)
     except Exception:
         # Ask model to output valid JSON only
         repair_prompt = f"The following output should be valid JSON matching this schema:\n{schema_txt}\n\nInvalid output:\n{raw_text}\n\nPlease output only valid JSON." 
-        resp = client.generate(model=model, prompt=repair_prompt, options={"temperature": 0.0, "num_predict": 512})
+        resp = await _llm().agenerate(model=model, prompt=repair_prompt, options={"temperature": 0.0, "num_predict": 512}, cache=cache)
         repaired = resp.get("response", "").strip()
         return json.loads(repaired)
 
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+from app.utils.llm_cache import LlmCache, cache_key, is_deterministic
+from app.utils.llm_gateway import LlmGateway
+from tests.test_llm_gateway import FakeOllama, ollama_host  # noqa: F401 - fixture
+
+
+def test_key_covers_the_request_but_not_transport_settings():
+    req = {"model": "m", "prompt": "p", "options": {"temperature": 0}}
+    assert cache_key(req, "d1") == cache_key(dict(req, stream=True, keep_alive="5m"), "d1")
+    assert cache_key(req, "d1") != cache_key(req, "d2")
+    assert cache_key(req, "d1") != cache_key(dict(req, format="json"), "d1")
+    assert cache_key(req, "d1") != cache_key(dict(req, options={"temperature": 0, "num_predict": 9}), "d1")
+    assert is_deterministic({"temperature": 0.1}) and not is_deterministic({"temperature": 0.8}) and not is_deterministic(None)
+
+
+def test_entries_expire_and_least_recently_used_go_first(tmp_path):
+    cache = LlmCache(tmp_path / "llm.sqlite", max_bytes=10_000, ttl=3600)
+    for i in range(3):
+        cache.put(f"k{i}", "m", {"response": "x" * 3000})
+    assert cache.get("k0") is not None  # k1 is now the least recently used
+    cache.put("k3", "m", {"response": "x" * 3000})
+    assert cache.get("k1") is None and cache.get("k0") is not None and cache.stats()["entries"] == 3
+
+    # another process (or a restart) sees the same entries
+    assert LlmCache(tmp_path / "llm.sqlite").get("k3") == {"response": "x" * 3000}
+    cache.ttl = 0.01
+    time.sleep(0.02)
+    assert cache.get("k3") is None
+
+
+def test_gateway_caches_deterministic_generations(tmp_path, ollama_host):  # noqa: F811
+    llm = LlmGateway(ollama_host, cache=LlmCache(tmp_path / "llm.sqlite"))
+    exact = {"model": "codellama:7b", "prompt": "plan", "options": {"temperature": 0}}
+
+    def calls():
+        return sum(1 for b in FakeOllama.bodies if b["prompt"] == "plan")
+
+    first = llm.generate(**exact)
+    assert llm.generate(**exact) == first and calls() == 1
+    llm.generate(cache="refresh", **exact)
+    llm.generate(cache="bypass", **exact)
+    assert calls() == 3 and llm.cache.stats()["hits"] == 1
+    # sampled answers only with cache=use
+    llm.generate(model="codellama:7b", prompt="plan")
+    llm.generate(model="codellama:7b", prompt="plan")
+    assert calls() == 5
+    llm.generate(model="codellama:7b", prompt="plan", cache="use")
+    llm.generate(model="codellama:7b", prompt="plan", cache="use")
+    assert calls() == 6
+
+    # a new build of the model (after the digest is looked up again) is not served old answers
+    FakeOllama.digest = "sha256:2"
+    llm._digests.clear()
+    llm.generate(**exact)
+    assert calls() == 7
+
+    async def stream_twice():
+        try:
+            return [[p async for p in llm.astream(**dict(exact, prompt="one two"))] for _ in range(2)]
+        finally:
+            await llm.aclose()
+
+    streamed, replayed = asyncio.run(stream_twice())
+    assert "".join(p["response"] for p in replayed) == "".join(p["response"] for p in streamed) == "one two "
+    assert replayed[-1]["done"] and replayed[-1]["eval_count"] == 3
+    assert sum(1 for b in FakeOllama.bodies if b["prompt"] == "one two") == 1
+
+
+def test_a_busy_cache_does_not_stall_the_event_loop(tmp_path, ollama_host):  # noqa: F811
+    llm = LlmGateway(ollama_host, cache=LlmCache(tmp_path / "llm.sqlite"))
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    async def main():
+        ticker = asyncio.ensure_future(tick())
+        try:
+            # another writer holds the database for 0.3s
+            with llm.cache._lock:
+                ask = asyncio.ensure_future(llm.agenerate(model="codellama:7b", prompt="x", options={"temperature": 0}))
+                await asyncio.sleep(0.3)
+            return (await ask)["response"]
+        finally:
+            ticker.cancel()
+            await llm.aclose()
+
+    assert asyncio.run(main()) == "echo x"
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.2
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.utils.llm_gateway import LlmGateway
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    wbufsize = 1 << 16  # one write per response
+    connections = set()
+    bodies = []
+    aborted = threading.Event()
+    digest = "sha256:1"
+    delay = 0.0
+
+    def _reply(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        FakeOllama.connections.add(self.client_address)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        FakeOllama.bodies.append(body)
+        if body.get("stream"):
+            return self._stream(body)
+        time.sleep(FakeOllama.delay)
+        self._reply({"model": body["model"], "response": f"echo {body['prompt']}", "done": True})
+
+    def _stream(self, body):
+        # one NDJSON line per word, body ends when the connection closes
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for word in body["prompt"].split():
+                self.wfile.write(json.dumps({"response": word + " ", "done": False}).encode() + b"\n")
+                self.wfile.flush()
+                time.sleep(0.01)
+            self.wfile.write(json.dumps({"response": "", "done": True, "eval_count": 3, "context": [1]}).encode() + b"\n")
+        except OSError:
+            FakeOllama.aborted.set()
+
+    def do_GET(self):
+        FakeOllama.connections.add(self.client_address)
+        self._reply({"models": [{"name": "codellama:7b", "digest": FakeOllama.digest}]})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ollama_host():
+    FakeOllama.connections.clear()
+    FakeOllama.bodies.clear()
+    FakeOllama.aborted.clear()
+    FakeOllama.digest = "sha256:1"
+    FakeOllama.delay = 0.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_calls_reuse_pooled_connections(ollama_host):
+    llm = LlmGateway(ollama_host, keep_alive="10m")
+    for i in range(5):
+        assert llm.generate(model="m", prompt=str(i))["response"] == f"echo {i}"
+    assert llm.list() == ["codellama:7b"]
+
+    async def ask():
+        try:
+            return [(await llm.agenerate(model="m", prompt="a", keep_alive=0))["response"] for _ in range(5)]
+        finally:
+            await llm.aclose()
+
+    assert asyncio.run(ask()) == ["echo a"] * 5
+    # one connection for the sync client, one for the async one
+    assert len(FakeOllama.connections) == 2
+    assert [b.get("keep_alive") for b in FakeOllama.bodies] == ["10m"] * 5 + [0] * 5
+
+
+def test_analyze_endpoint_uses_the_app_gateway(ollama_host, monkeypatch):
+    import importlib
+    import os
+
+    from fastapi.testclient import TestClient
+
+    mod = importlib.import_module(os.getenv("APP_MODULE", "main:app").split(":")[0])
+    monkeypatch.setattr(mod, "LLM", LlmGateway(ollama_host))
+    with TestClient(mod.app) as client:
+        for _ in range(3):
+            res = client.post("/api/analyze", json={"prompt": "hi"})
+            assert res.status_code == 200 and res.json()["response"] == "echo hi"
+    assert len(FakeOllama.connections) == 1
+
+
+
+def test_app_restarts_with_a_fresh_gateway(ollama_host, monkeypatch):
+    import importlib
+    import os
+
+    from fastapi.testclient import TestClient
+
+    mod = importlib.import_module(os.getenv("APP_MODULE", "main:app").split(":")[0])
+    monkeypatch.setattr(mod, "OLLAMA_HOST", ollama_host)
+    monkeypatch.setattr(mod, "LLM", None)
+    for _ in range(2):
+        # the second lifespan must not reuse the pool the first one closed
+        with TestClient(mod.app) as client:
+            assert client.post("/api/analyze", json={"prompt": "hi"}).json()["response"] == "echo hi"
+        assert mod.LLM is None
+
+def test_analyze_streams_server_sent_events(ollama_host, monkeypatch):
+    import importlib
+    import os
+
+    from fastapi.testclient import TestClient
+
+    mod = importlib.import_module(os.getenv("APP_MODULE", "main:app").split(":")[0])
+    monkeypatch.setattr(mod, "LLM", LlmGateway(ollama_host))
+    with TestClient(mod.app) as client:
+        res = client.post("/api/analyze", json={"prompt": "a b c", "stream": True})
+    assert res.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+        for block in res.text.strip().split("\n\n")
+    ]
+    assert events[0] == ("meta", {"model": "codellama:7b"})
+    assert "".join(e[1]["response"] for e in events if e[0] == "token") == "a b c "
+    assert events[-1] == ("done", {"done": True, "eval_count": 3})
+
+
+def test_closing_a_stream_stops_the_generation(ollama_host):
+    llm = LlmGateway(ollama_host)
+
+    async def read_two():
+        parts = llm.astream(model="m", prompt="word " * 500)
+        got = []
+        async for part in parts:
+            got.append(part)
+            if len(got) == 2:
+                break
+        await parts.aclose()
+        await llm.aclose()
+        return got
+
+    assert [p["response"] for p in asyncio.run(read_two())] == ["word ", "word "]
+    assert FakeOllama.aborted.wait(5)
+
+
+
+def test_identical_concurrent_requests_share_one_generation(ollama_host):
+    FakeOllama.delay = 0.2
+    llm = LlmGateway(ollama_host)
+
+    async def ask():
+        try:
+            return await asyncio.gather(
+                *[llm.agenerate(model="m", prompt="same", options={"temperature": 0}) for _ in range(5)],
+                llm.agenerate(model="m", prompt="same", options={"temperature": 0.5}),
+            )
+        finally:
+            await llm.aclose()
+
+    assert [r["response"] for r in asyncio.run(ask())] == ["echo same"] * 6
+    # the request with other options is not the same request
+    assert len(FakeOllama.bodies) == 2 and llm.coalesced == 4
+
+
+def test_stream_subscribers_share_one_generation(ollama_host):
+    llm = LlmGateway(ollama_host)
+
+    async def read(delay):
+        await asyncio.sleep(delay)
+        return "".join([p["response"] async for p in llm.astream(model="m", prompt="a b c d e f")])
+
+    async def readers():
+        try:
+            # the last one joins when some words have been streamed already
+            return await asyncio.gather(read(0), read(0), read(0.03))
+        finally:
+            await llm.aclose()
+
+    assert asyncio.run(readers()) == ["a b c d e f "] * 3
+    assert len(FakeOllama.bodies) == 1 and llm.coalesced == 2
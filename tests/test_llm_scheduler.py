@@ -0,0 +1,58 @@
+import asyncio
+import importlib
+import os
+
+import pytest
+
+from app.utils.llm_gateway import LlmGateway
+from app.utils.llm_scheduler import LlmScheduler, QueueFull
+from tests.test_llm_gateway import FakeOllama, ollama_host  # noqa: F401
+
+
+def test_interactive_requests_go_first_and_a_full_queue_refuses():
+    sched = LlmScheduler(concurrency=1, max_queue=3)
+    order = []
+
+    async def run(name, priority):
+        async with sched.aslot("m", priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        held = sched.aslot("m")
+        await held.__aenter__()
+        waiting = [asyncio.ensure_future(run(*a)) for a in [("batch", "batch"), ("gone", "batch"), ("chat", "interactive")]]
+        await asyncio.sleep(0.01)
+        with pytest.raises(QueueFull) as refused:
+            await run("late", "interactive")
+        assert refused.value.retry_after >= 1
+        # a cancelled waiter leaves the queue
+        waiting.pop(1).cancel()
+        await asyncio.sleep(0)
+        assert sched.stats()["models"]["m"]["queued"] == 2
+        await held.__aexit__(None, None, None)
+        await asyncio.gather(*waiting)
+
+    asyncio.run(main())
+    assert order == ["chat", "batch"]
+    stats = sched.stats()["models"]["m"]
+    assert stats["active"] == 0 and stats["queued"] == 0 and stats["rejected"] >= 1
+
+
+def test_endpoints_answer_429_when_the_queue_is_full(ollama_host, monkeypatch):  # noqa: F811
+    from fastapi.testclient import TestClient
+
+    mod = importlib.import_module(os.getenv("APP_MODULE", "main:app").split(":")[0])
+    sched = LlmScheduler(concurrency=1, max_queue=0)
+    monkeypatch.setattr(mod, "LLM_SCHEDULER", sched)
+    monkeypatch.setattr(mod, "LLM", LlmGateway(ollama_host, scheduler=sched))
+    with TestClient(mod.app) as client:
+        with sched.slot("codellama:7b"):
+            for body in ({"prompt": "hi"}, {"prompt": "hi", "stream": True}):
+                res = client.post("/api/analyze", json=body)
+                assert res.status_code == 429 and int(res.headers["Retry-After"]) >= 1
+            # other models have their own slots
+            assert client.post("/api/analyze", json={"prompt": "hi", "model": "other"}).status_code == 200
+            assert client.get("/health").json()["llm_queue"]["models"]["codellama:7b"]["rejected"] == 2
+        assert client.post("/api/analyze", json={"prompt": "hi"}).json()["response"] == "echo hi"
+    assert len(FakeOllama.bodies) == 2
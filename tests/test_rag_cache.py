@@ -0,0 +1,42 @@
+from app.utils.rag_cache import RetrievalCache, query_key
+
+
+def hit(source, text="x" * 10):
+    return {"source": source, "text": text, "score": 1.0}
+
+
+def test_key_ignores_token_order_but_not_k():
+    assert query_key(["facet", "address"], 8) == query_key(["address", "facet"], 8)
+    assert query_key(["facet"], 8) != query_key(["facet"], 4)
+    assert query_key(["facet"], 8) != query_key(["facet"], 8, min_score=1.0)
+
+
+def test_lru_bounds_and_generation_invalidation():
+    cache = RetrievalCache(max_entries=2, max_bytes=10_000)
+    cache.put("a", [hit("A.sol")])
+    cache.put("b", [hit("B.sol")])
+    assert cache.get("a")[0]["source"] == "A.sol"
+    cache.put("c", [hit("C.sol")])  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+    got = cache.get("a")
+    got[0]["text"] = "mutated"
+    assert cache.get("a")[0]["text"] == "x" * 10
+
+    generation = cache.generation
+    cache.bump()
+    assert cache.get("a") is None
+    cache.put("a", [hit("stale.sol")], generation)  # computed against the old index
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats["entries"] == 0 and stats["hits"] == 3 and stats["misses"] == 3
+
+
+def test_byte_budget_evicts_oldest():
+    cache = RetrievalCache(max_entries=100, max_bytes=1000)
+    cache.put("a", [hit("A.sol", "a" * 300)])
+    cache.put("b", [hit("B.sol", "b" * 300)])
+    assert cache.get("a") is None and cache.get("b") is not None
+    cache.put("huge", [hit("H.sol", "h" * 5000)])
+    assert cache.get("huge") is None and cache.get("b") is not None
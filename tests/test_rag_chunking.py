@@ -0,0 +1,72 @@
+from app.utils.rag_chunking import MIN_CHUNK_CHARS, chunk_source, solidity_spans, split_solidity
+from app.utils.rag_index import SourceFile
+
+BODY = "        total += amount; // keeps function/event words in comments harmless\n" * 4
+
+SOURCE = f"""// SPDX-License-Identifier: MIT
+pragma solidity ^0.8.20;
+
+/// @title Vault
+abstract contract Vault {{
+    event Deposited(address indexed who, uint256 amount);
+    error Nope();
+    string constant NOTE = "function contract {{ not a declaration";
+    uint256 public total;
+
+    /// @notice Deposit funds.
+    function deposit(uint256 amount, function(uint256) external cb) external {{
+{BODY}        if (amount == 0) {{ revert Nope(); }}
+    }}
+
+    /* withdraw
+       function withdraw() is documented here */
+    function withdraw(uint256 amount) external {{
+{BODY}    }}
+}}
+"""
+
+
+def test_spans_cut_at_member_declarations_only():
+    chunks = split_solidity(SOURCE)
+    assert [c.splitlines()[0].strip() for c in chunks] == [
+        "// SPDX-License-Identifier: MIT",
+        "/// @notice Deposit funds.",
+        "/* withdraw",
+    ]
+    # header, events/errors and state vars merge into one chunk; no keyword-only junk
+    assert "abstract contract Vault" in chunks[0] and "uint256 public total;" in chunks[0]
+    assert all(len(c) >= MIN_CHUNK_CHARS for c in chunks[:-1])
+    assert chunks[1].rstrip().endswith("}")
+
+
+def test_spans_are_offsets_into_the_source():
+    spans = solidity_spans(SOURCE)
+    assert spans == sorted(spans) and all(0 <= s < e <= len(SOURCE) for s, e in spans)
+    docs = chunk_source(SourceFile(None, "Vault.sol"), SOURCE)
+    assert [(d["start"], d["end"]) for d in docs] == spans
+    assert all(d["text"] == SOURCE[d["start"] : d["end"]] for d in docs)
+
+
+def test_trailing_comment_does_not_swallow_the_next_declaration():
+    body = "        x += 1;\n" * 20
+    text = (
+        "contract X {\n    /// doc\n    function f() external {\n" + body + "    }\n"
+        "    uint a; // trailing\n    function g() external {\n" + body + "    }\n}\n"
+    )
+    chunks = split_solidity(text)
+    assert len(chunks) == 2
+    assert "function f()" in chunks[0] and "uint a; // trailing" in chunks[0]
+    assert chunks[1].startswith("function g()")
+
+def test_long_declarations_are_windowed_with_overlap():
+    text = "contract Big {\n    function f() external {\n" + "        x += 1;\n" * 400 + "    }\n}\n"
+    spans = solidity_spans(text, size=1500, overlap=150)
+    assert len(spans) > 3
+    assert all(e - s <= 1500 for s, e in spans)
+    assert all(b[0] == a[0] + 1350 for a, b in zip(spans[1:], spans[2:]))
+    assert spans[-1][1] == len(text.rstrip())
+
+
+def test_plain_text_without_declarations_is_one_chunk():
+    assert split_solidity("  just some notes\n") == ["just some notes"]
+    assert split_solidity(" \n\t") == []
@@ -0,0 +1,88 @@
+import numpy as np
+
+from app.utils.rag_dense import DenseIndex, EmbeddingCache, HashEmbedder, OllamaEmbedder, build_dense, hybrid_top_k, load_dense, write_dense
+from app.utils.rag_index import RagIndex
+from app.utils.rag_tokenizer import tokenize
+from tests.test_rag_index import CORPUS, chunker, sources, write_corpus
+
+
+class CountingEmbedder(HashEmbedder):
+    def __init__(self):
+        super().__init__(dim=64)
+        self.embedded = 0
+
+    def embed(self, texts):
+        self.embedded += len(texts)
+        return super().embed(texts)
+
+
+def test_hash_embedder_is_deterministic_and_normalized():
+    a, b = HashEmbedder().embed(["facetAddress lookup", "facetAddress lookup"])
+    assert np.allclose(a, b) and np.isclose(np.linalg.norm(a), 1.0)
+    assert np.allclose(HashEmbedder().embed([""]), 0)
+
+
+def test_rebuilds_only_embed_new_chunks(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    index = RagIndex()
+    index.sync(sources(corpus), chunker, tokenize)
+    embedder = CountingEmbedder()
+
+    dense, info = build_dense(index, embedder, EmbeddingCache(tmp_path / "emb", embedder.name))
+    assert info["embedded"] == embedder.embedded > 0 and info["cached"] == 0
+    assert dense.matrix.shape == (len(index.docs), 64)
+
+    # a fresh cache object reads the persisted rows back
+    write_corpus(corpus, {"core/New.sol": "contract New {\n\nfunction mint(uint256 amount)"})
+    index.sync(sources(corpus), chunker, tokenize)
+    before = embedder.embedded
+    dense, info = build_dense(index, embedder, EmbeddingCache(tmp_path / "emb", embedder.name))
+    assert info["embedded"] == embedder.embedded - before == 2  # just New.sol's two chunks
+    live = [i for i, d in enumerate(index.docs) if d is not None]
+    assert np.allclose(np.linalg.norm(dense.matrix[live], axis=1), 1.0, atol=1e-5)
+
+
+def test_hybrid_fuses_dense_only_matches(tmp_path):
+    write_corpus(tmp_path, CORPUS)
+    index = RagIndex()
+    index.sync(sources(tmp_path), chunker, tokenize)
+    query = tokenize("claim transfer")
+    target = next(i for i, d in enumerate(index.docs) if not set(query) & set(tokenize(d["text"])))
+    # a dense space where the query only resembles a doc that shares no terms with it
+    matrix = np.zeros((len(index.docs), 2), dtype=np.float32)
+    matrix[:, 0] = 1.0
+    matrix[target] = [0.0, 1.0]
+    dense = DenseIndex(matrix, "test")
+    qvec = np.array([0.0, 1.0], dtype=np.float32)
+
+    ids, fused, lexical, sims = hybrid_top_k(index, dense, query, qvec, k=3, weight=0.5)
+    assert target in ids and lexical[ids.index(target)] == 0.0 and sims[ids.index(target)] == 1.0
+    assert fused == sorted(fused, reverse=True)
+
+    # weight 1 is BM25 order; min_score keeps its BM25 meaning
+    assert hybrid_top_k(index, dense, query, qvec, k=3, weight=1.0, min_score=0.01)[0] == index.top_k(query, 3, min_score=0.01)[0]
+
+
+def test_stored_matrices_of_dotted_model_versions_stay_apart(tmp_path):
+    for version, rows in (("v1.5", 2), ("v1.6", 3)):
+        write_dense(tmp_path, DenseIndex(np.full((rows, 4), rows, dtype=np.float32), f"mxbai-embed-large:{version}"))
+    assert len(list(tmp_path.glob("dense-*.f32"))) == 2
+    for version, rows in (("v1.5", 2), ("v1.6", 3)):
+        dense = load_dense(tmp_path, f"mxbai-embed-large:{version}")
+        assert dense.matrix.shape == (rows, 4) and np.all(dense.matrix == rows)
+
+def test_ollama_embedder_uses_the_client_it_is_given():
+    class Pooled:
+        calls = 0
+
+        def embed(self, model, input):
+            Pooled.calls += 1
+            return {"embeddings": [[3.0, 4.0] for _ in input]}
+
+    clients = [Pooled()]
+    embedder = OllamaEmbedder("nomic-embed-text", batch_size=2, client=lambda: clients[-1])
+    assert np.allclose(embedder.embed(["a", "b", "c"]), [[0.6, 0.8]] * 3) and Pooled.calls == 2
+    # looked up per call: a replaced gateway client is followed
+    clients.append(Pooled())
+    assert embedder.client is clients[-1]
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from app.utils.rag_builder import stream_build
+from app.utils.rag_filters import DocAttributes, DocFilter
+from app.utils.rag_index import RagIndex, SourceFile
+from app.utils.rag_store import open_store, write_store
+from tests.test_rag_index import CORPUS, chunker, tokenize, write_corpus
+
+FILES = dict(
+    CORPUS,
+    **{
+        "facets/LiquidityPool.sol": "contract LiquidityPool {\n\nfunction transfer(uint256 amount) external",
+        "admin/Governor.sol": "contract Governor {\n\nfunction transfer(address to, uint256 amount) external",
+        "scripts/deploy.ts": "const amount = 1\n\ntransfer(amount)",
+        # same text as the Token chunk: one slot, two files
+        "vendor/Copy.sol": CORPUS["core/Token.sol"],
+    },
+)
+
+
+def all_sources(root):
+    return [SourceFile(p, str(p.relative_to(root))) for p in sorted([*root.rglob("*.sol"), *root.rglob("*.ts")])]
+
+
+def build(tmp_path):
+    write_corpus(tmp_path / "contracts", FILES)
+    index = RagIndex()
+    index.sync(all_sources(tmp_path / "contracts"), chunker, tokenize)
+    return index
+
+
+def test_doc_filter_normalizes_and_validates():
+    assert DocFilter.of(bucket=" Liquidity ", path_prefix="./facets/", ext="SOL") == DocFilter("liquidity", "facets/", ".sol")
+    assert not DocFilter.of() and not DocFilter.of(path_prefix="./")
+    with pytest.raises(ValueError):
+        DocFilter.of(bucket="treasury")
+
+
+def test_locate_reports_the_first_occurrence_inside_the_filter():
+    doc = {"id": "core/A.sol#0", "source": "core/A.sol", "text": "t", "duplicates": [
+        {"id": "vendor/A.sol#0", "source": "vendor/A.sol"},
+        {"id": "facets/LiquidityA.sol#2", "source": "facets/LiquidityA.sol"},
+    ]}
+    assert DocFilter.of().locate(doc) is doc and DocFilter.of(bucket="core").locate(doc) is doc
+    assert DocFilter.of(bucket="misc").locate(doc)["source"] == "vendor/A.sol"
+    moved = DocFilter.of(path_prefix="facets/", ext="sol").locate(doc)
+    assert moved["id"] == "facets/LiquidityA.sol#2" and moved["text"] == "t"
+    assert DocFilter.of(ext="ts").matches("scripts/deploy.ts") and not DocFilter.of(ext="ts").matches("a.sol")
+
+def test_filtered_top_k_is_the_filtered_ranking(tmp_path):
+    index = build(tmp_path)
+    write_store(index, tmp_path / "index")
+    store = open_store(tmp_path / "index")
+    attrs = store.attributes
+    query = tokenize("transfer amount")
+    everything, _ = store.top_k(query, len(store.docs), min_score=1e-9, prune=False)
+
+    def sources_of(i):
+        doc = store.docs[i]
+        return [doc["source"]] + [d["source"] for d in doc.get("duplicates", [])]
+
+    for flt, allowed in [
+        (DocFilter.of(bucket="liquidity"), lambda s: "liquid" in s.lower()),
+        (DocFilter.of(path_prefix="facets"), lambda s: s.startswith("facets/")),
+        (DocFilter.of(ext="ts"), lambda s: s.endswith(".ts")),
+        (DocFilter.of(path_prefix="vendor/"), lambda s: s.startswith("vendor/")),
+        (DocFilter.of(bucket="core", ext="sol"), lambda s: "core" in s and s.endswith(".sol")),
+        (DocFilter.of(path_prefix="nowhere"), lambda s: False),
+    ]:
+        within = attrs.mask(flt)
+        want = [i for i in everything if any(allowed(s) for s in sources_of(i))]
+        assert store.top_k(query, 3, min_score=1e-9, within=within)[0] == want[:3], flt
+        # the zero-score fill stays inside the filter too
+        assert all(within[i] for i in store.top_k(query, 20, within=within)[0])
+    # vendor/ only holds copies: its chunks match through their duplicates
+    top = store.top_k(query, 1, within=attrs.mask(DocFilter.of(path_prefix="vendor")))[0][0]
+    assert not store.docs[top]["source"].startswith("vendor/") and "vendor/Copy.sol" in sources_of(top)
+
+
+def test_streamed_build_writes_the_same_attributes(tmp_path):
+    index = build(tmp_path)
+    write_store(index, tmp_path / "a")
+    stream_build(all_sources(tmp_path / "contracts"), chunker, tokenize, tmp_path / "b")
+    a, b = open_store(tmp_path / "a").attributes, open_store(tmp_path / "b").attributes
+    fresh = DocAttributes.from_manifest(index.manifest, len(index.docs))
+    for attrs in (b, fresh):
+        assert attrs.files == a.files
+        for flt in (DocFilter.of(bucket="rewards"), DocFilter.of(ext="ts"), DocFilter.of(path_prefix="facets/L")):
+            assert np.array_equal(attrs.mask(flt), a.mask(flt))
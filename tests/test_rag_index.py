@@ -0,0 +1,217 @@
+import re
+import time
+
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+from app.utils import rag_index
+from app.utils.rag_index import Bm25Scorer, RagIndex, SourceFile, doc_sources, select_top_k
+
+
+def tokenize(s):
+    return re.findall(r"\w+", s.lower())
+
+
+def chunker(src, text):
+    parts = [p for p in text.split("\n\n") if p.strip()]
+    return [{"id": f"{src.rel}#{i}", "text": p, "source": src.rel} for i, p in enumerate(parts)]
+
+
+def write_corpus(root, files):
+    for rel, text in files.items():
+        p = root / rel
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(text, encoding="utf-8")
+
+
+def sources(root):
+    return [SourceFile(p, str(p.relative_to(root))) for p in sorted(root.rglob("*.sol"))]
+
+
+CORPUS = {
+    "core/Token.sol": "contract Token {\n\nfunction transfer(address to, uint256 amount) external\n\nevent Transfer",
+    "facets/LiquidityFacet.sol": "contract LiquidityFacet {\n\nfunction addLiquidity(uint256 amount) external",
+    "facets/RewardsFacet.sol": "contract RewardsFacet {\n\nfunction claim() external\n\nfunction transfer rewards",
+}
+
+
+def _assert_matches_okapi(index, query):
+    live = [i for i, d in enumerate(index.docs) if d is not None]
+    ref = BM25Okapi([tokenize(index.docs[i]["text"]) for i in live])
+    got = index.get_scores(tokenize(query))
+    assert np.allclose(got[live], ref.get_scores(tokenize(query)))
+
+
+def test_scores_match_bm25okapi(tmp_path):
+    write_corpus(tmp_path, CORPUS)
+    index = RagIndex()
+    stats = index.sync(sources(tmp_path), chunker, tokenize)
+    assert stats["added"] == 3
+    for q in ["transfer amount", "liquidity facet", "claim rewards transfer"]:
+        _assert_matches_okapi(index, q)
+
+
+def test_incremental_sync_only_touches_changed_files(tmp_path):
+    write_corpus(tmp_path, CORPUS)
+    index = RagIndex()
+    index.sync(sources(tmp_path), chunker, tokenize)
+
+    chunked = []
+
+    def counting_chunker(src, text):
+        chunked.append(src.rel)
+        return chunker(src, text)
+
+    stats = index.sync(sources(tmp_path), counting_chunker, tokenize)
+    assert stats == {"added": 0, "changed": 0, "removed": 0, "unchanged": 3}
+    assert chunked == []
+
+    (tmp_path / "facets/RewardsFacet.sol").unlink()
+    write_corpus(tmp_path, {"core/Token.sol": "contract Token {\n\nfunction mint(uint256 amount) external"})
+    write_corpus(tmp_path, {"facets/AdminFacet.sol": "contract AdminFacet {\n\nfunction setOwner(address owner)"})
+    stats = index.sync(sources(tmp_path), counting_chunker, tokenize)
+    assert stats == {"added": 1, "changed": 1, "removed": 1, "unchanged": 1}
+    assert sorted(chunked) == ["core/Token.sol", "facets/AdminFacet.sol"]
+
+    assert index.vocab.get("claim") not in index.postings
+    assert sorted(e["rel"] for e in index.manifest.values()) == [
+        "core/Token.sol",
+        "facets/AdminFacet.sol",
+        "facets/LiquidityFacet.sol",
+    ]
+    fresh = RagIndex()
+    fresh.sync(sources(tmp_path), chunker, tokenize)
+    assert index.n_live == fresh.n_live and index.total_len == fresh.total_len
+    for q in ["mint amount", "owner", "liquidity"]:
+        _assert_matches_okapi(index, q)
+
+
+def test_top_k_matches_bm25okapi_ranking(tmp_path):
+    rng = np.random.default_rng(7)
+    vocab = [f"w{i}" for i in range(60)] + ["facet", "selector", "diamond", "owner"]
+    files = {}
+    for f in range(40):
+        paras = [" ".join(rng.choice(vocab, size=rng.integers(3, 25))) for _ in range(rng.integers(1, 5))]
+        files[f"f{f:02d}.sol"] = "\n\n".join(paras)
+    write_corpus(tmp_path, files)
+    index = RagIndex()
+    index.sync(sources(tmp_path), chunker, tokenize)
+
+    ref = BM25Okapi([tokenize(d["text"]) for d in index.docs])
+    for _ in range(30):
+        query = list(rng.choice(vocab, size=rng.integers(1, 6))) + ["unknown"]
+        for k in (1, 5, 20):
+            expected = ref.get_scores(query)
+            want = sorted(range(len(expected)), key=lambda i: expected[i], reverse=True)[:k]
+            got, scores = index.top_k(query, k)
+            assert np.allclose(scores, expected[want])
+            # ids can only differ inside groups of equal scores
+            assert [round(expected[i], 9) for i in got] == [round(expected[i], 9) for i in want]
+
+
+def test_pruned_top_k_is_exhaustive_top_k(tmp_path, monkeypatch):
+    rng = np.random.default_rng(11)
+    # a few terms in nearly every chunk, a long tail of rare ones
+    vocab = [f"w{i}" for i in range(200)]
+    p = 1.0 / np.arange(1, len(vocab) + 1)
+    files = {f"f{f:02d}.sol": "\n\n".join(" ".join(rng.choice(vocab, size=rng.integers(5, 40), p=p / p.sum())) for _ in range(4)) for f in range(60)}
+    write_corpus(tmp_path, files)
+    index = RagIndex()
+    index.sync(sources(tmp_path), chunker, tokenize)
+    monkeypatch.setattr(RagIndex, "prune_min_postings", 0)
+
+    skipped = 0
+    for _ in range(40):
+        query = list(rng.choice(vocab[:40], size=rng.integers(2, 12)))
+        for k, min_score in ((1, None), (5, None), (5, 2.0), (300, None)):
+            assert index.top_k(query, k, min_score) == index.top_k(query, k, min_score, prune=False)
+        skipped += len(index.score(query)[0]) - len(index.score_pruned(query, 5)[0])
+    assert skipped > 0
+
+
+def test_scorer_missing_a_hook_fails_at_construction():
+    class Partial(Bm25Scorer):
+        avgdl = n_slots = 0
+
+        def term_ids(self, terms):
+            return [-1] * len(terms)
+
+    with pytest.raises(TypeError, match="_term_postings"):
+        Partial()
+
+def test_select_top_k_breaks_ties_by_lower_id():
+    ids = np.array([9, 3, 7, 1, 5], dtype=np.int32)
+    scores = np.array([2.0, 5.0, 2.0, 2.0, 1.0])
+    assert select_top_k(ids, scores, 3) == ([3, 1, 7], [5.0, 2.0, 2.0])
+    assert select_top_k(ids, scores, 10)[0] == [3, 1, 7, 9, 5]
+    assert select_top_k(ids[:0], scores[:0], 3) == ([], [])
+
+
+def test_min_score_skips_zero_score_fill(tmp_path):
+    write_corpus(tmp_path, CORPUS)
+    index = RagIndex()
+    index.sync(sources(tmp_path), chunker, tokenize)
+    padded, _ = index.top_k(tokenize("claim"), 5)
+    assert len(padded) == 5
+    ids, scores = index.top_k(tokenize("claim"), 5, min_score=0.01)
+    assert len(ids) == 1 and index.docs[ids[0]]["source"] == "facets/RewardsFacet.sol"
+    assert index.top_k(tokenize("claim"), 5, min_score=scores[0] + 1) == ([], [])
+
+
+def test_process_pool_build_matches_thread_build(tmp_path, monkeypatch):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    write_corpus(corpus, {f"gen/G{i}.sol": f"contract G{i} {{\n\nfunction f{i}(uint256 amount)" for i in range(20)})
+    threaded = RagIndex()
+    threaded.sync(sources(corpus), chunker, tokenize)
+    monkeypatch.setattr(rag_index, "PROCESS_POOL_MIN_FILES", 1)
+    pooled = RagIndex()
+    assert pooled.sync(sources(corpus), chunker, tokenize, processes=2)["added"] == 23
+    assert pooled.docs == threaded.docs and pooled.postings == threaded.postings
+    assert np.allclose(pooled.get_scores(tokenize("transfer amount")), threaded.get_scores(tokenize("transfer amount")))
+
+
+def test_loading_stays_a_bounded_window_ahead_of_the_consumer(tmp_path):
+    write_corpus(tmp_path, {f"F{i}.sol": f"contract F{i} {{" for i in range(40)})
+    loaded = []
+
+    def counting_chunker(src, text):
+        loaded.append(src.rel)
+        return chunker(src, text)
+
+    items = [(src, {}, None) for src in sources(tmp_path)]
+    results = rag_index.load_sources(items, counting_chunker, tokenize, max_workers=2)
+    first = next(results)
+    # a stalled consumer holds at most two files per worker
+    time.sleep(0.1)
+    assert first[0].rel == "F0.sol" and len(loaded) <= 4
+    assert [res[0].rel for res in results] == [src.rel for src, _, _ in items[1:]]
+    assert len(loaded) == 40
+
+def test_identical_chunks_are_indexed_once(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    write_corpus(corpus, {
+        "original/Token.sol": CORPUS["core/Token.sol"],
+        "ai/Token.sol": CORPUS["core/Token.sol"] + "\n\nfunction mint(uint256 amount)",
+    })
+    index = RagIndex()
+    index.sync(sources(corpus), chunker, tokenize)
+    unique = {d["text"] for d in index.docs if d is not None}
+    assert index.n_live == len(unique) and index.n_chunks == index.n_live + 6
+    ref = BM25Okapi([tokenize(t) for t in (d["text"] for d in index.docs)])
+    assert np.allclose(index.get_scores(tokenize("transfer amount")), ref.get_scores(tokenize("transfer amount")))
+
+    slot = index.manifest[str(corpus / "core/Token.sol")]["chunks"][1]
+    assert doc_sources(index.docs[slot]) == ["ai/Token.sol", "core/Token.sol", "original/Token.sol"]
+
+    # dropping copies promotes the next occurrence; the last one frees the slot
+    (corpus / "ai/Token.sol").unlink()
+    (corpus / "core/Token.sol").unlink()
+    index.sync(sources(corpus), chunker, tokenize)
+    assert index.docs[slot] == {"id": "original/Token.sol#1", "text": index.docs[slot]["text"], "source": "original/Token.sol"}
+    (corpus / "original/Token.sol").unlink()
+    index.sync(sources(corpus), chunker, tokenize)
+    assert index.docs[slot] is None and index.n_chunks == index.n_live
+    assert set(index.by_digest.values()) == {i for i, d in enumerate(index.docs) if d is not None}
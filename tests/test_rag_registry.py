@@ -0,0 +1,46 @@
+from app.utils.rag_index import RagIndex
+from app.utils.rag_registry import IndexRegistry, root_slug, snapshot_bytes
+from app.utils.rag_store import open_snapshot, write_store
+from tests.test_rag_index import CORPUS, chunker, sources, tokenize, write_corpus
+
+
+def build_root(registry, tmp_path, name):
+    root = (tmp_path / name / "contracts").resolve()
+    write_corpus(root, CORPUS)
+    index = RagIndex()
+    index.sync(sources(root), chunker, tokenize)
+    registry.root_dir(root)
+    write_store(index, registry.store_dir(root))
+    return root
+
+
+def test_roots_get_separate_stores(tmp_path):
+    registry = IndexRegistry(tmp_path / "roots")
+    a, b = build_root(registry, tmp_path, "a"), build_root(registry, tmp_path, "b")
+    # equally named roots do not share a directory
+    assert a.name == b.name and root_slug(a) != root_slug(b)
+    assert {r["root"] for r in registry.roots()} == {str(a), str(b)}
+    assert registry.get(tmp_path / "never-built") is None
+    # looking up an unknown root creates nothing
+    assert not registry.known(tmp_path / "never-built") and len(list(registry.base.iterdir())) == 2
+
+
+def test_recent_roots_stay_open_within_the_budget(tmp_path):
+    registry = IndexRegistry(tmp_path / "roots")
+    roots = [build_root(registry, tmp_path, name) for name in "abc"]
+    size = snapshot_bytes(open_snapshot(registry.store_dir(roots[0])))
+    registry.max_bytes = 2 * size
+
+    a = registry.get(roots[0])
+    assert registry.get(roots[0]) is a and registry.opens == 1
+    registry.get(roots[1])
+    registry.get(roots[0])  # a is now the most recently used
+    registry.get(roots[2])  # evicts b, the least recently used
+    assert registry.stats()["evictions"] == 1 and registry.get(roots[0]) is a
+    assert {r["root"]: r["loaded"] for r in registry.roots()} == {str(roots[0]): True, str(roots[1]): False, str(roots[2]): True}
+
+    # a new generation of a loaded root is picked up
+    index = RagIndex()
+    index.sync(sources(roots[0]), chunker, tokenize)
+    gen = write_store(index, registry.store_dir(roots[0]))
+    assert registry.get(roots[0]).generation == gen != a.generation
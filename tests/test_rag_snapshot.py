@@ -0,0 +1,210 @@
+import importlib
+import os
+import threading
+
+import pytest
+
+mod = importlib.import_module(os.getenv("APP_MODULE", "main:app").split(":")[0])
+
+CONTRACT = "contract Vault{i} {{\n    function deposit(uint256 amount) external {{\n" + "        total += amount;\n" * 20 + "    }}\n}}\n"
+
+
+@pytest.fixture
+def rag_app(tmp_path, monkeypatch):
+    root = tmp_path / "contracts"
+    root.mkdir()
+    for i in range(20):
+        (root / f"Vault{i}.sol").write_text(CONTRACT.format(i=i), encoding="utf-8")
+    monkeypatch.setattr(mod, "CONTRACTS_ROOT", root)
+    monkeypatch.setattr(mod, "SCRIPTS_ROOT", None)
+    monkeypatch.setattr(mod, "STORE_DIR", tmp_path / "index")
+    monkeypatch.setattr(mod, "SNAPSHOT", None)
+    monkeypatch.setattr(mod, "_BUILDER", None)
+    monkeypatch.setattr(mod, "RAG_BUILD_WORKERS", 1)
+    mod.RETRIEVAL_CACHE.bump()
+    yield mod
+    mod.RETRIEVAL_CACHE.bump()
+
+
+def test_queries_keep_working_during_rebuilds(rag_app):
+    rag_app._build_index(False, "empty")
+    first = rag_app.SNAPSHOT.generation
+    stop = threading.Event()
+    errors = []
+
+    def rebuild():
+        try:
+            for _ in range(3):
+                rag_app._build_index(False, "empty")
+        except Exception as exc:  # pragma: no cover - reported below
+            errors.append(exc)
+        finally:
+            stop.set()
+
+    t = threading.Thread(target=rebuild)
+    t.start()
+    served = 0
+    while not stop.is_set() or served == 0:
+        hits = rag_app._retrieve("deposit amount", k=3)
+        assert len(hits) == 3
+        served += 1
+    t.join()
+    assert not errors
+    assert rag_app.SNAPSHOT.generation != first
+
+
+def test_pinned_snapshot_survives_a_publish(rag_app):
+    rag_app._build_index(False, "empty")
+    pinned = rag_app._pin_snapshot()
+    rag_app._build_index(False, "empty")
+    rag_app._build_index(False, "empty")
+    # the pinned generation has been replaced and pruned from disk
+    assert rag_app.SNAPSHOT is not pinned
+    assert not (rag_app.STORE_DIR / pinned.generation).exists()
+    top, _ = pinned.index.top_k(["deposit"], 2)
+    assert all(pinned.docs[i]["source"].startswith("Vault") for i in top)
+
+
+def test_filtered_hits_name_a_file_inside_the_filter(rag_app):
+    from app.utils.rag_filters import DocFilter
+
+    shared = "contract Shared {\n    function sweep(uint256 dust) external {}\n}\n"
+    for rel in ("core/Shared.sol", "vendor/Shared.sol"):
+        (rag_app.CONTRACTS_ROOT / rel).parent.mkdir()
+        (rag_app.CONTRACTS_ROOT / rel).write_text(shared, encoding="utf-8")
+    rag_app._build_index(False, "empty")
+    # one chunk, in the core and the misc bucket
+    (hit,) = rag_app._retrieve("sweep dust", k=1)
+    assert sorted(hit["sources"]) == ["core/Shared.sol", "vendor/Shared.sol"]
+    for flt, source in [
+        (DocFilter.of(bucket="misc"), "vendor/Shared.sol"),
+        (DocFilter.of(path_prefix="vendor"), "vendor/Shared.sol"),
+        (DocFilter.of(bucket="core"), "core/Shared.sol"),
+    ]:
+        (hit,) = rag_app._retrieve("sweep dust", k=1, filters=flt)
+        assert hit["source"] == source and hit["id"].startswith(source)
+        (batched,) = rag_app._retrieve_batch(["sweep dust"], k=1, filters=flt)
+        assert [h["source"] for h in batched] == [source]
+
+def test_batch_search_matches_single_queries(rag_app):
+    from fastapi.testclient import TestClient
+
+    rag_app._build_index(False, "empty")
+    client = TestClient(rag_app.app)
+    queries = ["deposit amount", "Vault3", "total"]
+    res = client.post("/contracts/search-index/batch", json={"queries": queries, "k": 3})
+    assert res.status_code == 200
+    rag_app.RETRIEVAL_CACHE.bump()
+    assert res.json()["results"] == [client.get("/contracts/search-index", params={"q": q, "k": 3}).json() for q in queries]
+
+    too_many = {"queries": ["deposit"] * (rag_app.RAG_BATCH_MAX + 1)}
+    assert client.post("/contracts/search-index/batch", json=too_many).status_code == 413
+
+
+def test_warm_up_preloads_and_primes_before_ready(rag_app, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    rag_app._build_index(False, "empty")
+    monkeypatch.setattr(rag_app, "SNAPSHOT", None)  # a fresh process
+    (tmp_path / "warmup.txt").write_text("deposit amount\n\nVault3\n", encoding="utf-8")
+    monkeypatch.setattr(rag_app, "RAG_WARMUP_QUERIES", f"@{tmp_path / 'warmup.txt'}")
+    monkeypatch.setattr(rag_app, "RAG_WARMUP_K", [3])
+    monkeypatch.setattr(rag_app, "WARMUP", {"state": "pending"})
+    woken = []
+
+    class Ollama:
+        def generate(self, **kw):
+            woken.append(kw)
+
+        def stats(self):
+            return {}
+
+    monkeypatch.setattr(rag_app, "LLM", Ollama())
+    client = TestClient(rag_app.app)
+    assert client.get("/health/ready").status_code == 503
+    assert client.get("/health").json()["ready"] is False
+
+    rag_app._warm_up()
+    res = client.get("/health/ready")
+    assert res.status_code == 200 and res.json()["queries"] == 2 and not res.json()["errors"]
+    assert rag_app.SNAPSHOT is not None and woken[0]["model"] == rag_app.WARMUP_MODEL
+    hits = rag_app.RETRIEVAL_CACHE.stats()["hits"]
+    rag_app._retrieve("Vault3", k=3)
+    assert rag_app.RETRIEVAL_CACHE.stats()["hits"] == hits + 1
+
+
+def test_switching_roots_keeps_their_indexes(rag_app, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(rag_app, "REGISTRY", rag_app.IndexRegistry(tmp_path / "roots", opener=rag_app.REGISTRY.opener))
+    monkeypatch.setattr(rag_app, "SEARCH_INDEX_PATH", tmp_path / "trigram.npz")
+    first = rag_app.CONTRACTS_ROOT.resolve()
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "Pool.sol").write_text("contract Pool {\n    function swap(uint256 amount) external {}\n}\n", encoding="utf-8")
+    client = TestClient(rag_app.app)
+    assert client.post("/admin/set-root", json={"new_root": str(first)}).json()["indexed"] is False
+    rag_app._build_index(False, "empty")
+    vault = rag_app.SNAPSHOT
+
+    res = client.post("/admin/set-root", json={"new_root": str(other)}).json()
+    assert res["indexed"] is False
+    rag_app._build_index(False, "empty")
+    # the first root can still be queried while the other one is served
+    hits = client.get("/contracts/search-index", params={"q": "deposit", "k": 2, "root": str(first)}).json()["results"]
+    assert [h["source"][:5] for h in hits] == ["Vault", "Vault"]
+    assert client.get("/contracts/search-index", params={"q": "swap", "k": 2}).json()["results"][0]["source"] == "Pool.sol"
+
+    # switching back serves the loaded snapshot: no build, no reopen
+    opens = rag_app.REGISTRY.opens
+    assert client.post("/admin/set-root", json={"new_root": str(first)}).json()["indexed"] is True
+    assert rag_app.SNAPSHOT is vault and rag_app.REGISTRY.opens == opens
+    # unknown roots are refused without leaving a directory behind, existing or not
+    for unknown in (tmp_path / "nowhere", tmp_path):
+        assert client.get("/contracts/search-index", params={"q": "deposit", "k": 1, "root": str(unknown)}).status_code == 400
+    assert len(list((tmp_path / "roots").iterdir())) == 2
+
+
+def test_workers_map_the_dense_matrix_built_with_the_generation(rag_app, tmp_path, monkeypatch):
+    import numpy as np
+
+    from app.utils.rag_dense import EmbeddingCache, HashEmbedder
+
+    embedder = HashEmbedder(dim=32)
+    monkeypatch.setattr(rag_app, "EMBEDDER", embedder)
+    monkeypatch.setattr(rag_app, "EMBED_CACHE", EmbeddingCache(tmp_path / "emb", embedder.name))
+    for incremental in (False, True):
+        (rag_app.CONTRACTS_ROOT / "Extra.sol").write_text(CONTRACT.format(i=99 + incremental), encoding="utf-8")
+        info = rag_app._build_index(incremental, "empty")
+        assert info["build"]["dense"]["dim"] == 32
+        built = rag_app.SNAPSHOT
+
+        # another worker picking up the generation maps the matrix, nothing is embedded or rebuilt
+        def no_rebuild(*args, **kwargs):
+            raise AssertionError("dense matrix rebuilt by a reader")
+
+        with monkeypatch.context() as m:
+            m.setattr(rag_app, "build_dense", no_rebuild)
+            m.setattr(rag_app, "SNAPSHOT", None)
+            snap = rag_app._load_index_if_present()
+        assert isinstance(snap.dense.matrix, np.memmap) and np.array_equal(snap.dense.matrix, built.dense.matrix)
+
+
+def test_regex_search_is_bounded(rag_app, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.utils.rag_trigram import RegexRunner
+
+    monkeypatch.setattr(rag_app, "SEARCH_INDEX_PATH", tmp_path / "trigram.npz")
+    monkeypatch.setattr(rag_app, "SEARCH_INDEX", None)
+    runner = RegexRunner(timeout=1.0, workers=1)
+    monkeypatch.setattr(rag_app, "REGEX_RUNNER", runner)
+    (rag_app.CONTRACTS_ROOT / "Slow.sol").write_text("a" * 40 + "!", encoding="utf-8")
+    client = TestClient(rag_app.app)
+    try:
+        res = client.get("/contracts/search", params={"q": r"^contract Vault1\d", "regex": True})
+        assert res.status_code == 200 and res.json()["count"] == 10
+        assert client.get("/contracts/search", params={"q": "a" * 300, "regex": True}).status_code == 400
+        assert client.get("/contracts/search", params={"q": "(a+)+$", "regex": True}).status_code == 408
+    finally:
+        runner.close()
@@ -0,0 +1,183 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from app.utils.rag_builder import stream_build
+from app.utils.rag_dense import DenseIndex, write_dense
+from app.utils.rag_filters import DocFilter
+from app.utils.rag_index import RagIndex
+from app.utils.rag_store import (
+    current_generation, new_generation_dir, open_snapshot, open_store, publish_generation, to_rag_index, write_store,
+)
+from tests.test_rag_index import CORPUS, chunker, sources, tokenize, write_corpus
+
+
+def build(root):
+    index = RagIndex()
+    index.sync(sources(root), chunker, tokenize)
+    return index
+
+
+def test_mapped_index_matches_in_memory_index(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    index = build(corpus)
+    store_dir = tmp_path / "index"
+    gen = write_store(index, store_dir)
+
+    store = open_store(store_dir)
+    assert store.generation == gen == current_generation(store_dir)
+    assert store.n_live == index.n_live and len(store.docs) == len(index.docs)
+    for q in ["transfer amount", "liquidity", "claim rewards", "missing"]:
+        assert np.allclose(store.get_scores(tokenize(q)), index.get_scores(tokenize(q)))
+        assert store.top_k(tokenize(q), 4) == index.top_k(tokenize(q), 4)
+    assert [store.docs[i] for i in range(len(store.docs))] == index.docs
+
+
+def test_generations_and_rehydrated_incremental_build(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    store_dir = tmp_path / "index"
+    write_store(build(corpus), store_dir)
+
+    (corpus / "facets/RewardsFacet.sol").unlink()
+    write_corpus(corpus, {"core/Token.sol": "contract Token {\n\nfunction burn(uint256 amount)"})
+    index = to_rag_index(open_store(store_dir))
+    stats = index.sync(sources(corpus), chunker, tokenize)
+    assert stats == {"added": 0, "changed": 1, "removed": 1, "unchanged": 1}
+    gen = write_store(index, store_dir)
+    write_store(index, store_dir)
+
+    # the previous generation is kept for readers that still map it
+    assert sorted(p.name for p in store_dir.iterdir() if p.is_dir()) == [gen, current_generation(store_dir)]
+    store = open_store(store_dir)
+    fresh = build(corpus)
+    for q in ["burn amount", "claim", "liquidity facet"]:
+        got = [(store.docs[i]["id"], round(s, 9)) for i, s in zip(*store.top_k(tokenize(q), 3, min_score=0.01))]
+        want = [(fresh.docs[i]["id"], round(s, 9)) for i, s in zip(*fresh.top_k(tokenize(q), 3, min_score=0.01))]
+        assert got == want
+
+
+def test_streamed_build_matches_in_memory_build(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    write_corpus(corpus, {f"gen/G{i}.sol": f"contract G{i} {{\n\nfunction transfer{i % 3}(uint256 amount)" for i in range(30)})
+    index = build(corpus)
+    # a tiny ceiling forces a segment per file and a real k-way merge
+    info = stream_build(sources(corpus), chunker, tokenize, tmp_path / "streamed", memory_limit_mb=0.0001)
+    assert info["segments"] > 10 and info["indexed_chunks"] == index.n_live
+    assert info["files"]["added"] == 33 and info["peak_rss_mb"] > 0
+
+    store = open_store(tmp_path / "streamed")
+    assert store.generation == info["generation"]
+    assert not (store.path / "segments").exists()
+    assert [store.docs[i] for i in range(len(store.docs))] == index.docs
+    assert store.load_manifest() == index.manifest
+    for q in ["transfer amount", "transfer1", "liquidity", "missing"]:
+        assert np.allclose(store.get_scores(tokenize(q)), index.get_scores(tokenize(q)))
+        assert store.top_k(tokenize(q), 5) == index.top_k(tokenize(q), 5)
+    rehydrated = to_rag_index(store)
+    assert rehydrated.sync(sources(corpus), chunker, tokenize)["unchanged"] == 33
+
+
+def test_streamed_build_of_empty_corpus_publishes_nothing(tmp_path):
+    (tmp_path / "contracts").mkdir()
+    info = stream_build(sources(tmp_path / "contracts"), chunker, tokenize, tmp_path / "index")
+    assert info["generation"] is None and current_generation(tmp_path / "index") is None
+    assert not any(p.name != "LOCK" for p in (tmp_path / "index").iterdir())
+
+
+def test_streamed_build_dedups_like_in_memory_build(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    write_corpus(corpus, {"original/Token.sol": CORPUS["core/Token.sol"], "copy/Rewards.sol": CORPUS["facets/RewardsFacet.sol"]})
+    index = build(corpus)
+    info = stream_build(sources(corpus), chunker, tokenize, tmp_path / "streamed", memory_limit_mb=0.0001)
+    store = open_store(tmp_path / "streamed")
+    assert info["chunk_occurrences"] == store.n_chunks == index.n_chunks > store.n_live == index.n_live
+    assert [store.docs[i] for i in range(len(store.docs))] == index.docs
+    assert np.allclose(store.get_scores(tokenize("claim transfer")), index.get_scores(tokenize("claim transfer")))
+    rehydrated = to_rag_index(store)
+    assert rehydrated.by_digest == index.by_digest and rehydrated.n_chunks == index.n_chunks
+
+
+def test_batch_scoring_matches_per_query_scoring(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    index = build(corpus)
+    write_store(index, tmp_path / "index")
+    store = open_store(tmp_path / "index")
+    queries = [tokenize(q) for q in ["transfer amount", "claim claim rewards", "", "missing", "liquidity facet amount"]]
+    for scorer in (index, store):
+        # tiny sub-batches exercise the splitting as well
+        for max_entries in (1, 1 << 22):
+            for q, (ids, scores) in zip(queries, scorer.score_batch(queries, max_entries=max_entries)):
+                want_ids, want_scores = scorer.score(q)
+                assert np.array_equal(ids, want_ids) and np.array_equal(scores, want_scores)
+        assert scorer.top_k_batch(queries, 3, min_score=0.01) == [scorer.top_k(q, 3, min_score=0.01) for q in queries]
+
+
+def test_docs_are_read_from_compressed_blocks(tmp_path, monkeypatch):
+    from app.utils import rag_store
+
+    monkeypatch.setattr(rag_store, "DOC_BLOCK_BYTES", 64)
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    write_corpus(corpus, {f"gen/G{i}.sol": f"contract G{i} {{\n\nfunction transfer{i % 3}(uint256 amount)" for i in range(30)})
+    index = build(corpus)
+    (corpus / "gen/G7.sol").unlink()
+    index.sync(sources(corpus), chunker, tokenize)  # leaves free slots
+    write_store(index, tmp_path / "index")
+    store = open_store(tmp_path / "index")
+    assert not (store.path / "docs.raw").exists()
+    assert (store.path / "blocks.u64").stat().st_size // 8 - 1 > 10
+
+    top, _ = store.top_k(tokenize("transfer1 amount"), 3)
+    assert [store.docs[i] for i in top] == [index.docs[i] for i in top]
+    assert 0 < store.docs.inflated <= 3
+    store.docs._cache_blocks = 2
+    assert [store.docs[i] for i in range(len(store.docs))] == index.docs
+    assert len(store.docs._cache) == 2
+
+
+def _new_generation(store_dir):
+    return new_generation_dir(Path(store_dir)).name
+
+
+def test_processes_sharing_a_store_never_share_or_lose_a_generation(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    store_dir = tmp_path / "index"
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context("spawn")) as ex:
+        names = list(ex.map(_new_generation, [str(store_dir)] * 8))
+    assert len(set(names)) == 8
+
+    first = write_store(build(corpus), store_dir)
+    # builds still being written survive other processes' publishes ...
+    building = new_generation_dir(store_dir)
+    for _ in range(3):
+        gen = write_store(build(corpus), store_dir)
+    assert building.is_dir() and sorted(p.name for p in store_dir.glob("g*")) == [building.name, *sorted(
+        (store_dir / "PUBLISHED").read_text().split()
+    )]
+    assert not (store_dir / first).exists()
+    # ... and one finishing late does not replace the newer generation
+    assert not publish_generation(store_dir, building.name) and current_generation(store_dir) == gen
+    assert not building.exists()
+
+
+def test_pinned_snapshot_reads_its_side_files_when_opened(tmp_path):
+    corpus = tmp_path / "contracts"
+    write_corpus(corpus, CORPUS)
+    store_dir = tmp_path / "index"
+    index = build(corpus)
+    write_store(index, store_dir, before_publish=lambda out: write_dense(out, DenseIndex(np.ones((len(index.docs), 4), dtype=np.float32), "m:v1.5")))
+    snap = open_snapshot(store_dir, "m:v1.5")
+    for _ in range(2):
+        write_store(build(corpus), store_dir)
+    assert not snap.index.path.exists()
+    # filters and the dense matrix of the pruned generation still work
+    assert snap.index.attributes.mask(DocFilter.of(bucket="rewards")).sum() == 3
+    assert snap.dense.matrix.shape == (len(index.docs), 4) and snap.dense.matrix.sum() == 4 * len(index.docs)
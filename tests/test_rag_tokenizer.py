@@ -0,0 +1,26 @@
+import numpy as np
+
+from app.utils.rag_tokenizer import Vocabulary, tokenize
+
+
+def test_identifiers_are_kept_whole_and_split():
+    assert tokenize("function facetAddress(bytes4 _selector) external view returns (address facetAddress_)") == [
+        "facetaddress", "facet", "address", "selector", "address", "facetaddress", "facet", "address",
+    ]
+    assert tokenize("DEFAULT_ADMIN_ROLE ERC20Upgradeable") == [
+        "default_admin_role", "default", "admin", "role", "erc20upgradeable", "erc", "upgradeable",
+    ]
+    assert set(tokenize("facet address lookup")) <= set(tokenize("facetAddress lookup"))
+
+
+def test_hex_literals_are_normalized_and_keywords_dropped():
+    assert tokenize("bytes4(0xCDFFACC6) uint256 memory calldata") == ["0xcdffacc6"]
+    assert tokenize("0xAbC0000000000000000000000000000000000dEf") == ["0xabc0000000000000000000000000000000000def"]
+
+
+def test_vocabulary_interns_dense_ids():
+    vocab = Vocabulary(["facet", "owner"])
+    assert vocab.intern("owner") == 1 and vocab.intern("diamond") == 2
+    assert vocab.intern_counts({"diamond": 3, "loupe": 1}) == {2: 3, 3: 1}
+    assert vocab.encode(["loupe", "nope", "facet"]).tolist() == [3, -1, 0]
+    assert vocab.encode([]).dtype == np.int32
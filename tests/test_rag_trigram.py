@@ -0,0 +1,79 @@
+import os
+import re
+import time
+
+import pytest
+
+from app.utils.rag_trigram import RegexRunner, RegexTimeout, TrigramIndex, regex_matcher, required_literals, substring_matcher
+
+
+def _write(root, rel, text):
+    p = root / rel
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_text(text, encoding="utf-8")
+    return p
+
+
+def test_required_literals_are_necessary_substrings():
+    assert required_literals("onlyOwner") == ["onlyOwner"]
+    assert required_literals(r"function\s+(deposit|withdraw)Facet\(") == ["function", "Facet("]
+    assert required_literals(r"x?abc") == ["abc"]
+    assert required_literals(r"a.b") == []
+
+
+def test_search_narrows_candidates_and_reports_every_line(tmp_path):
+    root = tmp_path / "contracts"
+    _write(root, "a/Vault.sol", "contract Vault {\n    function deposit() external onlyOwner {}\n    // onlyowner again\n}\n")
+    _write(root, "b/Token.sol", "contract Token {\n    function transfer() external {}\n}\n")
+    idx = TrigramIndex(root, tmp_path / "trigram.npz")
+    assert idx.refresh()["added"] == 2
+
+    res = idx.search(substring_matcher("onlyOwner"), ["onlyOwner"])
+    assert res["candidates"] == 1 and res["files_scanned"] == 1
+    assert [(h["file"], h["line"], h["column"]) for h in res["hits"]] == [
+        (os.path.join("a", "Vault.sol"), 2, 33),
+        (os.path.join("a", "Vault.sol"), 3, 8),
+    ]
+
+    pattern = r"^contract\s+\w+"
+    res = idx.search(regex_matcher(re.compile(pattern, re.M)), required_literals(pattern, re.M))
+    assert sorted(h["match"] for h in res["hits"]) == ["contract Token", "contract Vault"]
+    assert idx.search(substring_matcher("nowhere"), ["nowhere"])["candidates"] == 0
+
+
+def test_refresh_is_incremental_and_persisted(tmp_path):
+    root = tmp_path / "contracts"
+    vault = _write(root, "Vault.sol", "contract Vault {}\n")
+    _write(root, "Token.sol", "contract Token {}\n")
+    path = tmp_path / "trigram.npz"
+    TrigramIndex(root, path).refresh()
+
+    idx = TrigramIndex.load(root, path)
+    assert sorted(idx.files) == ["Token.sol", "Vault.sol"]
+    vault.write_text("contract Vault { uint256 reserve; }\n", encoding="utf-8")
+    os.utime(vault, ns=(1, 1))
+    (root / "Token.sol").unlink()
+    assert idx.refresh() == {"added": 0, "changed": 1, "removed": 1, "unchanged": 0}
+    assert idx.candidates(["reserve"]) == ["Vault.sol"]
+    assert idx.candidates(["Token"]) == []
+
+    # an index saved for another root is not reused
+    assert not TrigramIndex.load(tmp_path, path).files
+
+
+def test_runaway_regexes_are_stopped_at_the_deadline(tmp_path):
+    root = tmp_path / "contracts"
+    _write(root, "Vault.sol", "contract Vault {\n" + "a" * 40 + "!\n}\n")
+    idx = TrigramIndex(root)
+    idx.refresh()
+    runner = RegexRunner(timeout=1.0, workers=1)
+    try:
+        assert [h["match"] for h in idx.search_regex(runner, r"^contract\s+\w+", re.M)["hits"]] == ["contract Vault"]
+        started = time.perf_counter()
+        with pytest.raises(RegexTimeout):
+            idx.search_regex(runner, r"(a+)+$", re.M)  # catastrophic backtracking
+        assert time.perf_counter() - started < 3 and runner.kills == 1
+        # the killed worker is replaced
+        assert idx.search_regex(runner, r"Vault", 0)["hits"][0]["line"] == 1
+    finally:
+        runner.close()
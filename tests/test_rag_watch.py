@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from app.utils.rag_watch import SourceWatcher
+
+
+def wait_for(pred, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if pred():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_burst_of_changes_is_debounced_into_one_sync(tmp_path, use_inotify):
+    root = tmp_path / "contracts"
+    (root / "facets").mkdir(parents=True)
+    batches = []
+    done = threading.Event()
+
+    def on_change(paths):
+        batches.append(paths)
+        done.set()
+
+    watcher = SourceWatcher([root], on_change, suffixes={".sol"}, debounce=0.3, poll_interval=0.05,
+                            use_inotify=use_inotify).start()
+    try:
+        assert wait_for(lambda: watcher.backend != "none")
+        time.sleep(0.1)
+        for i in range(5):
+            (root / "facets" / f"F{i}.sol").write_text(f"contract F{i} {{}}")
+        (root / "notes.txt").write_text("ignored")
+        assert wait_for(lambda: watcher.status()["pending_changes"] > 0)
+        assert watcher.status()["lag_seconds"] >= 0
+        assert done.wait(5)
+        time.sleep(0.4)
+        assert len(batches) == 1
+        assert {p.rsplit("/", 1)[-1] for p in batches[0]} == {f"F{i}.sol" for i in range(5)}
+        status = watcher.status()
+        assert status["pending_changes"] == 0 and status["lag_seconds"] == 0.0
+        assert status["indexed_through"] == status["last_change"]
+    finally:
+        watcher.stop()
+    assert not watcher.status()["watching"]
+
+
+def test_failed_sync_is_kept_and_retried_with_backoff(tmp_path):
+    calls = []
+
+    def on_change(paths):
+        calls.append((time.time(), set(paths)))
+        if len(calls) <= 2:
+            raise RuntimeError("boom")
+
+    watcher = SourceWatcher([tmp_path], on_change, debounce=0.05, poll_interval=0.05, use_inotify=False,
+                            retry_backoff=0.2).start()
+    try:
+        watcher.trigger("start")
+        assert wait_for(lambda: watcher.status()["last_error"] == "boom")
+        # the index is stale until a sync succeeds
+        assert watcher.indexed_through is None
+        time.sleep(0.05)
+        assert watcher.status()["lag_seconds"] > 0 and watcher.status()["pending_changes"] == 1
+        watcher.trigger("again")
+        assert wait_for(lambda: len(calls) == 3 and watcher.status()["last_error"] is None)
+    finally:
+        watcher.stop()
+    # no new change is needed for the retries; they back off (0.2s, then 0.4s)
+    assert [c[1] for c in calls] == [{"start"}, {"start", "again"}, {"start", "again"}]
+    assert calls[2][0] - calls[1][0] >= 0.35
+    status = watcher.status()
+    assert status["failures"] == 0 and status["lag_seconds"] == 0.0 and status["indexed_through"] == status["last_change"]